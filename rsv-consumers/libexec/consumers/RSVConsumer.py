@@ -4,8 +4,49 @@ import os
 import re
 import sys
 import time
+import errno
+import fcntl
+import select
 import signal
+import struct
 import subprocess
+from optparse import OptionParser
+
+# inotify is Linux specific and we reach it through libc.  If it is not there
+# (or ctypes is not available) daemon mode falls back to polling.
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+    _libc.inotify_init
+    _libc.inotify_add_watch
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_Q_OVERFLOW  = 0x00004000
+
+# struct inotify_event is followed by a NUL padded name of 'len' bytes
+INOTIFY_EVENT = "iIII"
+INOTIFY_EVENT_SIZE = struct.calcsize(INOTIFY_EVENT)
+
+# In daemon mode, how often to look at the records directory if inotify is not available
+DAEMON_POLL_INTERVAL = 5
+
+# RSV can append records to segment files (spool-format = segments in rsv.conf)
+# instead of writing one file per record.  Records are appended to OPEN_SEGMENT,
+# which is renamed to a closed segment name when it is full or when we claim it.
+OPEN_SEGMENT = ".open.seg"
+SEGMENT_NAME = re.compile(r"^segment-.+\.seg$")
+
+# Records that a consumer could not send are kept here for a later attempt (see
+# hold_records).  The name starts with '.' so it is never read as a new record.
+HELD_RECORDS = ".held-records"
+
+# The characters allowed in the key of a WLCG record header (\w in a regex)
+WORD_CHARACTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_"
 
 class InvalidRecordError(Exception):
     """ Custom exception for a bad record format """
@@ -30,6 +71,8 @@ class RSVConsumer:
 
         # Register variables
         self.__consumer_done = False
+        self.daemon = False
+        self.flush_interval = 30
         self.__records_dir = os.path.join("/", "var", "spool", "rsv", "%s-consumer" % self.name)
         self.__log_file = os.path.join("/", "var", "log", "rsv", "consumers", "%s-consumer.output" % self.name)
 
@@ -77,7 +120,44 @@ class RSVConsumer:
 
 
     def parse_arguments(self):
-        """ Specific to each subclass. """
+        """ Specific to each subclass.  By default only the options common to all
+        consumers are accepted. """
+        parser = OptionParser(usage="usage: %s-consumer [--daemon [--flush-interval SECONDS]]" % self.name)
+        self.parse_consumer_arguments(parser)
+
+
+    def parse_consumer_arguments(self, parser):
+        """ Add the options that every consumer accepts to an OptionParser built by a
+        subclass, then parse the command line.  Returns (options, args). """
+
+        parser.add_option("--daemon", dest="daemon", action="store_true", default=False,
+                          help="Keep running and process records as they arrive.  Default=%default")
+        parser.add_option("--flush-interval", dest="flush_interval", type="int", default=30,
+                          help="In daemon mode, write out results at most once in this many seconds.  " +
+                          "Default=%default", metavar="SECONDS")
+
+        (options, args) = parser.parse_args()
+        self.daemon = options.daemon
+        self.flush_interval = options.flush_interval
+        return (options, args)
+
+
+    def flush(self):
+        """ Write out anything built up from the records processed so far.  This is
+        called at the end of a run, and periodically in daemon mode.  Specific to
+        each subclass. """
+        pass
+
+
+    def next_retry_time(self):
+        """ In daemon mode, the time (seconds since the epoch) at which retry() should
+        be called even if no records arrive, or None.  Specific to each subclass. """
+        return None
+
+
+    def retry(self):
+        """ Called in daemon mode once next_retry_time() has passed, e.g. to resend
+        records that failed earlier.  Specific to each subclass. """
         pass
 
 
@@ -109,9 +189,177 @@ class RSVConsumer:
 
 
     def process_files(self, sort_by_time=False, failed_records_dir=None):
-        """ Open the records directory and load each file """
+        """ Open the records directory and load each file.  In daemon mode keep
+        processing records as they arrive until we are asked to stop, calling
+        flush() at most once every flush_interval seconds and retry() whenever
+        next_retry_time() has passed. """
+
+        if not self.daemon:
+            self.claim_open_segment()
+            self.process_file_list(os.listdir(self.__records_dir), sort_by_time, failed_records_dir)
+            return
+
+        self.log("Running in daemon mode.  Flushing results at most every %s seconds." % self.flush_interval)
+
+        watch = watch_directory(self.__records_dir)
+        if watch is None:
+            self.log("inotify is not available.  Checking for records every %s seconds." %
+                     DAEMON_POLL_INTERVAL)
+
+        # Pick up anything that arrived while we were not running
+        self.claim_open_segment()
+        self.process_file_list(os.listdir(self.__records_dir), sort_by_time, failed_records_dir)
+        dirty = True
+        segment_pending = False
+        last_flush = 0
+
+        try:
+            while not self.__consumer_done:
+                if dirty and time.time() - last_flush >= self.flush_interval:
+                    # Records appended to the open segment are picked up once per flush
+                    if segment_pending:
+                        segment = self.claim_open_segment()
+                        if segment:
+                            self.process_file_list([segment], sort_by_time, failed_records_dir)
+                        segment_pending = False
+                    self.flush()
+                    dirty = False
+                    last_flush = time.time()
+
+                retry_time = self.next_retry_time()
+                if retry_time is not None and time.time() >= retry_time:
+                    self.retry()
+                    retry_time = self.next_retry_time()
+
+                # Sleep until records arrive, or until it is time for a pending flush or retry
+                timeout = DAEMON_POLL_INTERVAL
+                if dirty:
+                    timeout = max(0, last_flush + self.flush_interval - time.time())
+                elif watch is not None:
+                    timeout = None
+                if retry_time is not None:
+                    # Never spin if retry() did not move the retry time on
+                    wait = max(1, retry_time - time.time())
+                    if timeout is None or wait < timeout:
+                        timeout = wait
+
+                if watch is None:
+                    time.sleep(timeout)
+                    files = os.listdir(self.__records_dir)
+                else:
+                    files = watch.read_names(timeout)
+                    if files is None:
+                        # We missed events, so look at the whole directory
+                        files = os.listdir(self.__records_dir)
+
+                if files:
+                    if OPEN_SEGMENT in files:
+                        segment_pending = True
+                    self.process_file_list(files, sort_by_time, failed_records_dir)
+                    dirty = True
+        finally:
+            if watch is not None:
+                watch.close()
+
+        self.log("Leaving daemon mode.")
+        return
+
+
+    def claim_open_segment(self):
+        """ If records have been appended to the open segment, rename it to a closed
+        segment so that we can process it.  The writer holds a lock on the open
+        segment while it appends, so we never claim half of a record.  Return the
+        name of the claimed segment, or None. """
+
+        path = os.path.join(self.__records_dir, OPEN_SEGMENT)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size == 0:
+                return None
+            name = segment_name()
+            try:
+                os.rename(path, os.path.join(self.__records_dir, name))
+            except OSError, err:
+                self.log("ERROR: Failed to claim segment '%s'.  Error: %s" % (path, err))
+                return None
+        finally:
+            os.close(fd)
+
+        return name
+
+
+    def process_file_list(self, files, sort_by_time=False, failed_records_dir=None):
+        """ Process and remove the named files from the records directory.  Files
+        holding a single record are processed first, then segments, unless
+        sort_by_time is set.  Then everything is processed in the order it was
+        written: files by when they were created and segments by when they were
+        closed. """
+
+        # Files starting with '.' are still being written.  In daemon mode a file can
+        # also be named in an event after it was already processed.
+        files = [filename for filename in files if not filename.startswith(".") and
+                 os.path.exists(os.path.join(self.__records_dir, filename))]
+        if not files:
+            return
+
+        segments = [filename for filename in files if is_segment(filename)]
+        if sort_by_time and segments:
+            self.process_in_time_order(files, failed_records_dir)
+            return
+
+        files = [filename for filename in files if not is_segment(filename)]
+
+        if files:
+            self.process_record_files(files, sort_by_time, failed_records_dir)
+
+        # Segment names sort in the order they were closed
+        segments.sort()
+        for segment in segments:
+            if self.__consumer_done:
+                break
+            self.process_segment(segment, failed_records_dir)
+
+        return
+
+
+    def process_in_time_order(self, files, failed_records_dir=None):
+        """ Process files holding a single record and segments together, ordered by
+        their ctime (when a file was created, or when a segment was closed) """
+
+        entries = []
+        for filename in files:
+            try:
+                entries.append((os.stat(os.path.join(self.__records_dir, filename)).st_ctime, filename))
+            except OSError:
+                # Already processed
+                continue
+        entries.sort()
+
+        batch = []
+        for (ctime, filename) in entries:
+            if self.__consumer_done:
+                return
+            if not is_segment(filename):
+                batch.append(filename)
+                continue
+            if batch:
+                self.process_record_files(batch, False, failed_records_dir)
+                batch = []
+            self.process_segment(filename, failed_records_dir)
+
+        if batch and not self.__consumer_done:
+            self.process_record_files(batch, False, failed_records_dir)
+        return
+
+
+    def process_record_files(self, files, sort_by_time=False, failed_records_dir=None):
+        """ Process files that each hold a single record """
 
-        files = os.listdir(self.__records_dir)
         self.log("Processing %s files" % len(files))
 
         if sort_by_time:
@@ -142,17 +390,7 @@ class RSVConsumer:
                 continue
             
 
-            success = False
-            try:
-                self.process_record(record)
-                success = True
-            except InvalidRecordError, err:
-                self.log("ERROR: Invalid record in file '%s'.  Error: %s" % (file_path, err))
-            except GratiaException, err:
-                self.log("ERROR: Failed to send record '%s' via Gratia: %s" % (file_path, err))
-            except Exception, err:
-                self.log("ERROR: An unknown exception occurred when processing file '%s'. Error: " % file_path)
-                self.log(err)
+            success = self.try_process_record(record, file_path)
 
             if failed_records_dir and not success:
                 failed_file = os.path.join(failed_records_dir, filename)
@@ -172,6 +410,118 @@ class RSVConsumer:
                     self.die("ERROR: Failed to remove record '%s'.  Error: %s" % (file_path, err))
 
 
+    def process_segment(self, segment, failed_records_dir=None):
+        """ Process every record in a segment, then remove the whole segment.  Records
+        that fail are written one per file to failed_records_dir. """
+
+        segment_path = os.path.join(self.__records_dir, segment)
+        try:
+            fh = open(segment_path, 'r')
+            records = split_records(fh.read())
+            fh.close()
+        except IOError, err:
+            self.log("ERROR: Failed to read from segment '%s'. Error: %s" % (segment_path, err))
+            return
+
+        self.log("Processing %s records from segment %s" % (len(records), segment))
+
+        for index in range(len(records)):
+            if self.__consumer_done:
+                # Put the records we have not processed back so they are not lost
+                self.rewrite_segment(segment_path, records[index:])
+                return
+
+            source = "%s (record %s)" % (segment_path, index + 1)
+            if not self.try_process_record(records[index], source) and failed_records_dir:
+                failed_file = os.path.join(failed_records_dir, "%s.%s" % (segment, index + 1))
+                try:
+                    fh = open(failed_file, 'w')
+                    fh.write(records[index])
+                    fh.close()
+                except IOError, err:
+                    self.log("ERROR: Failed to write failed record '%s'.  Error: %s" % (failed_file, err))
+
+        try:
+            os.remove(segment_path)
+        except OSError, err:
+            # If we cannot remove the segment then we are going to process it again
+            # So stop processing now to avoid duplicate data.
+            self.die("ERROR: Failed to remove segment '%s'.  Error: %s" % (segment_path, err))
+
+
+    def rewrite_segment(self, segment_path, records):
+        """ Replace a segment with the given records """
+
+        temp_path = os.path.join(self.__records_dir, "." + os.path.basename(segment_path))
+        try:
+            fh = open(temp_path, 'w')
+            fh.write("".join(records))
+            fh.close()
+            os.rename(temp_path, segment_path)
+        except (IOError, OSError), err:
+            # If we cannot rewrite the segment then we are going to process it again
+            # So stop processing now to avoid duplicate data.
+            self.die("ERROR: Failed to rewrite segment '%s'.  Error: %s" % (segment_path, err))
+
+
+    def load_held_records(self):
+        """ Return the records kept back by hold_records, or [] if there are none """
+
+        path = os.path.join(self.__records_dir, HELD_RECORDS)
+        try:
+            fh = open(path, 'r')
+            try:
+                return split_records(fh.read())
+            finally:
+                fh.close()
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                self.log("ERROR: Failed to read held records from '%s'.  Error: %s" % (path, err))
+            return []
+
+
+    def hold_records(self, records):
+        """ Keep records that could not be sent for a later attempt, replacing any
+        that were held before.  They are kept in one file in the records directory
+        whose name starts with '.', so they are not processed as new records. """
+
+        path = os.path.join(self.__records_dir, HELD_RECORDS)
+        if not records:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+
+        temp_path = "%s.%s" % (path, os.getpid())
+        try:
+            fh = open(temp_path, 'w')
+            for record in records:
+                fh.write(record.strip("\r\n") + "\n")
+            fh.close()
+            os.rename(temp_path, path)
+        except (IOError, OSError), err:
+            self.log("ERROR: Failed to hold %s unsent records in '%s'.  Error: %s" % (len(records), path, err))
+        return
+
+
+    def try_process_record(self, record, source):
+        """ Process a single record, logging any problems.  Return True on success. """
+
+        try:
+            self.process_record(record)
+            return True
+        except InvalidRecordError, err:
+            self.log("ERROR: Invalid record in file '%s'.  Error: %s" % (source, err))
+        except GratiaException, err:
+            self.log("ERROR: Failed to send record '%s' via Gratia: %s" % (source, err))
+        except Exception, err:
+            self.log("ERROR: An unknown exception occurred when processing file '%s'. Error: " % source)
+            self.log(err)
+
+        return False
+
+
     def process_record(self):
         """ Specific to each subclass """
         pass
@@ -195,29 +545,7 @@ class RSVConsumer:
         Note: for local probe serviceURI and gatheredAt are replaced by hostName
         """
 
-        record = {}
-
-        # detailsData will always come last, and might be multiple lines
-        # Keep state so that once we are in the detailsData section, we put the rest of the
-        # lines into detailsData and return when we see EOT
-        in_details_data = 0
-        for line in raw_record.split('\n'):
-            if not in_details_data:
-                match = re.match("(\w+):(.*)$", line)
-                if match:
-                    record[match.group(1)] = match.group(2).strip()
-                    if match.group(1) == "detailsData":
-                        in_details_data = 1
-                else:
-                    raise InvalidRecordError("Invalid line:\n\t%s\n\nFull record:\n%s" % (line, raw_record))
-            else:
-                if re.match("EOT$", line):
-                    return record
-                else:
-                    record["detailsData"] += line + "\n"
-
-        # If we reach this point, it means we did not see EOT.  So the record is invalid
-        raise InvalidRecordError("'EOT' marker missing")
+        return parse_wlcg_record(raw_record)
 
 
     def parse_record(self, raw_record):
@@ -279,5 +607,215 @@ class RSVConsumer:
         sys.exit(1)
 
 
+def parse_wlcg_record(raw_record):
+    """ Parse a record in WLCG format into a dict (see RSVConsumer.parse_wlcg_record).
+
+    Every line up to the detailsData line must be a 'key: value' header.  detailsData
+    holds the rest of its own line followed by every line up to a line that is
+    exactly 'EOT'.  Records can carry several MB of detailsData, so rather than
+    looking at each line we find the boundaries with str.find and slice detailsData
+    out in one piece. """
+
+    # detailsData always comes last, so everything before it is headers
+    if raw_record.startswith("detailsData:"):
+        details_start = 0
+    else:
+        details_start = raw_record.find("\ndetailsData:")
+        if details_start != -1:
+            details_start += 1
+
+    if details_start == -1:
+        header_text = raw_record
+    else:
+        header_text = raw_record[:max(0, details_start - 1)]
+
+    record = {}
+    if details_start != 0:
+        for line in header_text.split("\n"):
+            colon = line.find(":")
+            key = line[:colon]
+            if colon < 1 or key.lstrip(WORD_CHARACTERS):
+                raise InvalidRecordError("Invalid line:\n\t%s\n\nFull record:\n%s" % (line, raw_record))
+            record[key] = line[colon + 1:].strip()
+
+    if details_start != -1:
+        first_end = raw_record.find("\n", details_start)
+        if first_end != -1:
+            # Look for a line that is exactly 'EOT'
+            eot = raw_record.find("\nEOT", first_end)
+            while eot != -1:
+                after = eot + 4
+                if after == len(raw_record) or raw_record[after] == "\n":
+                    record["detailsData"] = raw_record[details_start + 12:first_end].strip() + \
+                                            raw_record[first_end + 1:eot + 1]
+                    return record
+                eot = raw_record.find("\nEOT", eot + 1)
+
+    # If we reach this point, it means we did not see EOT.  So the record is invalid
+    raise InvalidRecordError("'EOT' marker missing")
+
+
+def parse_wlcg_record_by_line(raw_record):
+    """ The original line by line parser, kept to check and benchmark
+    parse_wlcg_record against """
+
+    record = {}
+
+    in_details_data = 0
+    for line in raw_record.split('\n'):
+        if not in_details_data:
+            match = re.match("(\w+):(.*)$", line)
+            if match:
+                record[match.group(1)] = match.group(2).strip()
+                if match.group(1) == "detailsData":
+                    in_details_data = 1
+            else:
+                raise InvalidRecordError("Invalid line:\n\t%s\n\nFull record:\n%s" % (line, raw_record))
+        else:
+            if re.match("EOT$", line):
+                return record
+            else:
+                record["detailsData"] += line + "\n"
+
+    raise InvalidRecordError("'EOT' marker missing")
+
+
+def is_segment(filename):
+    return SEGMENT_NAME.match(filename) is not None
+
+
+def segment_name():
+    """ Return a name for a closed segment.  Names sort in the order that the
+    segments were closed. """
+    return "segment-%017.6f-%d.seg" % (time.time(), os.getpid())
+
+
+def split_records(data):
+    """ Split the contents of a segment into records, each ending with an 'EOT' line.
+    Blank lines between records are skipped. """
+
+    records = []
+    start = 0
+    while start < len(data):
+        if data[start] in "\r\n":
+            start += 1
+            continue
+        if data.startswith("EOT\n", start):
+            end = start + 4
+        else:
+            end = data.find("\nEOT\n", start)
+            if end == -1:
+                # A partial record should never happen, but let the parser report it
+                records.append(data[start:])
+                break
+            end += 5
+        records.append(data[start:end])
+        start = end
+
+    return records
+
+
+class DirectoryWatch:
+    """ A minimal inotify watch for files that are completely written to, moved
+    into or hardlinked into a directory.  RSV hardlinks finished records into the
+    spool (Spool.link_into), which only raises IN_CREATE.  Files that are still being
+    written have names starting with '.', which process_file_list skips. """
+
+    def __init__(self, path):
+        self.fd = _libc.inotify_init()
+        if self.fd < 0:
+            raise OSError("inotify_init failed")
+        if _libc.inotify_add_watch(self.fd, path, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(self.fd)
+            raise OSError("inotify_add_watch failed for '%s'" % path)
+
+
+    def read_names(self, timeout):
+        """ Wait up to timeout seconds (None means forever) for files to arrive.
+        Return the list of their names, or None if events were lost. """
+
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error, err:
+            if err[0] == errno.EINTR:
+                return []
+            raise
+
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                return []
+            raise
+
+        names = []
+        offset = 0
+        while offset + INOTIFY_EVENT_SIZE <= len(data):
+            (wd, mask, cookie, length) = struct.unpack(INOTIFY_EVENT, data[offset:offset + INOTIFY_EVENT_SIZE])
+            offset += INOTIFY_EVENT_SIZE
+            if mask & IN_Q_OVERFLOW:
+                return None
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if name and name not in names:
+                names.append(name)
+
+        return names
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watch_directory(path):
+    """ Return a DirectoryWatch on path, or None if that is not possible """
+    if _libc is None:
+        return None
+    try:
+        return DirectoryWatch(path)
+    except OSError:
+        return None
+
+
 def alarm_handler(signum, frame):
     raise TimeoutError("System call timed out")
+
+
+def benchmark(repeat=5):
+    """ Compare parse_wlcg_record against the line by line parser on records with
+    small and large detailsData """
+
+    header = "metricName: org.osg.srm.srmping\nmetricType: status\ntimestamp: 1287068818\n" + \
+             "metricStatus: OK\nserviceType: OSG-SRM\nserviceURI: srm.example.org\n" + \
+             "gatheredAt: rsv.example.org\nsummaryData: OK\n"
+    line = "srmtester: request completed with status SRM_SUCCESS after 3 attempts\n"
+
+    for lines in (10, 1000, 10000):
+        raw_record = header + "detailsData: " + line * lines + "EOT\n"
+        if parse_wlcg_record(raw_record) != parse_wlcg_record_by_line(raw_record):
+            print "Parsers disagree on a record with %s lines of detailsData" % lines
+            return 1
+
+        times = []
+        for parser in (parse_wlcg_record_by_line, parse_wlcg_record):
+            start = time.time()
+            for i in range(repeat):
+                parser(raw_record)
+            times.append((time.time() - start) / repeat)
+
+        print "%6s lines (%8s bytes): line by line %9.3fms  single pass %9.3fms  (%.0fx)" % \
+              (lines, len(raw_record), times[0] * 1000, times[1] * 1000, times[0] / max(times[1], 1e-9))
+
+    return 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--benchmark"]:
+        sys.exit(benchmark())
+    print "Usage: %s --benchmark" % sys.argv[0]
+    sys.exit(1)
@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+
+""" Tests for nagios-consumer, run against a fake send_nsca command and a fake
+Nagios CGI on 127.0.0.1 """
+
+import os
+import imp
+import new
+import sys
+import time
+import base64
+import shutil
+import urllib2
+import tempfile
+import unittest
+import threading
+import SocketServer
+import ConfigParser
+import BaseHTTPServer
+from urlparse import urlsplit
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+CONSUMERS_DIR = os.path.join(TEST_DIR, "..", "libexec", "consumers")
+sys.path.insert(0, CONSUMERS_DIR)
+
+# The consumers are scripts without a .py extension, so don't leave compiled files next to them
+sys.dont_write_bytecode = True
+nagios = imp.load_source("nagios_consumer", os.path.join(CONSUMERS_DIR, "nagios-consumer"))
+
+RECORD = """metricName: %s
+metricType: status
+timestamp: %s
+metricStatus: %s
+serviceType: OSG-CE
+serviceURI: ce.example.org
+gatheredAt: rsv.example.org
+summaryData: %s
+detailsData: %s result
+EOT
+"""
+
+# Saves its input and prints what the test asks for
+FAKE_SEND_NSCA = """#!/bin/sh
+cat > "%s"
+%s
+"""
+
+
+CGI_PATH = "/nagios/cgi-bin/cmd.cgi"
+INFO_MESSAGE = "Your command request was successfully submitted to Nagios for processing."
+INFO_PAGE = "<P><DIV CLASS='infoMessage'>%s<BR><BR>\n" % INFO_MESSAGE
+ERROR_PAGE = "<P><DIV CLASS='errorMessage'>Sorry, but you are not authorized to commit the specified command.</DIV></P>\n"
+
+
+def record(metric, timestamp=1287068818, status="OK"):
+    return RECORD % (metric, timestamp, status, status, status)
+
+
+class Options:
+    def __init__(self, send_nsca=True, max_connections=1):
+        self.send_nsca = send_nsca
+        self.max_connections = max_connections
+
+
+def make_consumer(records_dir, url="nagios.example.org", send_nsca=True, max_connections=1):
+    """ Return a NagiosConsumer for records_dir.  The constructor is skipped because it
+    checks the user and parses sys.argv. """
+
+    consumer = new.instance(nagios.NagiosConsumer)
+    consumer._RSVConsumer__records_dir = records_dir
+    consumer._RSVConsumer__consumer_done = False
+    consumer._NagiosConsumer__options = Options(send_nsca, max_connections)
+    consumer.daemon = False
+    consumer.flush_interval = 30
+    consumer.messages = []
+    consumer.log = consumer.messages.append
+
+    consumer.config = ConfigParser.RawConfigParser()
+    consumer.config.add_section("RSV")
+    consumer.config.set("RSV", "RSV_HOST", "rsv.example.org")
+    consumer.config.set("RSV", "NAGIOS_URL", url)
+    consumer.config.set("RSV", "NAGIOS_USERNAME", "rsv")
+    consumer.config.set("RSV", "NAGIOS_PASSWORD", "secret")
+
+    consumer.initialize_variables()
+    return consumer
+
+
+
+class ConsumerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="rsv-test-")
+        self.records_dir = os.path.join(self.tempdir, "records")
+        os.mkdir(self.records_dir)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def held(self):
+        """ Return the metric names of the held records """
+        consumer = make_consumer(self.records_dir)
+        return [nagios.RSVConsumer.parse_wlcg_record(raw)["metricName"] for raw in consumer.load_held_records()]
+
+
+    def errors(self, consumer):
+        return [message for message in consumer.messages if message.startswith("ERROR")]
+
+
+
+class SendNSCATests(ConsumerTestCase):
+
+    def setUp(self):
+        ConsumerTestCase.setUp(self)
+        self.input = os.path.join(self.tempdir, "input")
+        self.original_send_nsca = nagios.SEND_NSCA
+        nagios.SEND_NSCA = os.path.join(self.tempdir, "send_nsca")
+        self.consumer = make_consumer(self.records_dir)
+
+
+    def tearDown(self):
+        nagios.SEND_NSCA = self.original_send_nsca
+        ConsumerTestCase.tearDown(self)
+
+
+    def fake_send_nsca(self, body):
+        fd = open(nagios.SEND_NSCA, 'w')
+        fd.write(FAKE_SEND_NSCA % (self.input, body))
+        fd.close()
+        os.chmod(nagios.SEND_NSCA, 0755)
+
+
+    def sent(self):
+        """ Return the service names send_nsca was given, and forget them """
+        if not os.path.exists(self.input):
+            return []
+        fd = open(self.input)
+        lines = fd.read().splitlines()
+        fd.close()
+        os.remove(self.input)
+        return [line.split(",")[1] for line in lines]
+
+
+    def test_all_sent(self):
+        self.fake_send_nsca('echo "3 data packet(s) sent to host successfully."')
+        for metric in ("org.osg.a", "org.osg.b", "org.osg.c"):
+            self.consumer.process_record(record(metric))
+        self.consumer.flush()
+
+        self.assertEqual(self.sent(), ["org.osg.a", "org.osg.b", "org.osg.c"])
+        self.assertEqual(self.held(), [])
+        self.assertEqual(self.consumer.next_retry_time(), None)
+        self.assertEqual(self.errors(self.consumer), [])
+
+
+    def test_partial(self):
+        self.fake_send_nsca('echo "1 data packet(s) sent to host successfully."\nexit 2')
+        for metric in ("org.osg.a", "org.osg.b", "org.osg.c"):
+            self.consumer.process_record(record(metric))
+        self.consumer.flush()
+
+        self.assertEqual(self.sent(), ["org.osg.a", "org.osg.b", "org.osg.c"])
+        self.assertEqual(self.held(), ["org.osg.b", "org.osg.c"])
+        self.failUnless(self.consumer.next_retry_time() > time.time())
+        # One line with the output of send_nsca and one summary, not one per record
+        self.assertEqual(len(self.errors(self.consumer)), 2)
+
+
+    def test_command_failure(self):
+        nagios.SEND_NSCA = os.path.join(self.tempdir, "missing")
+        self.consumer.process_record(record("org.osg.a"))
+        self.consumer.flush()
+        self.assertEqual(self.held(), ["org.osg.a"])
+
+
+    def test_command_fails_without_output(self):
+        self.fake_send_nsca('exit 1')
+        self.consumer.process_record(record("org.osg.a"))
+        self.consumer.flush()
+        self.assertEqual(self.held(), ["org.osg.a"])
+
+
+    def test_backoff(self):
+        self.fake_send_nsca('exit 1')
+        self.consumer.process_record(record("org.osg.a"))
+        self.consumer.flush()
+        first = self.consumer.next_retry_time() - time.time()
+        self.sent()
+
+        # New results are held with the others until it is time to try again
+        self.fake_send_nsca('echo "2 data packet(s) sent to host successfully."')
+        self.consumer.process_record(record("org.osg.b"))
+        self.consumer.flush()
+        self.assertEqual(self.sent(), [])
+        self.assertEqual(self.held(), ["org.osg.a", "org.osg.b"])
+
+        self.consumer.next_attempt = time.time() - 1
+        self.consumer.retry()
+        self.assertEqual(self.sent(), ["org.osg.a", "org.osg.b"])
+        self.assertEqual(self.held(), [])
+        self.assertEqual(self.consumer.next_retry_time(), None)
+        self.failUnless(first <= nagios.RETRY_INITIAL_BACKOFF)
+
+
+    def test_backoff_grows(self):
+        self.fake_send_nsca('exit 1')
+        waits = []
+        for attempt in range(3):
+            self.consumer.process_record(record("org.osg.a"))
+            self.consumer.next_attempt = None
+            self.consumer.flush()
+            waits.append(int(round(self.consumer.next_retry_time() - time.time())))
+        self.assertEqual(waits, [60, 120, 240])
+
+
+    def test_latest_only(self):
+        self.fake_send_nsca('echo "1 data packet(s) sent to host successfully."')
+        self.consumer.process_record(record("org.osg.a", 200, "CRITICAL"))
+        self.consumer.process_record(record("org.osg.a", 100, "OK"))
+        self.consumer.flush()
+
+        fd = open(self.input)
+        lines = fd.read().splitlines()
+        fd.close()
+        self.assertEqual(len(lines), 1)
+        self.failUnless(lines[0].startswith("rsv.example.org,org.osg.a,2,"))
+
+
+    def test_held_replaced_by_newer(self):
+        self.fake_send_nsca('exit 1')
+        self.consumer.process_record(record("org.osg.a", 100, "CRITICAL"))
+        self.consumer.flush()
+
+        self.fake_send_nsca('echo "1 data packet(s) sent to host successfully."')
+        consumer = make_consumer(self.records_dir)
+        consumer.process_record(record("org.osg.a", 200, "OK"))
+        consumer.flush()
+
+        fd = open(self.input)
+        lines = fd.read().splitlines()
+        fd.close()
+        self.assertEqual(lines, ["rsv.example.org,org.osg.a,0,OK result"])
+        self.assertEqual(self.held(), [])
+
+
+
+class FakeCGIHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers like the Nagios command CGI.  Results for services in the server's
+    statuses get that HTTP status and those in refused get the CGI's error page. """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        authorization = self.headers.getheader("authorization")
+        self.server.requests.append((self.client_address[1], self.path, authorization))
+        if authorization != self.server.authorization:
+            self.reply(401, "", {"WWW-Authenticate": 'Basic realm="Nagios Access"'})
+            return
+
+        # When we are the proxy the path is the whole URL
+        (path, query) = urlsplit(self.path)[2:4]
+        service = dict([pair.split("=", 1) for pair in query.split("&") if "=" in pair]).get("service")
+        if path != CGI_PATH:
+            self.reply(404, "Not found")
+        elif service in self.server.statuses:
+            self.reply(self.server.statuses[service], "", {"Location": "https://elsewhere.example.org/"})
+        elif service in self.server.refused:
+            self.reply(200, ERROR_PAGE)
+        else:
+            self.reply(200, INFO_PAGE)
+
+
+    def reply(self, status, body, headers={}):
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+class FakeCGIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), FakeCGIHandler)
+        self.authorization = "Basic " + base64.encodestring("rsv:secret")[:-1]
+        self.requests = []
+        self.statuses = {}
+        self.refused = []
+
+
+
+class CGITestCase(ConsumerTestCase):
+
+    def setUp(self):
+        ConsumerTestCase.setUp(self)
+        self.original_environ = os.environ.copy()
+        for name in os.environ.keys():
+            if name.lower().endswith("_proxy"):
+                del os.environ[name]
+        # urllib2 reads the proxy settings once, when it builds its opener
+        urllib2.install_opener(None)
+
+        self.server = FakeCGIServer()
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.setDaemon(True)
+        thread.start()
+        self.url = "http://127.0.0.1:%s%s" % (self.server.server_address[1], CGI_PATH)
+        self.sessions = []
+
+
+    def tearDown(self):
+        for session in self.sessions:
+            for connection in session.connections:
+                connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        os.environ.clear()
+        os.environ.update(self.original_environ)
+        urllib2.install_opener(None)
+        ConsumerTestCase.tearDown(self)
+
+
+    def session(self, max_connections=1, url=None):
+        session = nagios.NagiosSession(url or self.url, "rsv", "secret", max_connections)
+        self.sessions.append(session)
+        return session
+
+
+    def urls(self, services, url=None):
+        consumer = make_consumer(self.records_dir, url or self.url)
+        return [consumer.nagios_url(service, "rsv.example.org", "0", "OK") for service in services]
+
+
+    def authorized(self):
+        """ Return the (client port, path) of each request that was let in """
+        return [(port, path) for (port, path, authorization) in self.server.requests
+                if authorization == self.server.authorization]
+
+
+
+class NagiosSessionTests(CGITestCase):
+
+    def test_negotiate_once(self):
+        session = self.session()
+        (answers, error) = session.send(self.urls(["org.osg.a", "org.osg.b"]))
+        self.assertEqual(error, None)
+        self.assertEqual(answers, [([INFO_MESSAGE], [])] * 2)
+        session.send(self.urls(["org.osg.c"]))
+
+        # Only the first request goes without the Authorization header
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(len(self.authorized()), 3)
+
+
+    def test_connection_reused(self):
+        session = self.session()
+        session.send(self.urls(["org.osg.a", "org.osg.b", "org.osg.c"]))
+        session.send(self.urls(["org.osg.d", "org.osg.e"]))
+        ports = dict([(port, 1) for (port, path) in self.authorized()])
+        self.assertEqual(len(ports), 1)
+
+
+    def test_max_connections(self):
+        session = self.session(max_connections=2)
+        services = ["org.osg.%s" % index for index in range(10)]
+        (answers, error) = session.send(self.urls(services))
+        self.assertEqual(error, None)
+        self.failIf(None in answers)
+        ports = dict([(port, 1) for (port, path) in self.authorized()])
+        self.failUnless(len(ports) <= 2)
+
+
+    def test_not_found(self):
+        url = self.url.replace("cmd.cgi", "missing.cgi")
+        (answers, error) = self.session(url=url).send(self.urls(["org.osg.a", "org.osg.b"], url))
+        self.failUnless("404" in str(error))
+        self.assertEqual(answers, [None, None])
+
+
+    def test_server_error(self):
+        self.server.statuses["org.osg.b"] = 500
+        (answers, error) = self.session().send(self.urls(["org.osg.a", "org.osg.b", "org.osg.c"]))
+        self.failUnless("500" in str(error))
+        self.failIf(answers[0] is None)
+        self.assertEqual(answers[1:], [None, None])
+
+
+    def test_redirect(self):
+        self.server.statuses["org.osg.a"] = 302
+        (answers, error) = self.session().send(self.urls(["org.osg.a"]))
+        self.failUnless("redirects to https://elsewhere.example.org/" in str(error))
+        self.assertEqual(answers, [None])
+
+
+    def test_refused(self):
+        self.server.refused.append("org.osg.b")
+        (answers, error) = self.session().send(self.urls(["org.osg.a", "org.osg.b"]))
+        self.assertEqual(error, None)
+        self.assertEqual(answers[0][1], [])
+        self.assertEqual(len(answers[1][1]), 1)
+        self.failUnless("not authorized" in answers[1][1][0])
+
+
+    def test_proxy(self):
+        os.environ["http_proxy"] = "http://127.0.0.1:%s" % self.server.server_address[1]
+        url = "http://nagios.example.org%s" % CGI_PATH
+        (answers, error) = self.session(url=url).send(self.urls(["org.osg.a"], url))
+        self.assertEqual(error, None)
+        self.failUnless(self.authorized()[0][1].startswith(url))
+
+
+
+class CGIConsumerTests(CGITestCase):
+
+    def consumer(self):
+        consumer = make_consumer(self.records_dir, self.url, send_nsca=False)
+        return consumer
+
+
+    def test_sent_and_held(self):
+        self.server.statuses["org.osg.b"] = 500
+        consumer = self.consumer()
+        for metric in ("org.osg.a", "org.osg.b", "org.osg.c"):
+            consumer.process_record(record(metric))
+        consumer.flush()
+
+        self.assertEqual(self.held(), ["org.osg.b", "org.osg.c"])
+        self.failUnless(consumer.send_failed)
+        self.failIf(consumer.next_retry_time() is None)
+
+        del self.server.statuses["org.osg.b"]
+        consumer.next_attempt = time.time() - 1
+        consumer.retry()
+        self.assertEqual(self.held(), [])
+        # a, then b which failed, then b and c again
+        sent = [path for (port, path) in self.authorized()]
+        self.assertEqual(len(sent), 4)
+
+
+    def test_refused_not_held(self):
+        self.server.refused.append("org.osg.b")
+        consumer = self.consumer()
+        for metric in ("org.osg.a", "org.osg.b"):
+            consumer.process_record(record(metric))
+        consumer.flush()
+
+        self.assertEqual(self.held(), [])
+        self.failUnless(consumer.send_failed)
+        self.failUnless([error for error in self.errors(consumer) if "org.osg.b" in error])
+
+
+    def test_one_result_per_service(self):
+        consumer = self.consumer()
+        consumer.process_record(record("org.osg.a", 100, "CRITICAL"))
+        consumer.process_record(record("org.osg.a", 200, "OK"))
+        consumer.process_record(record("org.osg.a", 150, "WARNING"))
+        consumer.flush()
+
+        sent = [path for (port, path) in self.authorized()]
+        self.assertEqual(len(sent), 1)
+        self.failUnless("plugin_state=0" in sent[0])
+
+
+
+class RecordTimeTests(unittest.TestCase):
+
+    def test_epoch(self):
+        self.assertEqual(nagios.record_time("1280035094"), 1280035094)
+
+    def test_utc(self):
+        self.assertEqual(nagios.record_time("2010-07-25T05:18:14Z"), 1280035094)
+
+    def test_local(self):
+        self.assertEqual(nagios.record_time("2010-07-25 00:18:14 CDT"),
+                         time.mktime((2010, 7, 25, 0, 18, 14, 0, 0, -1)))
+
+    def test_garbage(self):
+        self.assertEqual(nagios.record_time("yesterday"), None)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
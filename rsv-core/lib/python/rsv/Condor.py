@@ -7,13 +7,29 @@ import time
 import commands
 from time import strftime
 
-import Host
+import CondorBackend
+
+# The job attributes that RSV reads.  Queries only fetch these attributes when the
+# backend supports it.
+CLASSAD_ATTRIBUTES = ["ClusterId", "ProcId", "Owner", "JobStatus", "EnteredCurrentStatus",
+                      "DeferralTime", "OSGRSV", "OSGRSVHost", "OSGRSVMetric",
+                      "OSGRSVUniqueName", "OSGRSVProbeInterval"]
 
 class Condor:
     """ Define the interface to condor-cron """
 
     def __init__(self, rsv):
         self.rsv = rsv
+        self.snapshot = None
+        self.backend = None
+
+
+    def get_backend(self):
+        """ Return the CondorBackend used to talk to Condor-Cron """
+        if self.backend is None:
+            self.backend = CondorBackend.get_backend(self)
+            self.rsv.log("DEBUG", "Using the '%s' Condor-Cron backend" % self.backend.name)
+        return self.backend
 
 
     def is_condor_running(self):
@@ -21,16 +37,32 @@ class Condor:
         Determine if Condor-Cron is running.  Return True is so, false otherwise
         """
 
-        (ret, out) = self.commands_getstatusoutput("condor_cron_q")
+        # Taking a snapshot of the queue tells us whether Condor-Cron is up, and
+        # we will most likely need the snapshot next anyway
+        return self.get_snapshot(allow_stale=True) is not None
 
-        if not ret:
-            self.rsv.log("DEBUG", "Condor is running.  Output of condor_cron_q:\n%s" % out)
-            return True
 
-        self.rsv.log("INFO", "Condor-Cron does not seem to be running.  " +
-                     "Output of condor_cron_q:\n%s" % out)
+    def get_snapshot(self, allow_stale=False):
+        """
+        Return a ClassadSnapshot of every job in Condor-Cron, taking one with a single
+        condor_cron_q -l if we do not have it yet.  If allow_stale is False and jobs were
+        submitted or removed since the snapshot was taken it is refreshed first.
+        Return None if Condor-Cron is not running.
+        """
 
-        return False
+        if self.snapshot is not None and (allow_stale or not self.snapshot.stale):
+            return self.snapshot
+
+        classads = self.get_backend().query(projection=CLASSAD_ATTRIBUTES)
+
+        if classads is None:
+            self.snapshot = None
+            self.rsv.log("INFO", "Condor-Cron does not seem to be running.")
+            return None
+
+        self.snapshot = ClassadSnapshot(classads)
+        self.rsv.log("DEBUG", "Condor is running.  Found %s jobs in condor_cron_q" % len(self.snapshot.classads))
+        return self.snapshot
 
 
     def is_job_running(self, condor_id):
@@ -39,16 +71,17 @@ class Condor:
         Return false if it is not
         """
 
-        classads = self.get_classads("OSGRSVUniqueName==\"%s\"" % condor_id)
+        # Jobs we submitted or removed are reflected in the snapshot, so it does not
+        # have to be refreshed to answer this
+        snapshot = self.get_snapshot(allow_stale=True)
 
-        if classads is None:
+        if snapshot is None:
             self.rsv.log("ERROR", "Could not determine if job is running")
             return False
 
-        for classad in classads:
-            # We put the attribute into the classad in quotes, so search for it accordingly
-            if classad["OSGRSVUniqueName"] == '"' + condor_id + '"':
-                return True
+        # We put the attribute into the classad in quotes, so search for it accordingly
+        if snapshot.lookup("OSGRSVUniqueName", '"' + condor_id + '"'):
+            return True
 
         return False
 
@@ -63,23 +96,20 @@ class Condor:
         else:
             self.rsv.log("DEBUG", "Getting Condor classads with no constraint")
 
-        if not self.is_condor_running():
+        snapshot = self.get_snapshot()
+        if snapshot is None:
             self.rsv.log("ERROR", "Cannot fetch classads because Condor-Cron is not running")
             return None
 
-        # Build the command
-        cmd = "condor_cron_q -l"
-        if  constraint is not None:
-            cmd += " -constraint '%s'" % constraint
-
-        (ret, out) = self.commands_getstatusoutput(cmd)
+        # Simple constraints are answered from the snapshot
+        classads = snapshot.select(constraint)
+        if classads is not None:
+            return classads
 
-        # Run the command and parse the classad
-        if ret != 0:
-            self.rsv.log("ERROR", "Command returned error code '%i': '%s'" % (ret, cmd))
-            return None
-        else:
-            return parse_classads(out)
+        classads = self.get_backend().query(constraint, CLASSAD_ATTRIBUTES)
+        if classads is None:
+            self.rsv.log("ERROR", "Could not fetch classads with constraint '%s'" % constraint)
+        return classads
 
 
     def number_of_running_metrics(self):
@@ -154,6 +184,21 @@ class Condor:
         """
         Input: submit file contents and job identifier
         Create submission file, submits it to Condor and removes it
+        Return the cluster ID of the job, or False on error
+        """
+
+        job_ids = self.submit_jobs(submit_file_contents, condor_id, dir, remove)
+        if not job_ids:
+            return False
+
+        return job_ids[0][0]
+
+
+    def submit_jobs(self, submit_file_contents, condor_id, dir="/tmp", remove=1):
+        """
+        Like submit_job, but the submit file may contain several Queue statements.
+        Return a list of (cluster, proc) IDs in the order the jobs were queued,
+        or False on error
         """
 
         sub_file_name = os.path.join(dir, condor_id + ".sub")
@@ -173,28 +218,19 @@ class Condor:
         os.chdir(os.path.join("/", "tmp"))
 
         # Submit the job and remove the file
-        cmd = "condor_cron_submit %s" % sub_file_name
-        raw_ec, out = self.commands_getstatusoutput(cmd, self.rsv.get_user())
-        exit_code = os.WEXITSTATUS(raw_ec)
-        self.rsv.log("INFO", "Condor submission: %s" % out)
-        self.rsv.log("DEBUG", "Condor submission completed: %s (%s)" % (exit_code, raw_ec))
+        job_ids = self.get_backend().submit(submit_file_contents, sub_file_name, self.rsv.get_user())
 
         if remove:
             os.remove(sub_file_name)
 
-        if exit_code != 0:
-            self.rsv.log("ERROR", "Problem submitting job to condor.  Command output:\n%s" % out)
+        if not job_ids:
             return False
 
-        # Determine the job cluster ID
-        match = re.search("submitted to cluster (\d+)\.", out)
-        if match:
-            job_id = match.group(1)
-            self.rsv.log("DEBUG", "Condor job cluster ID: %s" % job_id)
-            return job_id
-        else:
-            self.rsv.log("ERROR", "Could not determine job cluster ID from output:\n%s" % out)
-            return False
+        if self.snapshot is not None:
+            self.snapshot.add(classad_from_submit_file(submit_file_contents))
+
+        self.rsv.log("DEBUG", "Condor job IDs: %s" % " ".join(["%s.%s" % job_id for job_id in job_ids]))
+        return job_ids
 
 
     def stop_jobs(self, constraint):
@@ -205,12 +241,15 @@ class Condor:
 
         self.rsv.log("INFO", "Stopping all metrics with constraint '%s'" % constraint)
 
-        if not self.is_condor_running():
+        snapshot = self.get_snapshot(allow_stale=True)
+        if snapshot is None:
             self.rsv.log("ERROR", "Cannot stop jobs because Condor-Cron is not running")
             return False
 
         # Check if any jobs are running to be removed
-        jobs = self.get_classads(constraint)
+        jobs = snapshot.select(constraint)
+        if jobs is None:
+            jobs = self.get_classads(constraint)
         if jobs is None:
             self.rsv.log("ERROR", "Problem stopping RSV jobs.  Condor may not be running")
             return False
@@ -218,18 +257,13 @@ class Condor:
             self.rsv.log("INFO", "No jobs to be removed with constraint '%s'" % constraint)
             return True
 
-        # Build the command
-        cmd = "condor_cron_rm"
-        if constraint is not None:
-            cmd += " -constraint '%s'" % constraint
-
-        (ret, out) = self.commands_getstatusoutput(cmd)
-
-        if ret != 0:
-            self.rsv.log("ERROR", "Command returned error code '%i': '%s'.  Output:\n%s" %
-                         (ret, cmd, out))
+        if not self.get_backend().remove(constraint):
+            self.snapshot = None
             return False
 
+        if self.snapshot is not None and not self.snapshot.remove(constraint):
+            self.snapshot = None
+
         return True
         
 
@@ -304,10 +338,16 @@ class Condor:
         submit += "# Temporary submit file generated by rsv-control\n"
         submit += "# Generated at %s\n" % timestamp
         submit += "######################################################################\n"
-        submit += "Arguments = %s\n" % arguments
-        submit += "DeferralPrepTime = 180\n"
-        submit += "DeferralTime = (CurrentTime + 300 + random(30))\n"
-        submit += "DeferralWindow = 99999999\n"
+        if consumer.is_daemon():
+            # The consumer keeps running and processes records as they arrive, so
+            # start it right away instead of deferring it
+            arguments = (arguments + " --daemon").strip()
+            submit += "Arguments = %s\n" % arguments
+        else:
+            submit += "Arguments = %s\n" % arguments
+            submit += "DeferralPrepTime = 180\n"
+            submit += "DeferralTime = (CurrentTime + 300 + random(30))\n"
+            submit += "DeferralWindow = 99999999\n"
         submit += "Environment = %s\n"    % environment
         submit += "Executable = %s\n"     % consumer.executable
         submit += "Error = %s/%s.err\n"   % (log_dir, condor_id)
@@ -431,7 +471,7 @@ class Condor:
 
                 # Determine if any metrics are enabled on this host, but not running
                 missing_metrics = []
-                enabled_metrics = Host.Host(host, self.rsv).get_enabled_metrics()
+                enabled_metrics = self.rsv.get_host(host).get_enabled_metrics()
                 for metric in enabled_metrics:
                     if metric not in running_metrics[host]:
                         missing_metrics.append(metric)
@@ -476,23 +516,161 @@ class Condor:
 
         return True
 
-def parse_classads(output):
+def parse_classads(output, attributes=None):
     """
     Parse a set of condor classads in "attribute = value" format.
     A blank line will be between each classad.
+    output can be a string or any iterable of lines (e.g. a pipe), which is read one
+    line at a time.  If attributes is given only those attributes are kept.
     Return an array of hashes
     """
+    if isinstance(output, str):
+        output = output.split("\n")
+
+    wanted = None
+    if attributes is not None:
+        wanted = dict([(attribute, 1) for attribute in attributes])
+
     classads = []
     tmp = {}
-    for line in output.split("\n"):
+    for line in output:
+        line = line.rstrip("\r\n")
+
         # A blank line signifies that this classad is finished
         if line == "":
             if len(tmp) > 0:
                 classads.append(tmp)
                 tmp = {}
+            continue
 
-        pair = line.split(" = ", 2)
-        if len(pair) == 2:
+        pair = line.split(" = ", 1)
+        if len(pair) == 2 and (wanted is None or pair[0] in wanted):
             tmp[pair[0]] = pair[1]
 
+    if len(tmp) > 0:
+        classads.append(tmp)
+
     return classads
+
+
+def parse_projected_classads(output, attributes):
+    """
+    Parse the output of condor_cron_q -af:rt attributes, which has one line per job
+    with the raw value of each attribute separated by tabs.  Attributes that are not
+    defined for a job are left out of its classad.
+    output can be a string or any iterable of lines.
+    Return an array of hashes
+    """
+    if isinstance(output, str):
+        output = output.split("\n")
+
+    classads = []
+    for line in output:
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+
+        values = line.split("\t")
+        if len(values) != len(attributes):
+            continue
+
+        classad = {}
+        for index in range(len(attributes)):
+            if values[index] != "undefined":
+                classad[attributes[index]] = values[index]
+        classads.append(classad)
+
+    return classads
+
+
+# A constraint that ClassadSnapshot can answer without running condor_cron_q, e.g.
+#   OSGRSVUniqueName=="foo__bar"
+SIMPLE_CONSTRAINT = re.compile(r'^\s*(\w+)\s*==\s*("[^"]*")\s*$')
+
+class ClassadSnapshot:
+    """
+    The classads of every job in Condor-Cron at one point in time, indexed by the
+    attributes that RSV puts into its jobs.  Jobs that we submit or remove afterwards
+    are applied to the snapshot and mark it as stale, since attributes that Condor
+    sets (e.g. JobStatus) are not known for the submitted jobs.
+    """
+
+    INDEXED_ATTRIBUTES = ("OSGRSV", "OSGRSVUniqueName", "OSGRSVHost", "OSGRSVMetric")
+
+    def __init__(self, classads):
+        self.classads = []
+        self.index = {}
+        for attribute in self.INDEXED_ATTRIBUTES:
+            self.index[attribute] = {}
+
+        for classad in classads:
+            self.add(classad)
+        self.stale = False
+
+
+    def add(self, classad):
+        self.classads.append(classad)
+        for attribute in self.INDEXED_ATTRIBUTES:
+            if attribute in classad:
+                self.index[attribute].setdefault(classad[attribute], []).append(classad)
+        self.stale = True
+
+
+    def lookup(self, attribute, value):
+        """ Return the classads whose attribute has exactly value (including quotes) """
+        if attribute in self.index:
+            return self.index[attribute].get(value, [])
+        return [classad for classad in self.classads if classad.get(attribute) == value]
+
+
+    def select(self, constraint):
+        """
+        Return the classads matching constraint, or None if the constraint is not
+        simple enough to be answered from the snapshot
+        """
+        if constraint is None:
+            return list(self.classads)
+
+        match = SIMPLE_CONSTRAINT.match(constraint)
+        if not match:
+            return None
+
+        return list(self.lookup(match.group(1), match.group(2)))
+
+
+    def remove(self, constraint):
+        """
+        Remove the classads matching constraint.  Return False if the constraint is not
+        simple enough to be applied to the snapshot.
+        """
+        classads = self.select(constraint)
+        if classads is None:
+            return False
+
+        removed = {}
+        for classad in classads:
+            removed[id(classad)] = 1
+
+        remaining = [classad for classad in self.classads if id(classad) not in removed]
+        self.classads = []
+        for attribute in self.INDEXED_ATTRIBUTES:
+            self.index[attribute] = {}
+        for classad in remaining:
+            self.add(classad)
+        self.stale = True
+        return True
+
+
+def classad_from_submit_file(submit_file_contents):
+    """
+    Return the custom attributes (e.g. +OSGRSVUniqueName = "foo") of a submit
+    file as a classad
+    """
+    classad = {}
+    for line in submit_file_contents.split("\n"):
+        if line.startswith("+"):
+            pair = line[1:].split(" = ", 1)
+            if len(pair) == 2:
+                classad[pair[0].strip()] = pair[1].strip()
+
+    return classad
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+""" Ways of talking to the Condor-Cron schedd.  The Condor class uses one of these
+to query, submit and remove jobs. """
+
+import os
+import re
+import pwd
+import tempfile
+import subprocess
+
+import Condor
+
+# The htcondor bindings are imported when they are first needed (see get_bindings)
+htcondor = None
+
+# Condor-Cron runs its own schedd, which is configured by this file
+CONDOR_CRON_CONFIG = "/etc/condor-cron/condor_config"
+
+# A Queue statement in a submit description, optionally with a count
+QUEUE_STATEMENT = re.compile(r"^\s*queue(\s+(\d+))?\s*$", re.IGNORECASE)
+
+
+class CLIBackend:
+    """ Run the condor_cron_* command line tools """
+
+    name = "cli"
+
+    def __init__(self, condor):
+        self.condor = condor
+        self.rsv = condor.rsv
+
+
+    def query(self, constraint=None, projection=None):
+        """ Return a list of classads (dicts of attribute -> value as it appears in
+        condor_cron_q -l) of the jobs matching constraint, or None on error.  If
+        projection is given only those attributes are fetched. """
+
+        if projection:
+            cmd = "condor_cron_q -af:rt %s" % " ".join(projection)
+        else:
+            cmd = "condor_cron_q -l"
+        if constraint is not None:
+            cmd += " -constraint '%s'" % constraint
+
+        self.rsv.log("DEBUG", "Running query: %s" % cmd)
+
+        # Parse the output as it arrives rather than holding all of it in memory
+        errors = tempfile.TemporaryFile()
+        try:
+            try:
+                process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=errors,
+                                           close_fds=True)
+            except OSError, err:
+                self.rsv.log("INFO", "Could not run '%s': %s" % (cmd, err))
+                return None
+
+            if projection:
+                classads = Condor.parse_projected_classads(process.stdout, projection)
+            else:
+                classads = Condor.parse_classads(process.stdout)
+            ret = process.wait()
+
+            if ret != 0:
+                errors.seek(0)
+                self.rsv.log("INFO", "Command returned error code '%i': '%s'.  Output:\n%s" %
+                             (ret, cmd, errors.read()))
+                return None
+        finally:
+            errors.close()
+
+        return classads
+
+
+    def submit(self, submit_file_contents, sub_file_name, user):
+        """ Submit the jobs in a submit description, which has been written to
+        sub_file_name.  Return a list of (cluster, proc) of the submitted jobs in the
+        order they were queued, or None on error. """
+
+        cmd = "condor_cron_submit %s" % sub_file_name
+        raw_ec, out = self.condor.commands_getstatusoutput(cmd, user)
+        exit_code = os.WEXITSTATUS(raw_ec)
+        self.rsv.log("INFO", "Condor submission: %s" % out)
+        self.rsv.log("DEBUG", "Condor submission completed: %s (%s)" % (exit_code, raw_ec))
+
+        if exit_code != 0:
+            self.rsv.log("ERROR", "Problem submitting job to condor.  Command output:\n%s" % out)
+            return None
+
+        # Determine the job cluster ID.  The jobs are numbered from 0 in the order
+        # that they were queued.
+        match = re.search("(\d+) job\(s\) submitted to cluster (\d+)\.", out)
+        if match:
+            return [(match.group(2), str(proc)) for proc in range(int(match.group(1)))]
+
+        match = re.search("submitted to cluster (\d+)\.", out)
+        if match:
+            return [(match.group(1), "0")]
+
+        self.rsv.log("ERROR", "Could not determine job cluster ID from output:\n%s" % out)
+        return None
+
+
+    def remove(self, constraint):
+        """ Remove the jobs matching constraint.  Return True on success. """
+
+        cmd = "condor_cron_rm"
+        if constraint is not None:
+            cmd += " -constraint '%s'" % constraint
+
+        (ret, out) = self.condor.commands_getstatusoutput(cmd)
+
+        if ret != 0:
+            self.rsv.log("ERROR", "Command returned error code '%i': '%s'.  Output:\n%s" %
+                         (ret, cmd, out))
+            return False
+
+        return True
+
+
+
+class BindingsBackend:
+    """ Talk to the Condor-Cron schedd directly using the htcondor Python bindings """
+
+    name = "python"
+
+    def __init__(self, condor, bindings, schedd=None):
+        self.condor = condor
+        self.rsv = condor.rsv
+        self.htcondor = bindings
+        self.schedd = schedd
+        self.cli = CLIBackend(condor)
+
+
+    def get_schedd(self):
+        if self.schedd is None:
+            self.schedd = self.htcondor.Schedd()
+        return self.schedd
+
+
+    def query(self, constraint=None, projection=None):
+        """ Return a list of classads (dicts of attribute -> value as it appears in
+        condor_cron_q -l) of the jobs matching constraint, or None on error.  Only
+        the attributes in projection are fetched if it is given. """
+
+        if constraint is None:
+            constraint = "true"
+
+        try:
+            ads = self.get_schedd().query(constraint, list(projection or []))
+        except (IOError, RuntimeError), err:
+            self.rsv.log("INFO", "Could not query the Condor-Cron schedd: %s" % err)
+            return None
+
+        classads = []
+        for ad in ads:
+            classad = {}
+            for attribute in ad.keys():
+                # The string form of the expression matches the condor_cron_q -l output,
+                # e.g. string values are quoted
+                classad[attribute] = str(ad.lookup(attribute))
+            classads.append(classad)
+
+        return classads
+
+
+    def submit(self, submit_file_contents, sub_file_name, user):
+        """ Submit the jobs in a submit description (also written to sub_file_name)
+        in a single transaction.  Return
+        a list of (cluster, proc) of the submitted jobs in the order they were queued,
+        or None on error. """
+
+        # The schedd will own the jobs as whoever we are, so if we need to switch
+        # users (i.e. we are root) we have to go through condor_cron_submit
+        if user and os.getuid() != pwd.getpwnam(user).pw_uid:
+            return self.cli.submit(submit_file_contents, sub_file_name, user)
+
+        descriptions = split_submit_file(submit_file_contents)
+        if descriptions is None:
+            self.rsv.log("DEBUG", "Submit description is not supported by the htcondor bindings, " +
+                         "using condor_cron_submit")
+            return self.cli.submit(submit_file_contents, sub_file_name, user)
+
+        # All of the clusters are queued in one transaction, which is committed only
+        # if every one of them was queued successfully
+        job_ids = []
+        try:
+            transaction = self.get_schedd().transaction()
+            transaction.__enter__()
+            committed = False
+            try:
+                for (description, count) in descriptions:
+                    submit = self.htcondor.Submit(description)
+                    cluster = submit.queue(transaction, count)
+                    for proc in range(count):
+                        job_ids.append((str(cluster), str(proc)))
+                committed = True
+            finally:
+                if committed:
+                    transaction.__exit__(None, None, None)
+                else:
+                    # Passing an exception aborts the transaction
+                    transaction.__exit__(RuntimeError, RuntimeError("submission failed"), None)
+        except (IOError, RuntimeError, ValueError), err:
+            self.rsv.log("ERROR", "Problem submitting job to condor: %s" % err)
+            return None
+
+        self.rsv.log("INFO", "Condor submission: %s job(s) submitted to cluster(s) %s" %
+                     (len(job_ids), ", ".join(unique([cluster for (cluster, proc) in job_ids]))))
+        return job_ids
+
+
+    def remove(self, constraint):
+        """ Remove the jobs matching constraint.  Return True on success. """
+
+        if constraint is None:
+            constraint = "true"
+
+        try:
+            self.get_schedd().act(self.htcondor.JobAction.Remove, constraint)
+        except (IOError, RuntimeError), err:
+            self.rsv.log("ERROR", "Could not remove jobs with constraint '%s': %s" % (constraint, err))
+            return False
+
+        return True
+
+
+
+def get_backend(condor):
+    """ Return the backend selected by condor-backend in rsv.conf.  'auto' uses the
+    htcondor bindings if they can be imported and the command line tools otherwise. """
+
+    choice = condor.rsv.get_condor_backend()
+
+    if choice in ("auto", "python"):
+        bindings = get_bindings(condor.rsv)
+        if bindings is not None:
+            return BindingsBackend(condor, bindings)
+        if choice == "python":
+            condor.rsv.log("WARNING", "condor-backend is 'python' but the htcondor bindings " +
+                           "could not be imported.  Using the command line tools.")
+
+    return CLIBackend(condor)
+
+
+def get_bindings(rsv):
+    """ Import the htcondor bindings configured for Condor-Cron, or return None if
+    they are not available """
+
+    global htcondor
+    if htcondor is not None:
+        return htcondor
+
+    # The bindings read the Condor configuration when they are imported, so point
+    # them at the Condor-Cron configuration first
+    original_config = os.environ.get("CONDOR_CONFIG")
+    os.environ["CONDOR_CONFIG"] = CONDOR_CRON_CONFIG
+    try:
+        try:
+            import htcondor as bindings
+            bindings.reload_config()
+        except (ImportError, RuntimeError), err:
+            rsv.log("DEBUG", "htcondor bindings are not available: %s" % err)
+            return None
+    finally:
+        if original_config is None:
+            del os.environ["CONDOR_CONFIG"]
+        else:
+            os.environ["CONDOR_CONFIG"] = original_config
+
+    htcondor = bindings
+    return htcondor
+
+
+def split_submit_file(submit_file_contents):
+    """ Split a submit description into (description, count) pairs, one for each Queue
+    statement.  Commands carry over from one Queue statement to the next in a submit
+    file, so each description contains every command before its Queue statement.
+    Return None if the description uses a Queue statement we cannot handle. """
+
+    descriptions = []
+    commands = []
+    for line in submit_file_contents.split("\n"):
+        if line.strip().lower().startswith("queue"):
+            match = QUEUE_STATEMENT.match(line)
+            if not match:
+                return None
+            count = 1
+            if match.group(2):
+                count = int(match.group(2))
+            descriptions.append(("\n".join(commands) + "\n", count))
+        else:
+            commands.append(line)
+
+    return descriptions
+
+
+def unique(items):
+    seen = {}
+    result = []
+    for item in items:
+        if item not in seen:
+            seen[item] = 1
+            result.append(item)
+    return result
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+""" Read Condor user log events for many jobs that share a single log """
+
+import re
+import time
+
+import Sysutils
+
+# Condor user log event codes that we care about
+SUBMIT               = 0
+EXECUTE              = 1
+EXECUTABLE_ERROR     = 2
+SHADOW_EXCEPTION     = 7
+TERMINATED           = 5
+ABORTED              = 9
+HELD                 = 12
+GLOBUS_SUBMIT_FAILED = 18
+GLOBUS_RESOURCE_DOWN = 20
+REMOTE_ERROR         = 21
+
+EVENT_NAMES = {
+    SUBMIT               : "submit",
+    EXECUTE              : "execute",
+    EXECUTABLE_ERROR     : "executable error",
+    SHADOW_EXCEPTION     : "shadow exception",
+    TERMINATED           : "terminated",
+    ABORTED              : "aborted",
+    HELD                 : "held",
+    GLOBUS_SUBMIT_FAILED : "Globus submit failed",
+    GLOBUS_RESOURCE_DOWN : "Globus resource down",
+    REMOTE_ERROR         : "remote error",
+    }
+
+# The result codes returned by CondorG.wait()
+JOB_SUCCEEDED        = 0
+JOB_ABORTED          = 1
+JOB_FAILED           = 2
+JOB_SUBMIT_FAILED    = 3
+JOB_RESOURCE_DOWN    = 4
+JOB_TIMED_OUT        = 5
+JOB_HELD             = 6
+
+# Events that end a job, and what they mean for the metric
+TERMINAL_EVENTS = {
+    EXECUTABLE_ERROR     : JOB_FAILED,
+    SHADOW_EXCEPTION     : JOB_FAILED,
+    ABORTED              : JOB_ABORTED,
+    HELD                 : JOB_HELD,
+    GLOBUS_SUBMIT_FAILED : JOB_SUBMIT_FAILED,
+    GLOBUS_RESOURCE_DOWN : JOB_RESOURCE_DOWN,
+    REMOTE_ERROR         : JOB_FAILED,
+    }
+
+# Each event starts with a line like:
+#   005 (1234.000.000) 10/18 12:00:00 Job terminated.
+# and ends with a line containing only '...'
+EVENT_HEADER = re.compile(r"^(\d{3}) \((\d+)\.(\d+)\.\d+\) ")
+EVENT_END = "..."
+
+
+class Event:
+    """ A single event from a Condor user log """
+
+    def __init__(self, code, cluster, proc, text):
+        self.code = code
+        self.cluster = cluster
+        self.proc = proc
+        self.text = text
+
+
+    def get_name(self):
+        return EVENT_NAMES.get(self.code, "event %03d" % self.code)
+
+
+    def get_result(self):
+        """ Return the result code if this event ends the job, otherwise None """
+        if self.code == TERMINATED:
+            if self.text.find("return value") > -1:
+                return JOB_SUCCEEDED
+            return JOB_FAILED
+        return TERMINAL_EVENTS.get(self.code)
+
+
+
+class EventParser:
+    """ Turn lines of a user log into Events.  Lines can be fed in as they arrive;
+    an event is only returned once its closing '...' line has been seen. """
+
+    def __init__(self):
+        self.lines = []
+
+
+    def feed(self, text):
+        """ Return the list of Events completed by text """
+
+        events = []
+        for line in text.splitlines(True):
+            if line.rstrip("\r\n") == EVENT_END:
+                event = self.make_event(self.lines)
+                if event:
+                    events.append(event)
+                self.lines = []
+            else:
+                self.lines.append(line)
+
+        return events
+
+
+    def make_event(self, lines):
+        if not lines:
+            return None
+        match = EVENT_HEADER.match(lines[0])
+        if not match:
+            return None
+        return Event(int(match.group(1)), int(match.group(2)), int(match.group(3)),
+                     "".join(lines) + EVENT_END + "\n")
+
+
+
+class WaitingJob:
+    """ A job registered with the JobEventReader """
+
+    def __init__(self, cluster, proc, job, timeout):
+        self.cluster = cluster
+        self.proc = proc
+        self.job = job
+        self.deadline = time.time() + timeout
+        self.events = []
+        self.result = None
+
+
+    def get_log_contents(self):
+        return "".join([event.text for event in self.events])
+
+
+
+class JobEventReader:
+    """ Follow a single Condor user log shared by many jobs and hand out each job's
+    result as soon as its terminal event is written.  Jobs are matched to events
+    by their cluster and proc IDs. """
+
+    def __init__(self, rsv, log_path):
+        self.rsv = rsv
+        self.log_path = log_path
+        self.follower = Sysutils.LogFollower(log_path)
+        self.parser = EventParser()
+        self.notifier = None
+        self.jobs = {}
+        self.finished = []
+
+
+    def add_job(self, cluster, proc, job, timeout):
+        """ Wait for the job with the given cluster/proc.  job can be any object; it
+        is handed back by wait(). """
+
+        waiting = WaitingJob(int(cluster), int(proc), job, int(timeout))
+        self.jobs[(waiting.cluster, waiting.proc)] = waiting
+        return waiting
+
+
+    def pending(self):
+        """ Return the number of jobs that have not finished yet """
+        return len(self.jobs)
+
+
+    def read_events(self):
+        """ Read any new events from the log and dispatch them to their jobs """
+
+        for event in self.parser.feed(self.follower.read()):
+            key = (event.cluster, event.proc)
+            if key not in self.jobs:
+                continue
+
+            waiting = self.jobs[key]
+            waiting.events.append(event)
+            self.rsv.log("DEBUG", "Job %s.%s: %s event" % (event.cluster, event.proc, event.get_name()))
+
+            result = event.get_result()
+            if result is not None:
+                waiting.result = result
+                del self.jobs[key]
+                self.finished.append(waiting)
+
+        return
+
+
+    def expire_jobs(self):
+        """ Give up on jobs that are past their deadline """
+
+        now = time.time()
+        for key in self.jobs.keys():
+            waiting = self.jobs[key]
+            if now >= waiting.deadline:
+                waiting.result = JOB_TIMED_OUT
+                del self.jobs[key]
+                self.finished.append(waiting)
+        return
+
+
+    def wait(self, sleep_interval=10):
+        """ Generator that yields each WaitingJob as soon as it finishes (in the order
+        they finish) until no jobs are left. """
+
+        backoff = Sysutils.MIN_POLL_INTERVAL
+        while self.jobs or self.finished:
+            self.read_events()
+            self.expire_jobs()
+
+            if self.finished:
+                backoff = Sysutils.MIN_POLL_INTERVAL
+                while self.finished:
+                    yield self.finished.pop(0)
+                continue
+
+            # Sleep until the log changes or the next job's deadline is reached
+            timeout = sleep_interval
+            for waiting in self.jobs.values():
+                timeout = min(timeout, max(0, waiting.deadline - time.time()))
+
+            if self.notifier is None:
+                self.notifier = Sysutils.watch_file(self.log_path)
+
+            if self.notifier is not None:
+                self.notifier.wait(timeout)
+            else:
+                time.sleep(min(timeout, backoff))
+                backoff = min(backoff * 2, sleep_interval)
+
+        return
+
+
+    def close(self):
+        if self.notifier is not None:
+            self.notifier.close()
+            self.notifier = None
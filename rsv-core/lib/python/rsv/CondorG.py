@@ -10,6 +10,9 @@ import tempfile
 import Condor
 import Sysutils
 
+# A command in a submit description, e.g. 'Executable = foo' or '+OSGRSV = True'
+SUBMIT_COMMAND = re.compile(r"^\s*(\+?[\w.]+)\s*=")
+
 KEYWORDS = ["return value", "error", "abort", "Globus job submission failed", "Detected Down Globus Resource", "held"]
 
 class CondorG:
@@ -24,6 +27,8 @@ class CondorG:
     tempdir = None
     cleanup = True
     cluster_id = None
+    proc_id = 0
+    log_contents = None
 
     def __init__(self, rsv, cleanup=True):
         """ Constructor """
@@ -41,26 +46,46 @@ class CondorG:
                     self.rsv.log("WARNING", "Could not remove Condor-G temporary directory '%s'.  Error %s" % (self.tempdir, err))
 
 
-    def submit(self, metric, attrs=None, timeout=None):
-        """ Form a grid submit file and submit the job to Condor """
+    def submit(self, metric, attrs=None, timeout=None, log=None):
+        """ Form a grid submit file and submit the job to Condor.  If log is given
+        the job writes its events to that (possibly shared) user log. """
+
+        submit_file = self.prepare(metric, attrs, log) + "Queue\n"
+
+        condor = Condor.Condor(self.rsv)
+        self.cluster_id = condor.submit_job(submit_file, metric.name, dir=self.tempdir, remove=0)
+
+        if not self.cluster_id:
+            return False
+
+        self.rsv.log("DEBUG", "Condor-G submission job ID - %s" % self.cluster_id)
+        return True
+
+
+    def prepare(self, metric, attrs=None, log=None):
+        """ Make the working directory for metric and return its submit description,
+        without the Queue statement """
 
         self.metric = metric
 
         # Make a temporary directory to store submit file, input, output, and log
-        parent_dir = os.path.join("/", "var", "tmp", "rsv")
-        if not os.path.exists(parent_dir):
-            # /var/tmp/rsv can be periodically deleted by system cleanup utilities so we sometimes
-            # have to re-create it
-            os.mkdir(parent_dir, 0755)
-            (uid, gid) = pwd.getpwnam('rsv')[2:4]
-            os.chown(parent_dir, uid, gid)
-        self.tempdir = tempfile.mkdtemp(prefix="condor_g-", dir=parent_dir)
+        self.tempdir = make_temp_dir("condor_g-")
         self.rsv.log("INFO", "Condor-G working directory: %s" % self.tempdir)
-        
-        self.log = os.path.join(self.tempdir, "%s.log" % metric.name)
+
+        # Jobs submitted as part of a batch all write to the same user log
+        if log:
+            self.log = log
+        else:
+            self.log = os.path.join(self.tempdir, "%s.log" % metric.name)
         self.out = os.path.join(self.tempdir, "%s.out" % metric.name)
         self.err = os.path.join(self.tempdir, "%s.err" % metric.name)
 
+        return self.build_submit_file(metric, attrs)
+
+
+    def build_submit_file(self, metric, attrs=None):
+        """ Return the submit description for a grid universe job """
+
         #
         # Build the submit file
         #
@@ -110,8 +135,9 @@ class CondorG:
             submit_file += "grid_resource = gt2 %s/jobmanager-%s\n\n" % (metric.host, jobmanager)
         
         # The user proxy should be in the submit file regardless of the CE type
-        if 'X509_USER_PROXY' in os.environ:
-                submit_file += "x509userproxy = %s\n" % os.environ['X509_USER_PROXY']
+        env = metric.get_job_environment()
+        if 'X509_USER_PROXY' in env:
+                submit_file += "x509userproxy = %s\n" % env['X509_USER_PROXY']
 
         submit_file += "Executable = %s\n" % metric.executable
 
@@ -132,16 +158,8 @@ class CondorG:
         submit_file += "Error = %s\n\n" % self.err
         submit_file += "Notification = never\n"
         submit_file += "WhenToTransferOutput = ON_EXIT_OR_EVICT\n\n"
-        submit_file += "Queue\n"
 
-        condor = Condor.Condor(self.rsv)
-        self.cluster_id = condor.submit_job(submit_file, metric.name, dir=self.tempdir, remove=0)
-
-        if not self.cluster_id:
-            return False
-
-        self.rsv.log("DEBUG", "Condor-G submission job ID - %s" % self.cluster_id)
-        return True
+        return submit_file
         
 
     def wait(self):
@@ -180,7 +198,7 @@ class CondorG:
         """ Remove the job from the Condor queue """
 
         if self.cluster_id:
-            constraint = "ClusterId==%s" % self.cluster_id
+            constraint = "ClusterId==%s && ProcId==%s" % (self.cluster_id, self.proc_id)
             condor = Condor.Condor(self.rsv)
             if not condor.stop_jobs(constraint):
                 self.rsv.log("WARNING", "Could not stop Condor-G jobs.  Constraint: %s" % constraint)
@@ -191,17 +209,91 @@ class CondorG:
 
     def get_stdout(self):
         """ Return the STDOUT of the job """
-        return self.utils.slurp(self.out)
+        return self.utils.slurp(self.out, buffer=self.rsv.get_output_buffer(self.metric, "stdout"))
 
     def get_stderr(self):
         """ Return the STDERR of the job """
-        return self.utils.slurp(self.err)
+        return self.utils.slurp(self.err, buffer=self.rsv.get_output_buffer(self.metric, "stderr"))
 
     def get_log_contents(self):
         """ Return the log contents of the job """
+        # When the job shares a log with other jobs, only return its own events
+        if self.log_contents is not None:
+            return self.log_contents
         return self.utils.slurp(self.log)
 
 
+def submit_batch(rsv, jobs, dir):
+    """ Submit many jobs with a single condor_submit.  jobs is a list of (job,
+    submit_description) pairs where submit_description was returned by
+    job.prepare().  The (cluster, proc) IDs of the submitted jobs map back to the
+    jobs by position.  Returns True on success. """
+
+    if not jobs:
+        return True
+
+    submit_file = build_batch_submit_file([description for (job, description) in jobs])
+
+    condor = Condor.Condor(rsv)
+    job_ids = condor.submit_jobs(submit_file, "batch", dir=dir, remove=0)
+    if not job_ids or len(job_ids) != len(jobs):
+        return False
+
+    for index in range(len(jobs)):
+        (job, description) = jobs[index]
+        (job.cluster_id, job.proc_id) = job_ids[index]
+
+    rsv.log("DEBUG", "Condor batch submission: %s jobs" % len(jobs))
+    return True
+
+
+def build_batch_submit_file(descriptions):
+    """ Join submit descriptions into one, with a Queue statement after each.
+    condor_submit carries commands over from one Queue statement to the next, so
+    any command that is set for some jobs but not for this one is cleared first. """
+
+    all_commands = {}
+    job_commands = []
+    for description in descriptions:
+        commands = {}
+        for line in description.split("\n"):
+            match = SUBMIT_COMMAND.match(line)
+            if match:
+                commands[match.group(1).lower()] = 1
+                all_commands[match.group(1).lower()] = match.group(1)
+        job_commands.append(commands)
+
+    keys = all_commands.keys()
+    keys.sort()
+
+    submit_file = ""
+    for index in range(len(descriptions)):
+        for key in keys:
+            if key in job_commands[index]:
+                continue
+            if key.startswith("+"):
+                submit_file += "%s = undefined\n" % all_commands[key]
+            else:
+                submit_file += "%s =\n" % all_commands[key]
+        submit_file += descriptions[index]
+        submit_file += "Queue\n\n"
+
+    return submit_file
+
+
+def make_temp_dir(prefix):
+    """ Make a temporary directory under /var/tmp/rsv """
+
+    parent_dir = os.path.join("/", "var", "tmp", "rsv")
+    if not os.path.exists(parent_dir):
+        # /var/tmp/rsv can be periodically deleted by system cleanup utilities so we sometimes
+        # have to re-create it
+        os.mkdir(parent_dir, 0755)
+        (uid, gid) = pwd.getpwnam('rsv')[2:4]
+        os.chown(parent_dir, uid, gid)
+    return tempfile.mkdtemp(prefix=prefix, dir=parent_dir)
+
+
 def quote_arguments(args):
     """ Generate an Arguments string for a condor submit file with proper quoting """
 
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+""" An index of the hosts, metrics and consumers in this install of RSV """
+
+import os
+import re
+
+import Host
+import Metric
+import Consumer
+
+# Files in the configuration directory that are not host configuration
+SPECIAL_CONFIG_FILES = ["rsv.conf", "consumers.conf", "rsv-nagios.conf", "rsv-zabbix.conf"]
+
+
+class ConfigIndex:
+    """ Built once per process (see RSV.get_index).  The configuration and libexec
+    directories are scanned and every host configuration file is loaded when the
+    index is created.  Metric and Consumer objects are created when they are first
+    asked for and then shared, so each configuration file is parsed at most once. """
+
+    def __init__(self, rsv, config_dir, libexec_dir):
+        self.rsv = rsv
+
+        self.hosts = scan_hosts(rsv, config_dir)
+        self.installed_metrics = scan_installed_metrics(rsv, os.path.join(libexec_dir, "metrics"))
+        self.installed_consumers = scan_installed_consumers(rsv, os.path.join(libexec_dir, "consumers"))
+
+        self.host_objects = {}
+        for host in self.hosts:
+            self.host_objects[host] = Host.Host(host, rsv)
+
+        self.consumer_objects = {}
+        self.metric_objects = None
+
+
+    def get_host(self, host):
+        """ Return the Host for host.  A host without a configuration file gets an
+        empty configuration, which is shared from then on. """
+        if host not in self.host_objects:
+            self.host_objects[host] = Host.Host(host, self.rsv)
+        return self.host_objects[host]
+
+
+    def get_host_info(self):
+        """ Return a Host for each configured host """
+        return [self.host_objects[host] for host in self.hosts]
+
+
+    def get_consumer(self, consumer):
+        if consumer not in self.consumer_objects:
+            self.consumer_objects[consumer] = Consumer.Consumer(consumer, self.rsv)
+        return self.consumer_objects[consumer]
+
+
+    def get_metric_info(self):
+        """ Return a dictionary with a Metric (not specific to any host) for each
+        installed metric """
+        if self.metric_objects is None:
+            self.metric_objects = {}
+            for metric in self.installed_metrics:
+                self.metric_objects[metric] = Metric.Metric(metric, self.rsv)
+        return self.metric_objects
+
+
+
+def scan_hosts(rsv, conf_dir):
+    """ Return a list of hosts that have configuration files """
+
+    try:
+        config_files = os.listdir(conf_dir)
+    except OSError:
+        # todo - check for permission problem
+        rsv.log("ERROR", "The conf directory does not exist (%s)" % conf_dir)
+        return []
+
+    hosts = []
+    for config_file in config_files:
+        # Somewhat arbitrary pattern, but it won't match '.', '..', or '.svn'
+        if config_file.endswith(".conf") and config_file not in SPECIAL_CONFIG_FILES:
+            hosts.append(config_file[:-len(".conf")])
+    return hosts
+
+
+def scan_installed_metrics(rsv, metrics_dir):
+    """ Return a sorted list of installed metrics """
+
+    try:
+        files = os.listdir(metrics_dir)
+    except OSError, err:
+        rsv.log("ERROR", "The metrics directory (%s) could not be accessed.  Error msg: %s" %
+                (metrics_dir, err))
+        return []
+
+    # Each metric should be something like org.osg.
+    # This pattern will specifically not match '.', '..', '.svn', etc
+    metric_name = re.compile("\w\.\w")
+    metrics = [entry for entry in files if metric_name.search(entry)]
+    metrics.sort()
+    return metrics
+
+
+def scan_installed_consumers(rsv, consumers_dir):
+    """ Return a sorted list of installed consumers """
+
+    try:
+        files = os.listdir(consumers_dir)
+    except OSError, err:
+        rsv.log("ERROR", "The consumers directory (%s) could not be accessed.  Error msg: %s" %
+                (consumers_dir, err))
+        return []
+
+    consumers = [entry for entry in files if entry.endswith("-consumer")]
+    consumers.sort()
+    return consumers
@@ -110,6 +110,12 @@ class Consumer:
             return ""
 
 
+    def is_daemon(self):
+        """ Return True if the consumer should run continuously (with --daemon) rather
+        than being started by Condor-Cron every few minutes """
+        return self.config_val("daemon", "true")
+
+
     def get_environment(self):
         """ Return the environment string from the configuration file after making
         necessary substitutions. """
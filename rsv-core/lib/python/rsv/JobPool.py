@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+""" A bounded pool of forked workers used to run metrics concurrently """
+
+# Standard libraries
+import os
+import sys
+import time
+import errno
+import signal
+import tempfile
+import traceback
+
+
+class Job:
+    """ Bookkeeping for a single unit of work in the pool """
+
+    def __init__(self, index, group, label, func, args):
+        self.index = index
+        self.group = group
+        self.label = label
+        self.func = func
+        self.args = args
+
+        self.pid = None
+        self.stdout = None
+        self.stderr = None
+        self.start_time = None
+        self.end_time = None
+        self.exit_code = None
+
+
+    def elapsed(self):
+        """ Return the number of seconds the job ran for """
+        if self.start_time is None or self.end_time is None:
+            return 0
+        return self.end_time - self.start_time
+
+
+
+class JobPool:
+    """ Run functions in forked child processes, at most max_jobs at a time and
+    at most max_jobs_per_group at a time for any one group (e.g. a host).
+
+    Each job runs in its own process, so it can call sys.exit() or change
+    os.environ without affecting the other jobs.  The
+    STDOUT and STDERR of each job are captured and replayed in the order the
+    jobs were added, so the output of different jobs is never interleaved. """
+
+    def __init__(self, rsv, max_jobs, max_jobs_per_group=0):
+        self.rsv = rsv
+        self.max_jobs = max(1, max_jobs)
+        self.max_jobs_per_group = max_jobs_per_group
+        self.jobs = []
+        self.wall_time = 0
+
+
+    def add(self, group, label, func, *args):
+        """ Queue func(*args) to run.  group is used for the per-group limit and
+        label is used when reporting on the job. """
+        self.jobs.append(Job(len(self.jobs), group, label, func, args))
+
+
+    def record(self, group, label, start_time, end_time, exit_code):
+        """ Record a job that was run outside of the pool (e.g. a Condor job) so that
+        it is included in the summary """
+
+        job = Job(len(self.jobs), group, label, None, ())
+        job.start_time = start_time
+        job.end_time = end_time
+        job.exit_code = exit_code
+        self.jobs.append(job)
+
+
+    def run(self):
+        """ Run all of the queued jobs and wait for them to finish """
+
+        pending = [job for job in self.jobs if job.end_time is None]
+        running = {}
+        per_group = {}
+        next_to_print = 0
+
+        start_time = time.time()
+        try:
+            while pending or running:
+                # Start as many jobs as our limits allow
+                for job in list(pending):
+                    if len(running) >= self.max_jobs:
+                        break
+                    if self.max_jobs_per_group > 0 and \
+                       per_group.get(job.group, 0) >= self.max_jobs_per_group:
+                        continue
+
+                    pending.remove(job)
+                    self.start(job)
+                    running[job.pid] = job
+                    per_group[job.group] = per_group.get(job.group, 0) + 1
+
+                # Wait for any child to finish
+                (pid, status) = waitpid()
+                if pid not in running:
+                    continue
+
+                job = running.pop(pid)
+                job.end_time = time.time()
+                job.exit_code = exit_code_from_status(status)
+                per_group[job.group] -= 1
+                self.rsv.log("DEBUG", "Job '%s' finished in %.1fs with exit code %s" %
+                             (job.label, job.elapsed(), job.exit_code))
+
+                # Replay output in the order the jobs were added
+                while next_to_print < len(self.jobs) and self.jobs[next_to_print].end_time is not None:
+                    self.replay_output(self.jobs[next_to_print])
+                    next_to_print += 1
+        finally:
+            # If we are leaving early (e.g. Ctrl-C) don't leave children behind
+            for pid in running.keys():
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+        self.wall_time = time.time() - start_time
+        return
+
+
+    def start(self, job):
+        """ Fork a child process to run a single job """
+
+        job.stdout = tempfile.TemporaryFile()
+        job.stderr = tempfile.TemporaryFile()
+
+        # Flush our buffers so that the child does not inherit (and print) them again
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        job.start_time = time.time()
+        job.pid = os.fork()
+        if job.pid == 0:
+            run_child(job)
+
+        return
+
+
+    def replay_output(self, job):
+        """ Copy the captured output of a finished job to our STDOUT/STDERR """
+
+        if job.stdout is None:
+            return
+
+        for (captured, stream) in ((job.stdout, sys.stdout), (job.stderr, sys.stderr)):
+            captured.seek(0)
+            while 1:
+                data = captured.read(65536)
+                if not data:
+                    break
+                stream.write(data)
+            captured.close()
+            stream.flush()
+
+
+    def summary(self, slowest=5):
+        """ Display the wall-clock time of the run and the slowest jobs """
+
+        total_time = 0
+        failed = 0
+        for job in self.jobs:
+            total_time += job.elapsed()
+            if job.exit_code != 0:
+                failed += 1
+
+        self.rsv.echo("\nRan %s metrics in %.1fs wall-clock time (%.1fs of metric time, %s parallel jobs)." %
+                      (len(self.jobs), self.wall_time, total_time, self.max_jobs))
+        if failed:
+            self.rsv.echo("%s metrics exited with a non-zero exit code." % failed)
+
+        by_time = [(job.elapsed(), job.index, job) for job in self.jobs]
+        by_time.sort()
+        by_time.reverse()
+        if by_time:
+            self.rsv.echo("Slowest metrics:")
+            for (elapsed, index, job) in by_time[:slowest]:
+                self.rsv.echo("%8.1fs  %s" % (elapsed, job.label), 2)
+
+        return
+
+
+
+def run_child(job):
+    """ Body of the forked child.  This never returns. """
+
+    exit_code = 1
+    try:
+        try:
+            os.dup2(job.stdout.fileno(), 1)
+            os.dup2(job.stderr.fileno(), 2)
+            job.func(*job.args)
+            exit_code = 0
+        except SystemExit, err:
+            exit_code = exit_code_from_system_exit(err)
+        except:
+            traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except IOError:
+            pass
+        # Use _exit so that we don't run the parent's cleanup handlers
+        os._exit(exit_code)
+
+
+def waitpid():
+    """ Wait for any child, retrying if a signal interrupts us """
+    while 1:
+        try:
+            return os.waitpid(-1, 0)
+        except OSError, err:
+            if err.errno != errno.EINTR:
+                raise
+
+
+def exit_code_from_status(status):
+    """ Turn the status returned by os.waitpid into an exit code """
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return 128 + os.WTERMSIG(status)
+
+
+def exit_code_from_system_exit(err):
+    """ Turn the argument of a SystemExit into an exit code """
+    if err.code is None:
+        return 0
+    try:
+        return int(err.code)
+    except (TypeError, ValueError):
+        return 1
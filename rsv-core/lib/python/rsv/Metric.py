@@ -3,10 +3,30 @@
 import os
 import re
 import sys
+import atexit
+import cPickle
 import ConfigParser
 
 VALID_OUTPUT_FORMATS = ["wlcg", "wlcg-multiple", "brief"]
 
+# The merged configuration of each metric/host pair is cached here (see ConfigCache)
+CONFIG_CACHE_FILE = os.path.join("/", "var", "lib", "rsv", "metric-config.cache")
+
+# Bump this when the way configuration is merged changes (e.g. new defaults) so
+# that old cache entries are not used
+CONFIG_CACHE_VERSION = 1
+
+class JobEnvironment(dict):
+    """ The environment variables for a metric's jobs.  It cannot be changed once it
+    is made, so one copy can be shared by every command the metric runs. """
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError("A job environment cannot be modified")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __readonly
+
+
+
 class Metric:
     """ Instantiable class to read and store configuration for a single metric """
 
@@ -35,19 +55,34 @@ class Metric:
             self.host_config_file = os.path.join(conf_dir, host, metric + ".conf")
             self.host_allmetrics_config_file = os.path.join(conf_dir, host, "allmetrics.conf")
 
-        # Load configuration
-        defaults = get_metric_defaults(metric)
+        # Load configuration.  Unless a file was given on the command line we can use
+        # the cached configuration if none of the files have changed.
         self.config = ConfigParser.RawConfigParser()
         self.config.optionxform = str
-        self.load_config(defaults, options)
+
+        cache_key = None
+        cached = False
+        if not (options and options.extra_config_file):
+            cache_key = (metric, self.host or "")
+            signature = self.get_config_signature()
+            cached = self.load_cached_config(cache_key, signature)
+
+        if not cached:
+            defaults = get_metric_defaults(metric)
+            self.load_config(defaults, options)
 
         if not self.validate_config():
             self.rsv.log("ERROR", "Metric %s is not configured correctly." % self.name)
+        elif cache_key and not cached:
+            config_cache.put(cache_key, signature, dump_sections(self.config))
 
         self.ce_type = None
         if options and options.ce_type:
             self.ce_type = options.ce_type
 
+        # Worked out the first time it is needed (see get_job_environment)
+        self.job_environment = None
+
         return
 
 
@@ -165,6 +200,30 @@ class Metric:
 
         return
 
+    def get_config_signature(self):
+        """ Return the signatures of the files the configuration is loaded from """
+        files = [self.meta_file, self.top_config_file]
+        if self.host:
+            files += [self.host_allmetrics_config_file, self.host_config_file]
+        return tuple([file_signature(file) for file in files])
+
+
+    def load_cached_config(self, cache_key, signature):
+        """ Load the configuration from the cache.  Return False if it is not cached
+        or any of the files have changed. """
+
+        sections = config_cache.get(cache_key, signature)
+        if sections is None:
+            return False
+
+        self.rsv.log("DEBUG", "Using cached configuration for metric '%s'" % self.name)
+        for (section, items) in sections:
+            self.config.add_section(section)
+            for (option, value) in items:
+                self.config.set(section, option, value)
+        return True
+
+
     def validate_config(self):
         """ Validate metric-specific configuration """
 
@@ -278,6 +337,61 @@ class Metric:
         return env
 
 
+    def get_job_environment(self):
+        """ Return the environment this metric's jobs run with: our own environment
+        with the proxy found by RSV.check_proxy and the metric's environment settings
+        applied.  It is worked out once for each Metric and cannot be changed, so it
+        can be handed to any number of commands (env=) at the same time. """
+
+        if self.job_environment is None:
+            self.job_environment = JobEnvironment(self.build_job_environment(os.environ))
+        return self.job_environment
+
+
+    def build_job_environment(self, base):
+        """ Return a copy of base with the proxy and environment settings applied """
+
+        self.rsv.log("INFO", "Setting up job environment:")
+
+        env = dict(base)
+
+        # Globus needs help finding the proxy since it probably does not have the
+        # default naming scheme of /tmp/x509_u<UID>
+        proxy = self.rsv.get_proxy()
+        if proxy:
+            env["X509_USER_PROXY"] = proxy
+            env["X509_PROXY_FILE"] = proxy
+
+        settings = self.get_environment()
+        if not settings:
+            self.rsv.log("INFO", "No environment setup declared", 4)
+            return env
+
+        for var in settings.keys():
+            (action, value) = settings[var]
+            action = action.upper()
+            self.rsv.log("INFO", "Var: '%s' Action: '%s' Value: '%s'" % (var, action, value), 4)
+            if action == "APPEND":
+                if var in env:
+                    env[var] = env[var] + ":" + value
+                else:
+                    env[var] = value
+                self.rsv.log("DEBUG", "New value of %s:\n%s" % (var, env[var]), 8)
+            elif action == "PREPEND":
+                if var in env:
+                    env[var] = value + ":" + env[var]
+                else:
+                    env[var] = value
+                self.rsv.log("DEBUG", "New value of %s:\n%s" % (var, env[var]), 8)
+            elif action == "SET":
+                env[var] = value
+            elif action == "UNSET":
+                if var in env:
+                    del env[var]
+
+        return env
+
+
     def get_classAds(self):
         """ Return the classAds configuration """
         
@@ -537,6 +651,107 @@ class Metric:
         return
 
 
+class ConfigCache:
+    """ Cache of the merged configuration of each metric/host pair, so that warm
+    invocations do not parse any INI files.  Each entry holds the signatures
+    (inode, mtime and size) of the files it was loaded from and is only used if
+    they all still match.  The cache is read on first use and new entries are
+    written back together by flush(), which runs when the process exits.  JobPool
+    workers end with os._exit, so anything added before the pool starts must be
+    flushed first (see run_metric.run_parallel). """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        self.added = {}
+
+
+    def read(self):
+        """ Return the entries in the cache file, or {} if it cannot be used """
+        try:
+            fd = open(self.path, 'rb')
+            try:
+                (version, entries) = cPickle.load(fd)
+            finally:
+                fd.close()
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError, TypeError,
+                AttributeError, ImportError, IndexError, KeyError):
+            return {}
+
+        if version != CONFIG_CACHE_VERSION or not isinstance(entries, dict):
+            return {}
+        return entries
+
+
+    def get(self, key, signature):
+        if self.entries is None:
+            self.entries = self.read()
+
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        return None
+
+
+    def put(self, key, signature, sections):
+        if self.entries is None:
+            self.entries = self.read()
+
+        if not self.added:
+            atexit.register(self.flush)
+        self.entries[key] = (signature, sections)
+        self.added[key] = (signature, sections)
+
+
+    def flush(self):
+        """ Add our new entries to the cache file.  Other processes may have updated
+        it since we read it, so merge with what is there now. """
+
+        if not self.added:
+            return
+
+        entries = self.read()
+        entries.update(self.added)
+        temp_path = "%s.%s" % (self.path, os.getpid())
+        try:
+            fd = open(temp_path, 'wb')
+            try:
+                cPickle.dump((CONFIG_CACHE_VERSION, entries), fd, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            # The cache is only an optimization
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+        self.added = {}
+        return
+
+
+config_cache = ConfigCache(CONFIG_CACHE_FILE)
+
+
+def file_signature(path):
+    """ Return (inode, mtime, size) of a file, or None if it does not exist """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_ino, info.st_mtime, info.st_size)
+
+
+def dump_sections(config):
+    """ Return the contents of a RawConfigParser as a list of (section, [(option, value)]),
+    keeping the order of the options """
+    sections = []
+    for section in config.sections():
+        sections.append((section, [(option, config.get(section, option)) for option in config.options(section)]))
+    return sections
+
+
 def get_metric_defaults(metric_name):
     """ Load metric default values """
     defaults = {}
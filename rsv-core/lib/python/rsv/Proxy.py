@@ -0,0 +1,176 @@
+#!/usr/bin/python
+
+""" Find out when proxies expire without running openssl for every metric """
+
+import os
+import stat
+import time
+import fcntl
+import cPickle
+import calendar
+
+# The expiry of each proxy is remembered here between invocations
+PROXY_CACHE_FILE = os.path.join("/", "var", "lib", "rsv", "proxy-expiry.cache")
+
+# Held while the service proxy is renewed.  It lives in RSV's own directory rather
+# than next to the proxy (e.g. in /tmp) where another user could create it first.
+RENEWAL_LOCK_FILE = os.path.join("/", "var", "lib", "rsv", "proxy-renewal.lock")
+
+# The longest we wait for another process to finish renewing the proxy
+RENEWAL_LOCK_TIMEOUT = 60
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+class ProxyCache:
+    """ Remembers the notAfter time of proxy files.  openssl is run once for each
+    version of a proxy file; the answer is kept in memory and in PROXY_CACHE_FILE,
+    keyed on the inode, mtime and size of the proxy, so a renewed proxy is read
+    again. """
+
+    def __init__(self, rsv, openssl, path=PROXY_CACHE_FILE):
+        self.rsv = rsv
+        self.openssl = openssl
+        self.path = path
+        self.entries = None
+
+
+    def read(self):
+        try:
+            fd = open(self.path, 'rb')
+            try:
+                entries = cPickle.load(fd)
+            finally:
+                fd.close()
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError, TypeError,
+                AttributeError, ImportError, IndexError, KeyError):
+            return {}
+
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+
+    def save(self, proxy, entry):
+        """ Add an entry to the cache file, keeping entries other processes added """
+
+        entries = self.read()
+        entries[proxy] = entry
+        temp_path = "%s.%s" % (self.path, os.getpid())
+        try:
+            fd = open(temp_path, 'wb')
+            try:
+                cPickle.dump(entries, fd, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            os.rename(temp_path, self.path)
+        except (IOError, OSError), err:
+            self.rsv.log("DEBUG", "Could not save proxy cache '%s': %s" % (self.path, err))
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        return
+
+
+    def get_enddate(self, proxy):
+        """ Return (notAfter in seconds since the epoch, openssl output) for a proxy.
+        The time is None if the proxy cannot be read. """
+
+        signature = file_signature(proxy)
+        if signature is None:
+            return (None, "Proxy file '%s' does not exist\n" % proxy)
+
+        if self.entries is None:
+            self.entries = self.read()
+
+        entry = self.entries.get(proxy)
+        if entry is not None and entry[0] == signature:
+            self.rsv.log("DEBUG", "Using cached expiration time of proxy '%s'" % proxy, 4)
+            return (entry[1], entry[2])
+
+        (ret, out, err) = self.rsv.run_command([self.openssl, "x509", "-in", proxy, "-noout", "-enddate"])
+        not_after = None
+        if ret == 0:
+            not_after = parse_enddate(out)
+        if not_after is None:
+            return (None, out + err)
+
+        entry = (signature, not_after, out)
+        self.entries[proxy] = entry
+        self.save(proxy, entry)
+        return (not_after, out)
+
+
+    def check_end(self, proxy, seconds, now):
+        """ Like 'openssl x509 -enddate -checkend': return (expiring, output) where
+        expiring is True if the proxy expires within seconds of now (or cannot be
+        read) """
+
+        (not_after, out) = self.get_enddate(proxy)
+        if not_after is None:
+            return (True, out)
+
+        if not_after - now <= seconds:
+            return (True, out + "Certificate will expire\n")
+        return (False, out + "Certificate will not expire\n")
+
+
+
+def file_signature(path):
+    """ Return (inode, mtime, size) of a file, or None if it does not exist """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_ino, info.st_mtime, info.st_size)
+
+
+def parse_enddate(output):
+    """ Turn the output of 'openssl x509 -enddate', e.g.
+        notAfter=Oct  8 12:00:00 2026 GMT
+    into seconds since the epoch, or None if it cannot be parsed """
+
+    for line in output.splitlines():
+        if not line.startswith("notAfter="):
+            continue
+        try:
+            (month, day, clock, year) = line[len("notAfter="):].split()[0:4]
+            (hour, minute, second) = clock.split(":")
+            return calendar.timegm((int(year), MONTHS.index(month) + 1, int(day),
+                                    int(hour), int(minute), int(second), 0, 0, 0))
+        except ValueError:
+            return None
+
+    return None
+
+
+def lock(path, timeout=RENEWAL_LOCK_TIMEOUT):
+    """ Take an exclusive lock on path, waiting up to timeout seconds for it.  Return
+    the file descriptor to pass to unlock, or None if the lock was not taken.  The
+    lock file must be a regular file; symlinks are not followed. """
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0600)
+    except OSError:
+        return None
+
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        return None
+
+    deadline = time.time() + timeout
+    while 1:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except IOError:
+            if time.time() >= deadline:
+                os.close(fd)
+                return None
+        time.sleep(0.1)
+
+
+def unlock(fd):
+    if fd is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
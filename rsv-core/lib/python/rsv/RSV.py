@@ -4,19 +4,24 @@
 import os
 import re
 import sys
+import time
 import logging
 import ConfigParser
 from pwd import getpwnam
 
 # RSV libraries
-import Host
-import Metric
+import Proxy
 import Results
 import Sysutils
-import Consumer
+import Reachability
+import ConfigIndex
 
 # Define base system paths
 OPENSSL_EXE = "/usr/bin/openssl"
+
+# Metric output is kept up to details-data-trim-length bytes plus this much, to
+# leave room for the other lines of a WLCG record
+OUTPUT_HEADROOM = 4096
 CONFIG_DIR = os.path.join("/", "etc", "rsv")
 LIBEXEC_DIR = os.path.join("/", "usr", "libexec", "rsv")
 LOG_DIR = os.path.join("/", "var", "log", "rsv")
@@ -36,6 +41,7 @@ class RSV:
         self.config = None
         self.logger = None
         self.proxy = None
+        self.index = None
 
         # For any messages that won't go through the logger
         self.quiet = 0
@@ -44,6 +50,8 @@ class RSV:
 
         # Instantiate our helper objects
         self.sysutils = Sysutils.Sysutils(self)
+        self.proxy_cache = Proxy.ProxyCache(self, OPENSSL_EXE)
+        self.reachability = Reachability.Reachability(self)
         self.results  = Results.Results(self, options)
 
         # Setup the logger
@@ -103,82 +111,43 @@ class RSV:
 
 
 
+    def get_index(self):
+        """ Return the index of hosts, metrics and consumers, building it on first use """
+        if self.index is None:
+            self.index = ConfigIndex.ConfigIndex(self, CONFIG_DIR, LIBEXEC_DIR)
+        return self.index
+
+
     def get_installed_metrics(self):
         """ Return a list of installed metrics """
-        metrics_dir = os.path.join(LIBEXEC_DIR, "metrics")
-        try:
-            files = os.listdir(metrics_dir)
-            files.sort()
-            metrics = []
-            for entry in files:
-                # Each metric should be something like org.osg.
-                # This pattern will specifically not match '.', '..', '.svn', etc
-                if re.search("\w\.\w", entry):
-                    metrics.append(entry)
-            return metrics
-        except OSError, err:
-            self.log("ERROR", "The metrics directory (%s) could not be accessed.  Error msg: %s" %
-                     (metrics_dir, err))
-            return []
+        return list(self.get_index().installed_metrics)
 
 
     def get_installed_consumers(self):
         """ Return a list of installed consumers """
-        consumers_dir = os.path.join(LIBEXEC_DIR, "consumers")
-        try:
-            files = os.listdir(consumers_dir)
-            files.sort()
-            consumers = []
-            for entry in files:
-                if re.search("-consumer$", entry):
-                    consumers.append(entry)
-            return consumers
-        except OSError, err:
-            self.log("ERROR", "The consumers directory (%s) could not be accessed.  Error msg: %s" %
-                     (consumers_dir, err))
-            return []
+        return list(self.get_index().installed_consumers)
 
 
     def get_metric_info(self):
         """ Return a dictionary with information about each installed metric """
-
-        metrics = {}
-        for metric in self.get_installed_metrics():
-            metrics[metric] = Metric.Metric(metric, self)
-
-        return metrics
+        return self.get_index().get_metric_info()
 
 
 
     def get_hosts(self):
         """ Return a list of hosts that have configuration files """
-
-        special_config_files = ["rsv.conf", "consumers.conf", "rsv-nagios.conf", "rsv-zabbix.conf"]
-
-        conf_dir = CONFIG_DIR
-        try:
-            config_files = os.listdir(conf_dir)
-            hosts = []
-            for config_file in config_files:
-                # Somewhat arbitrary pattern, but it won't match '.', '..', or '.svn'
-                if re.search("\.conf$", config_file) and config_file not in special_config_files:
-                    host = re.sub("\.conf$", "", config_file)
-                    hosts.append(host)
-            return hosts
-        except OSError:
-            # todo - check for permission problem
-            self.log("ERROR", "The conf directory does not exist (%s)" % conf_dir)
+        return list(self.get_index().hosts)
 
 
 
     def get_host_info(self):
         """ Return a list containing one Host instance for each configured host """
+        return self.get_index().get_host_info()
 
-        hosts = []
-        for host in self.get_hosts():
-            hosts.append(Host.Host(host, self))
 
-        return hosts
+    def get_host(self, host):
+        """ Return the Host instance for a host, whether or not it is configured """
+        return self.get_index().get_host(host)
 
 
 
@@ -264,8 +233,7 @@ class RSV:
             for consumer in re.split("\s*,\s*", self.consumer_config.get("consumers", "enabled")):
                 if consumer and not consumer.isspace():
                     if want_objects:
-                        consumer_obj = Consumer.Consumer(consumer, self)
-                        consumers.append(consumer_obj)
+                        consumers.append(self.get_index().get_consumer(consumer))
                     else:
                         consumers.append(consumer)
             return consumers
@@ -401,31 +369,39 @@ class RSV:
         self.log("INFO", "Using service certificate proxy", 4)
 
         hours_til_expiry = 6
-        seconds_til_expiry = str(hours_til_expiry * 60 * 60)
-        (ret, out, err) = self.run_command([OPENSSL_EXE, "x509", "-in", proxy, "-noout", "-enddate", "-checkend", seconds_til_expiry])
+        seconds_til_expiry = hours_til_expiry * 60 * 60
+        (expiring, out) = self.proxy_cache.check_end(proxy, seconds_til_expiry, time.time())
 
-        if ret == 0:
+        if not expiring:
             self.log("INFO", "Service certificate valid for at least %s hours." % hours_til_expiry, 4)
         else:
-            self.log("INFO", "Service certificate proxy expired or expiring within %s hours.  Renewing it." %
-                    hours_til_expiry, 4)
-
-            cmd = ["grid-proxy-init", "-cert", cert, "-key", key, "-valid", "12:00", "-bits", "1024", "-debug", "-out", proxy]
-            if self.use_legacy_proxy():
-                self.log("INFO", "Generating a legacy Globus proxy because it was requested.", 4)
-                # This should come right after "grid-proxy-init"
-                cmd.insert(1, "-old")
-
-            (ret, out, err) = self.run_command(cmd)
-
-            if ret:
-                self.results.service_proxy_renewal_failed(metric, cert, key, proxy, out, err)
-                sys.exit(1)
-
-        # Globus needs help finding the service proxy since it probably does not have the
-        # default naming scheme of /tmp/x509_u<UID>
-        os.environ["X509_USER_PROXY"] = proxy
-        os.environ["X509_PROXY_FILE"] = proxy
+            # Several metrics may find the proxy expiring at the same time.  Only one
+            # of them renews it, the others wait for the lock and find it renewed.
+            lock_fd = Proxy.lock(Proxy.RENEWAL_LOCK_FILE)
+            if lock_fd is None:
+                self.log("WARNING", "Could not lock '%s' within %s seconds.  Renewing the proxy anyway." %
+                         (Proxy.RENEWAL_LOCK_FILE, Proxy.RENEWAL_LOCK_TIMEOUT), 4)
+            try:
+                (expiring, out) = self.proxy_cache.check_end(proxy, seconds_til_expiry, time.time())
+                if not expiring:
+                    self.log("INFO", "Service certificate proxy was renewed by another process.", 4)
+                else:
+                    self.log("INFO", "Service certificate proxy expired or expiring within %s hours.  Renewing it." %
+                            hours_til_expiry, 4)
+
+                    cmd = ["grid-proxy-init", "-cert", cert, "-key", key, "-valid", "12:00", "-bits", "1024", "-debug", "-out", proxy]
+                    if self.use_legacy_proxy():
+                        self.log("INFO", "Generating a legacy Globus proxy because it was requested.", 4)
+                        # This should come right after "grid-proxy-init"
+                        cmd.insert(1, "-old")
+
+                    (ret, out, err) = self.run_command(cmd)
+
+                    if ret:
+                        self.results.service_proxy_renewal_failed(metric, cert, key, proxy, out, err)
+                        sys.exit(1)
+            finally:
+                Proxy.unlock(lock_fd)
 
         return
 
@@ -445,29 +421,69 @@ class RSV:
         # doesn't seem to like a proxy that has a lifetime of less than 3 hours anyways,
         # so this check might need to be adjusted if that behavior is more understood.
         minutes_til_expiration = 10
-        seconds_til_expiration = str(minutes_til_expiration * 60)
-        (ret, out, err) = self.run_command([OPENSSL_EXE, "x509", "-in", proxy_file, "-noout", "-enddate", "-checkend", seconds_til_expiration])
+        seconds_til_expiration = minutes_til_expiration * 60
+        (expiring, out) = self.proxy_cache.check_end(proxy_file, seconds_til_expiration, time.time())
 
-        if ret:
+        if expiring:
             self.results.expired_user_proxy(metric, proxy_file, out, minutes_til_expiration)
             sys.exit(1)
 
-        # Just in case this isn't the default /tmp/x509_u<UID> we'll explicitly set it
-        os.environ["X509_USER_PROXY"] = proxy_file
-        os.environ["X509_PROXY_FILE"] = proxy_file
-
         return
 
 
-    def run_command(self, command, timeout=None):
-        """ Wrapper for Sysutils.system """
+    def run_command(self, command, timeout=None, env=None, stdout=None, stderr=None):
+        """ Wrapper for Sysutils.system.  The command runs under a Sysutils.Supervisor
+        so it does not interfere with other commands being timed by this process.
+        stdout and stderr are optional buffers for the output (see get_output_buffer). """
 
         if not timeout:
             # Use the timeout declared in the config file
             timeout = self.config.getint("rsv", "job-timeout")
 
         self.log("INFO", "Running command with timeout (%s seconds):\n\t%s" % (timeout, " ".join(command)))
-        return self.sysutils.system(command, timeout)
+        return self.sysutils.system(command, timeout, env, stdout, stderr)
+
+
+    def get_output_buffer(self, metric, stream):
+        """ Return a buffer to collect one output stream (stdout or stderr) of a
+        metric in.  Only as much is kept as details-data-trim-length needs, unless it
+        is 0.  If output-spill-dir is set, the output that is left out is written to
+        a file there and the file is named in the output. """
+
+        trim_length = self.config.getint("rsv", "details-data-trim-length")
+        if trim_length <= 0:
+            return Sysutils.OutputBuffer()
+
+        spill_path = None
+        spill_dir = self.config.get("rsv", "output-spill-dir")
+        if spill_dir:
+            spill_path = os.path.join(spill_dir, "%s.%s.%s.%s.%s" % (metric.name, metric.host,
+                                                                     time.strftime("%Y%m%d-%H%M%S"),
+                                                                     os.getpid(), stream))
+
+        return Sysutils.BoundedOutputBuffer(trim_length + OUTPUT_HEADROOM, spill_path)
+
+
+    def get_parallel_jobs(self):
+        """ Return the number of metrics that 'rsv-control --run' may run at the same
+        time.  --jobs on the command line overrides parallel-jobs in rsv.conf. """
+
+        jobs = getattr(self.options, "jobs", None)
+        if jobs is None:
+            jobs = self.config.getint("rsv", "parallel-jobs")
+        return max(1, jobs)
+
+
+    def get_parallel_jobs_per_host(self):
+        """ Return the maximum number of metrics to run against a single host at the
+        same time when running in parallel.  0 means no limit. """
+        return max(0, self.config.getint("rsv", "parallel-jobs-per-host"))
+
+
+    def get_ping_cache_ttl(self):
+        """ Return how many seconds the result of pinging a host is reused for.  0 means
+        that every metric pings its host. """
+        return max(0, self.config.getint("rsv", "ping-cache-ttl"))
 
 
     def use_condor_g(self):
@@ -506,6 +522,38 @@ class RSV:
             return None
 
 
+    def use_spool_segments(self):
+        """ Return True if records should be appended to spool segments rather than
+        written one per file.  We will default to one file per record. """
+
+        try:
+            value = (self.config.get("rsv", "spool-format") or "files").lower()
+        except ConfigParser.NoOptionError:
+            return False
+
+        if value not in ("files", "segments"):
+            self.log("ERROR", "Invalid value for spool-format: must be 'files' or 'segments'")
+            return False
+
+        return value == "segments"
+
+
+    def get_condor_backend(self):
+        """ Return 'auto', 'python' or 'cli' depending on how the user wants us to talk
+        to Condor-Cron.  We will default to 'cli' if the value is missing or invalid. """
+
+        try:
+            value = (self.config.get("rsv", "condor-backend") or "cli").lower()
+        except ConfigParser.NoOptionError:
+            return "cli"
+
+        if value not in ("auto", "python", "cli"):
+            self.log("ERROR", "Invalid value for condor-backend: must be 'auto', 'python' or 'cli'")
+            return "cli"
+
+        return value
+
+
     def use_legacy_proxy(self):
         """ Return True or False depending on if we should use a legacy Globus proxy.
         We will default to False if the user did not specify. """
@@ -539,9 +587,36 @@ def get_rsv_defaults():
     # to trim it down to in bytes.  A value of 0 means no trimming.
     set_default_value("rsv", "details-data-trim-length", 10000)
 
+    # Don't keep the part of a metric's output that is trimmed.  If this is set to a
+    # directory, the full output of a metric that is trimmed is saved there.
+    set_default_value("rsv", "output-spill-dir", "")
+
     # Set the job timeout default in seconds
     set_default_value("rsv", "job-timeout", 1200)
 
+    # Run metrics one at a time unless the user asks for more (rsv-control --jobs)
+    set_default_value("rsv", "parallel-jobs", 1)
+
+    # When running in parallel, don't flood a single host with more than this many
+    # metrics at once.  A value of 0 means no limit.
+    set_default_value("rsv", "parallel-jobs-per-host", 2)
+
+    # Metrics run within this many seconds of each other against the same host share
+    # one ping of that host
+    set_default_value("rsv", "ping-cache-ttl", 60)
+
+    # Write one file per record into the consumer spool directories.  'segments'
+    # appends records to segment files instead, which consumers drain much faster.
+    set_default_value("rsv", "spool-format", "files")
+
+    # With spool-format = segments, start a new segment once the current one
+    # reaches this many bytes
+    set_default_value("rsv", "spool-segment-size", 1048576)
+
+    # Talk to Condor-Cron through the condor_cron_* command line tools, as RSV always
+    # has.  'auto' or 'python' use the htcondor Python bindings instead.
+    set_default_value("rsv", "condor-backend", "cli")
+
     return defaults
 
 
@@ -574,22 +649,22 @@ def validate_config(rsv):
 
 
     #
-    # "details_data_trim_length" must be an integer because we will use it later
-    # in a splice
+    # "details-data-trim-length" must be an integer because we will use it later
+    # in a splice and to size the output buffers
     #
     try:
-        rsv.config.getint("rsv", "details_data_trim_length")
+        rsv.config.getint("rsv", "details-data-trim-length")
     except ConfigParser.NoOptionError:
         # We set a default for this, but just to be safe set it again here.
-        rsv.config.set("rsv", "details_data_trim_length", "10000")
+        rsv.config.set("rsv", "details-data-trim-length", "10000")
     except ValueError:
-        rsv.log("ERROR: details_data_trim_length must be an integer.  It is set to '%s'"
-                % rsv.config.get("rsv", "details_data_trim_length"))
+        rsv.log("ERROR", "details-data-trim-length must be an integer.  It is set to '%s'"
+                % rsv.config.get("rsv", "details-data-trim-length"))
         sys.exit(1)
 
 
     #
-    # job_timeout must be an integer because we will use it later in an alarm call
+    # job_timeout must be an integer because we will use it later as a command deadline
     #
     try:
         rsv.config.getint("rsv", "job-timeout")
@@ -602,6 +677,19 @@ def validate_config(rsv):
         sys.exit(1)
 
 
+    #
+    # parallel-jobs, parallel-jobs-per-host, spool-segment-size and ping-cache-ttl must be
+    # integers because they size the worker pool and the spool segments and time the ping cache
+    #
+    for option in ("parallel-jobs", "parallel-jobs-per-host", "spool-segment-size", "ping-cache-ttl"):
+        try:
+            rsv.config.getint("rsv", option)
+        except ValueError:
+            rsv.log("ERROR", "%s must be an integer.  It is set to '%s'" %
+                    (option, rsv.config.get("rsv", option)))
+            sys.exit(1)
+
+
     #
     # warn if consumers are missing
     #
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+""" Check that the hosts we monitor can be reached before running metrics against them """
+
+import os
+import time
+import errno
+import select
+import socket
+import cPickle
+
+import Sysutils
+
+PING_EXE = "/bin/ping"
+
+# Results are shared between invocations (each Condor-Cron job is a separate
+# process) for ping-cache-ttl seconds
+REACHABILITY_CACHE_FILE = os.path.join("/", "var", "lib", "rsv", "reachability.cache")
+
+# How long to wait for a TCP connection when the host does not answer pings
+TCP_CONNECT_TIMEOUT = 3
+
+
+class HostStatus:
+    """ The result of probing one host """
+
+    def __init__(self, host, reachable, command, stdout="", stderr="", timed_out=False):
+        self.host = host
+        self.reachable = reachable
+        self.command = command
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        self.checked = time.time()
+
+
+
+class Reachability:
+    """ Probes hosts and remembers the results for a short time.  Every host that
+    is not already known is probed at the same time, with one ping each.  If a host
+    does not answer pings (ICMP is often blocked) but its URI has a port, we try a
+    TCP connection to that port instead. """
+
+    def __init__(self, rsv, path=REACHABILITY_CACHE_FILE):
+        self.rsv = rsv
+        self.path = path
+        self.results = None
+
+
+    def get_status(self, uri):
+        """ Return the HostStatus for the host in uri, probing it if needed """
+
+        host = split_uri(uri)[0]
+        status = self.get_cached(host)
+        if status is None:
+            self.check([uri])
+            status = self.results[host]
+        return status
+
+
+    def get_cached(self, host):
+        """ Return the HostStatus for host if it was checked recently, otherwise None """
+
+        ttl = self.rsv.get_ping_cache_ttl()
+        if ttl <= 0:
+            return None
+
+        if self.results is None:
+            self.results = self.read()
+
+        status = self.results.get(host)
+        if status is None or time.time() - status.checked > ttl:
+            return None
+
+        self.rsv.log("DEBUG", "Using reachability of host %s checked %d seconds ago" %
+                     (host, time.time() - status.checked), 4)
+        return status
+
+
+    def check(self, uris):
+        """ Probe each distinct host in uris that was not checked recently """
+
+        if self.results is None:
+            self.results = self.read()
+
+        ports = {}
+        for uri in uris:
+            (host, port) = split_uri(uri)
+            if self.get_cached(host) is not None:
+                continue
+            if ports.get(host) is None:
+                ports[host] = port
+
+        if not ports:
+            return
+
+        hosts = ports.keys()
+        hosts.sort()
+        self.rsv.log("INFO", "Checking that %s hosts can be reached: %s" % (len(hosts), " ".join(hosts)))
+
+        statuses = self.ping(hosts)
+
+        # Hosts that don't answer pings may still accept connections on their service port
+        fallback = [(host, ports[host]) for host in hosts
+                    if not statuses[host].reachable and not statuses[host].timed_out and ports[host]]
+        if fallback:
+            for (host, error) in tcp_connect(fallback, TCP_CONNECT_TIMEOUT).items():
+                if error is None:
+                    self.rsv.log("INFO", "Host %s did not answer ping but accepts connections on port %s" %
+                                 (host, ports[host]), 4)
+                    statuses[host].reachable = True
+                else:
+                    statuses[host].stderr += "TCP connection to %s:%s failed: %s\n" % (host, ports[host], error)
+
+        for host in hosts:
+            self.results[host] = statuses[host]
+        self.save(statuses)
+        return
+
+
+    def ping(self, hosts):
+        """ Ping every host at the same time and return a HostStatus for each """
+
+        timeout = self.rsv.config.getint("rsv", "job-timeout")
+        supervisor = Sysutils.Supervisor(self.rsv)
+        children = {}
+        for host in hosts:
+            # Send a single ping, with a timeout.  We just want to know if we can reach
+            # the remote host, we don't care about the latency unless it exceeds the timeout
+            cmd = [PING_EXE, "-W", "3", "-c", "1", host]
+            try:
+                children[host] = supervisor.spawn(cmd, timeout)
+            except OSError, err:
+                # No usable ping on this system.  We can still try the TCP port.
+                children[host] = None
+                self.rsv.log("WARNING", "Could not run '%s': %s" % (" ".join(cmd), err))
+        supervisor.run()
+
+        statuses = {}
+        for host in hosts:
+            child = children[host]
+            if child is None:
+                statuses[host] = HostStatus(host, False, " ".join([PING_EXE, host]),
+                                            stderr="Could not run %s\n" % PING_EXE)
+                continue
+
+            command = " ".join(child.command)
+            if child.timed_out:
+                statuses[host] = HostStatus(host, False, command, timed_out=True,
+                                            stderr="Command timed out (timeout=%s)" % timeout)
+            else:
+                statuses[host] = HostStatus(host, child.returncode == 0, command,
+                                            child.get_stdout(), child.get_stderr())
+        return statuses
+
+
+    def read(self):
+        try:
+            fd = open(self.path, 'rb')
+            try:
+                results = cPickle.load(fd)
+            finally:
+                fd.close()
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError, TypeError,
+                AttributeError, ImportError, IndexError, KeyError):
+            return {}
+
+        if not isinstance(results, dict):
+            return {}
+        return results
+
+
+    def save(self, statuses):
+        """ Add statuses to the cache file, keeping results other processes added """
+
+        if self.rsv.get_ping_cache_ttl() <= 0:
+            return
+
+        results = self.read()
+        results.update(statuses)
+        temp_path = "%s.%s" % (self.path, os.getpid())
+        try:
+            fd = open(temp_path, 'wb')
+            try:
+                cPickle.dump(results, fd, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            os.rename(temp_path, self.path)
+        except (IOError, OSError), err:
+            self.rsv.log("DEBUG", "Could not save reachability cache '%s': %s" % (self.path, err))
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        return
+
+
+
+def split_uri(uri):
+    """ Split a metric URI such as host:port into (host, port).  The port is None
+    if the URI does not have one. """
+
+    if uri.find(":") > 0:
+        (host, port) = uri.split(":", 1)
+        try:
+            return (host, int(port))
+        except ValueError:
+            return (host, None)
+    return (uri, None)
+
+
+def tcp_connect(targets, timeout):
+    """ Open a TCP connection to each (host, port) in targets at the same time.
+    Returns a dictionary with None for each host that accepted the connection or
+    the error for each host that did not. """
+
+    errors = {}
+    pending = {}
+    for (host, port) in targets:
+        try:
+            address = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)[0]
+            sock = socket.socket(address[0], address[1], address[2])
+        except (socket.error, socket.gaierror), err:
+            errors[host] = err
+            continue
+
+        sock.setblocking(0)
+        ret = sock.connect_ex(address[4])
+        if ret == 0:
+            errors[host] = None
+            sock.close()
+        elif ret in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            pending[sock] = host
+        else:
+            errors[host] = os.strerror(ret)
+            sock.close()
+
+    deadline = time.time() + timeout
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            writable = select.select([], pending.keys(), [], remaining)[1]
+        except select.error, err:
+            if err[0] == errno.EINTR:
+                continue
+            raise
+
+        for sock in writable:
+            host = pending.pop(sock)
+            ret = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if ret == 0:
+                errors[host] = None
+            else:
+                errors[host] = os.strerror(ret)
+            sock.close()
+
+    for (sock, host) in pending.items():
+        errors[host] = "timed out after %s seconds" % timeout
+        sock.close()
+
+    return errors
@@ -7,13 +7,37 @@ import sys
 import time
 import socket
 import calendar
-import tempfile
 import ConfigParser
 from time import localtime, strftime, strptime, gmtime
 
+import Spool
+import Sysutils
+
 UTC_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 LOCAL_TIME_FORMAT = "%Y-%m-%d %H:%M:%S %Z"
 
+def trim(data, trim_length):
+    """ Return the first trim_length bytes of data followed by a note saying how
+    much was left out.  Output that was already left out while it was being
+    collected (see Sysutils.BoundedOutputBuffer) is counted, and the file holding
+    the full output is named if there is one. """
+
+    if len(data) <= trim_length:
+        return data
+
+    omitted = len(data) - trim_length
+    spilled = ""
+    match = Sysutils.OMITTED_OUTPUT_PATTERN.search(data)
+    if match:
+        # Don't count the part of the earlier note (with its newlines) that is cut
+        start = max(match.start() - 1, trim_length)
+        end = min(match.end() + 1, len(data))
+        omitted += int(match.group(1)) - max(0, end - start)
+        if match.group(2):
+            spilled = "; full output in %s" % match.group(2)
+    return data[:trim_length] + Sysutils.OMITTED_OUTPUT % (omitted, spilled)
+
+
 def timestamp(local=False):
     """ When generating timestamps, we want to use UTC when communicating with
     the remote collector.  For example:
@@ -57,18 +81,25 @@ class Results:
     def __init__(self, rsv, options):
         self.rsv = rsv
         self.options = options
+        self.spool = Spool.SpoolWriter(rsv, self)
 
 
     def wlcg_result(self, metric, record, stderr):
         """ Handle WLCG formatted output """
 
         # Trim detailsData using details-data-trim-length
-        trim_length = self.rsv.config.get("rsv", "details-data-trim-length")
-        if trim_length > 0:
-            pass
-            #self.rsv.log("INFO", "Trimming data to %s bytes because details-data-trim-length is set" %
-            #        trim_length)
-            # TODO - trim detailsData
+        trim_length = self.rsv.config.getint("rsv", "details-data-trim-length")
+        match = re.search("^detailsData: ?", record, re.MULTILINE)
+        if trim_length > 0 and match:
+            end = record.rfind("\nEOT")
+            if end < match.end():
+                # No EOT yet, it is added below
+                end = len(record)
+            details = record[match.end():end]
+            if len(details) > trim_length:
+                self.rsv.log("INFO", "Trimming data to %s bytes because details-data-trim-length is set" %
+                             trim_length)
+                record = record[:match.end()] + trim(details, trim_length).rstrip("\n") + record[end:]
 
         # A bug was discovered in RSV 3.3.5 that sometimes reads only 2048 bytes of STDOUT.
         # This results in a truncated record.  We will check our record now and if it has a
@@ -105,11 +136,11 @@ class Results:
         # Trim the data appropriately based on details-data-trim-length.
         # A value of 0 means do not trim it.
         #
-        trim_length = self.rsv.config.get("rsv", "details-data-trim-length")
-        if trim_length > 0:
+        trim_length = self.rsv.config.getint("rsv", "details-data-trim-length")
+        if trim_length > 0 and len(data) > trim_length:
             self.rsv.log("INFO", "Trimming data to %s bytes because details-data-trim-length is set" %
                          trim_length)
-            data = data[:trim_length]
+            data = trim(data, trim_length)
 
         #
         # We want to print the time different depending on the consumer
@@ -139,8 +170,9 @@ class Results:
         if self.options.test:
             self.rsv.echo('No records have been generated because --test was used.')
         else:
-            for consumer in self.rsv.get_enabled_consumers():
-                self.create_consumer_record(metric, consumer, utc_summary, local_summary, epoch_summary)
+            self.spool.write(metric, {"local" : local_summary,
+                                      "epoch" : epoch_summary,
+                                      ""      : utc_summary})
 
         # enhance - should we have different exit codes based on status?  I think
         # that just running a probe successfully should be a 0 exit status, but
@@ -176,33 +208,6 @@ class Results:
 
 
 
-    def create_consumer_record(self, metric, consumer, utc_summary, local_summary, epoch_summary):
-        """ Make a file in the consumer records area """
-
-        # Check/create the directory that we'll put record into
-        output_dir = os.path.join("/", "var", "spool", "rsv", consumer.name)
-
-        if not self.validate_directory(output_dir):
-            self.rsv.log("WARNING", "Cannot write record for consumer '%s'" % consumer.name)
-        else:
-            prefix = metric.name + "."
-            (file_handle, file_path) = tempfile.mkstemp(prefix=prefix, dir=output_dir)
-
-            self.rsv.log("INFO", "Creating record for %s consumer at '%s'" % (consumer.name, file_path))
-
-            time_format = consumer.requested_time_format()
-            if time_format == "local":
-                os.write(file_handle, local_summary)
-            elif time_format == "epoch":
-                os.write(file_handle, epoch_summary)
-            else:
-                os.write(file_handle, utc_summary)
-
-            os.close(file_handle)
-
-        return
-
-
     def validate_directory(self, output_dir):
         """ Validate the directory and create it if it does not exist """
 
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+""" Write result records into the spool directories of the enabled consumers """
+
+import os
+import time
+import errno
+import fcntl
+import tempfile
+
+SPOOL_DIR = os.path.join("/", "var", "spool", "rsv")
+
+# Records are written here first and then linked into each consumer's directory,
+# so a consumer never sees a partially written record
+STAGING_DIR = os.path.join(SPOOL_DIR, ".staging")
+
+# With spool-format = segments, records are appended to this file in each consumer
+# directory.  It is renamed to a segment name (see segment_name) when it is full
+# or when the consumer claims it.  Consumers skip files starting with '.'.
+OPEN_SEGMENT = ".open.seg"
+
+
+class SpoolWriter:
+    """ Fans each record out to every enabled consumer.  Each time format is written
+    only once and then hardlinked into the consumer directories that want it (or,
+    with spool-format = segments, appended to each consumer's open segment).  The
+    list of consumers and the directories that have been validated are cached for
+    the life of the process. """
+
+    def __init__(self, rsv, results):
+        self.rsv = rsv
+        self.results = results
+        self.consumers = None
+        self.valid_dirs = {}
+
+
+    def get_consumers(self):
+        """ Return a list of (consumer name, time format, output directory) for the
+        enabled consumers whose spool directory we can write to """
+
+        if self.consumers is None:
+            self.consumers = []
+            for consumer in self.rsv.get_enabled_consumers():
+                output_dir = os.path.join(SPOOL_DIR, consumer.name)
+                if not self.validate_directory(output_dir):
+                    self.rsv.log("WARNING", "Cannot write record for consumer '%s'" % consumer.name)
+                    continue
+                self.consumers.append((consumer.name, consumer.requested_time_format(), output_dir))
+
+        return self.consumers
+
+
+    def validate_directory(self, output_dir):
+        """ Validate (and create if necessary) a directory, remembering the answer """
+
+        if output_dir not in self.valid_dirs:
+            self.valid_dirs[output_dir] = self.results.validate_directory(output_dir)
+        return self.valid_dirs[output_dir]
+
+
+    def write(self, metric, summaries):
+        """ Write a record for each consumer.  summaries maps a time format ('local',
+        'epoch' or '' for UTC) to the record in that format. """
+
+        if self.rsv.use_spool_segments():
+            self.append_to_segments(summaries)
+            return
+
+        # Group the consumers by the time format they want
+        by_format = {}
+        for (name, time_format, output_dir) in self.get_consumers():
+            if time_format not in summaries:
+                time_format = ""
+            by_format.setdefault(time_format, []).append((name, output_dir))
+
+        for time_format in by_format.keys():
+            self.write_record(metric, summaries[time_format], by_format[time_format])
+
+        return
+
+
+    def write_record(self, metric, record, consumers):
+        """ Write one record and put it into the directory of each of consumers, which
+        is a list of (consumer name, output directory) """
+
+        prefix = metric.name + "."
+
+        staged = None
+        if self.validate_directory(STAGING_DIR):
+            try:
+                (file_handle, staged) = tempfile.mkstemp(prefix=prefix, dir=STAGING_DIR)
+                try:
+                    os.write(file_handle, record)
+                finally:
+                    os.close(file_handle)
+            except (IOError, OSError), err:
+                self.rsv.log("WARNING", "Could not write record to staging directory '%s': %s" %
+                             (STAGING_DIR, err))
+                if staged:
+                    remove(staged)
+                staged = None
+
+        for (name, output_dir) in consumers:
+            if staged:
+                file_path = link_into(staged, output_dir)
+            else:
+                file_path = None
+
+            # We could not link (e.g. the spool is on more than one filesystem) so
+            # write a private copy and rename it into place
+            if not file_path:
+                file_path = write_into(record, output_dir, prefix)
+
+            if file_path:
+                self.rsv.log("INFO", "Creating record for %s consumer at '%s'" % (name, file_path))
+            else:
+                self.rsv.log("WARNING", "Cannot write record for consumer '%s'" % name)
+
+        if staged:
+            remove(staged)
+
+        return
+
+
+    def append_to_segments(self, summaries):
+        """ Append the record to the open segment of each consumer """
+
+        max_size = self.rsv.config.getint("rsv", "spool-segment-size")
+        for (name, time_format, output_dir) in self.get_consumers():
+            record = summaries.get(time_format, summaries[""])
+            try:
+                append_record(output_dir, record, max_size)
+                self.rsv.log("INFO", "Appended record for %s consumer to '%s'" %
+                             (name, os.path.join(output_dir, OPEN_SEGMENT)))
+            except (IOError, OSError), err:
+                self.rsv.log("WARNING", "Cannot write record for consumer '%s': %s" % (name, err))
+
+        return
+
+
+
+def frame_record(record):
+    """ Return record ending in exactly one 'EOT' line, which is how the consumers
+    tell the records in a segment apart """
+
+    record = record.strip("\r\n")
+    if record != "EOT" and not record.endswith("\nEOT"):
+        record += "\nEOT"
+    return record + "\n"
+
+
+def append_record(output_dir, record, max_size):
+    """ Append record to the open segment in output_dir, rotating the segment first
+    if it has reached max_size bytes.  The segment is locked while we write so that
+    the consumer never claims it in the middle of a record. """
+
+    record = frame_record(record)
+    path = os.path.join(output_dir, OPEN_SEGMENT)
+    while 1:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            # The segment may have been rotated or claimed while we waited for the
+            # lock, in which case we need to open the new one
+            try:
+                current = os.stat(path)
+            except OSError:
+                continue
+            opened = os.fstat(fd)
+            if (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino):
+                continue
+
+            if max_size > 0 and opened.st_size > 0 and opened.st_size + len(record) > max_size:
+                os.rename(path, os.path.join(output_dir, segment_name()))
+                continue
+
+            os.write(fd, record)
+            return
+        finally:
+            os.close(fd)
+
+
+def segment_name():
+    """ Return a name for a closed segment.  Names sort in the order that the
+    segments were closed. """
+    return "segment-%017.6f-%d.seg" % (time.time(), os.getpid())
+
+
+def link_into(staged, output_dir):
+    """ Hardlink staged into output_dir.  Return the new path, or None on failure """
+
+    basename = os.path.basename(staged)
+    file_path = os.path.join(output_dir, basename)
+    suffix = 0
+    while 1:
+        try:
+            os.link(staged, file_path)
+            return file_path
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                return None
+        suffix += 1
+        file_path = os.path.join(output_dir, "%s.%s" % (basename, suffix))
+
+
+def write_into(record, output_dir, prefix):
+    """ Write record into output_dir under a temporary name starting with '.' (which
+    consumers skip) and rename it into place.  Return the new path, or None on failure """
+
+    temp_path = None
+    try:
+        (file_handle, temp_path) = tempfile.mkstemp(prefix="." + prefix, dir=output_dir)
+        try:
+            os.write(file_handle, record)
+        finally:
+            os.close(file_handle)
+
+        file_path = os.path.join(output_dir, os.path.basename(temp_path)[1:])
+        os.rename(temp_path, file_path)
+        return file_path
+    except (IOError, OSError):
+        if temp_path:
+            remove(temp_path)
+        return None
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -5,16 +5,429 @@ import os
 import re
 import sys
 import time
+import errno
+import fcntl
+import select
 import signal
 import subprocess
 
 class TimeoutError(Exception):
     """ This defines an Exception that we can use if our system call times out """
     pass
-            
 
-def alarm_handler(signum, frame):
-    raise TimeoutError("System call timed out")
+
+# Put in place of the output that a BoundedOutputBuffer did not keep
+OMITTED_OUTPUT = "\n[RSV: %d bytes of output omitted%s]\n"
+OMITTED_OUTPUT_PATTERN = re.compile(r"\[RSV: (\d+) bytes of output omitted(?:; full output in (\S+))?\]")
+
+
+class OutputBuffer:
+    """ Collects the output read from one stream of a child process.  The
+    Supervisor writes to it as output arrives and closes it at EOF, so other
+    ways of storing output can be swapped in (see BoundedOutputBuffer). """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        pass
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+
+class BoundedOutputBuffer(OutputBuffer):
+    """ Keeps only the first and the last limit bytes of a stream, and counts the
+    bytes in between, so a runaway command cannot use up our memory.  If spill_path
+    is given, the whole stream is also written to that file once it goes over limit
+    bytes, and the file is removed again if nothing had to be left out. """
+
+    def __init__(self, limit, spill_path=None):
+        self.limit = limit
+        self.spill_path = spill_path
+        self.spill = None
+        self.head = []
+        self.head_size = 0
+        self.tail = []
+        self.tail_size = 0
+        self.size = 0
+
+
+    def write(self, data):
+        self.size += len(data)
+
+        if self.head_size < self.limit:
+            part = data[:self.limit - self.head_size]
+            self.head.append(part)
+            self.head_size += len(part)
+            data = data[len(part):]
+            if not data:
+                return
+
+        if self.spill_path:
+            self.write_spill(data)
+
+        self.tail.append(data)
+        self.tail_size += len(data)
+        # Drop whole chunks that are no longer part of the last limit bytes
+        while self.tail_size - len(self.tail[0]) >= self.limit:
+            self.tail_size -= len(self.tail.pop(0))
+
+
+    def write_spill(self, data):
+        if self.spill is None:
+            try:
+                self.spill = open(self.spill_path, 'w')
+            except IOError:
+                # Carry on without it.  getvalue() will not mention the file.
+                self.spill_path = None
+                return
+            # The file is opened once the head is full, so it starts with the head
+            self.spill.write("".join(self.head))
+        self.spill.write(data)
+
+
+    def omitted(self):
+        """ Return the number of bytes that were left out """
+        return self.size - self.head_size - min(self.tail_size, self.limit)
+
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            if self.omitted() == 0:
+                try:
+                    os.remove(self.spill_path)
+                except OSError:
+                    pass
+                self.spill_path = None
+
+
+    def getvalue(self):
+        tail = "".join(self.tail)
+        if len(tail) > self.limit:
+            tail = tail[-self.limit:]
+
+        omitted = self.omitted()
+        if omitted == 0:
+            return "".join(self.head) + tail
+
+        spilled = ""
+        if self.spill_path:
+            spilled = "; full output in %s" % self.spill_path
+        return "".join(self.head) + OMITTED_OUTPUT % (omitted, spilled) + tail
+
+
+class ChildProcess:
+    """ A command started by the Supervisor """
+
+    def __init__(self, command, timeout, env=None, stdout=None, stderr=None):
+        self.command = command
+        self.timeout = timeout
+        self.env = env
+        self.popen = None
+        self.pid = None
+        self.deadline = None
+        self.returncode = None
+        self.timed_out = False
+        self.stdout = stdout or OutputBuffer()
+        self.stderr = stderr or OutputBuffer()
+
+
+    def finished(self):
+        """ Return True once the process has exited and been reaped """
+        return self.returncode is not None
+
+
+    def get_stdout(self):
+        return self.stdout.getvalue()
+
+
+    def get_stderr(self):
+        return self.stderr.getvalue()
+
+
+
+class Supervisor:
+    """ Run many child processes at the same time, each with its own timeout.
+
+    The STDOUT and STDERR of every child are read through a single poll/select
+    loop, so no signals (e.g. SIGALRM) are needed and any number of commands can
+    be timed at once.  Each child is started in its own process group so that a
+    timeout kills everything the command started, not just the top process. """
+
+    read_size = 65536
+
+    def __init__(self, rsv):
+        self.rsv = rsv
+        self.children = []
+        self.fds = {}
+
+
+    def spawn(self, command, timeout=None, env=None, stdout=None, stderr=None):
+        """ Start a command and return its ChildProcess.  A timeout of None or 0
+        means that the command can run forever.  The output is collected in stdout
+        and stderr, which default to new OutputBuffers. """
+
+        child = ChildProcess(command, timeout, env, stdout, stderr)
+        child.popen = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, env=env, preexec_fn=os.setpgrp,
+                                       close_fds=True)
+        child.pid = child.popen.pid
+        child.popen.stdin.close()
+        if timeout:
+            child.deadline = time.time() + timeout
+
+        for (stream, sink) in ((child.popen.stdout, child.stdout), (child.popen.stderr, child.stderr)):
+            fd = stream.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self.fds[fd] = (child, stream, sink)
+
+        self.children.append(child)
+        return child
+
+
+    def run(self):
+        """ Wait until every child has finished (or been killed for timing out) """
+
+        while 1:
+            running = [child for child in self.children if not child.finished()]
+            if not running:
+                break
+
+            # Sleep until there is output or the next deadline comes up.  If a child
+            # closed its output but has not exited we need to check on it periodically.
+            wait = None
+            now = time.time()
+            for child in running:
+                if child.deadline is not None:
+                    remaining = max(0, child.deadline - now)
+                    if wait is None or remaining < wait:
+                        wait = remaining
+                if not self.child_has_open_fds(child):
+                    if wait is None or wait > 0.1:
+                        wait = 0.1
+
+            for fd in self.wait_for_output(wait):
+                self.read_fd(fd)
+
+            now = time.time()
+            for child in running:
+                if child.deadline is not None and now >= child.deadline:
+                    self.kill(child)
+                elif not self.child_has_open_fds(child):
+                    child.returncode = child.popen.poll()
+
+        return
+
+
+    def child_has_open_fds(self, child):
+        for (owner, stream, sink) in self.fds.values():
+            if owner is child:
+                return True
+        return False
+
+
+    def wait_for_output(self, timeout):
+        """ Return the list of fds with data (or EOF) waiting to be read """
+
+        if not self.fds:
+            if timeout:
+                time.sleep(timeout)
+            return []
+
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            for fd in self.fds.keys():
+                poller.register(fd, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR)
+            if timeout is not None:
+                timeout = int(timeout * 1000)
+            try:
+                return [fd for (fd, event) in poller.poll(timeout)]
+            except select.error, err:
+                if err[0] == errno.EINTR:
+                    return []
+                raise
+        else:
+            try:
+                return select.select(self.fds.keys(), [], [], timeout)[0]
+            except select.error, err:
+                if err[0] == errno.EINTR:
+                    return []
+                raise
+
+
+    def read_fd(self, fd):
+        """ Read whatever is available on fd, closing it on EOF """
+
+        (child, stream, sink) = self.fds[fd]
+        while 1:
+            try:
+                data = os.read(fd, self.read_size)
+            except OSError, err:
+                if err.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+
+            if not data:
+                stream.close()
+                sink.close()
+                del self.fds[fd]
+                return
+
+            sink.write(data)
+
+
+    def kill(self, child):
+        """ Kill the whole process group of a child that ran out of time """
+
+        child.timed_out = True
+        try:
+            os.killpg(child.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+        for fd in self.fds.keys():
+            (owner, stream, sink) = self.fds[fd]
+            if owner is child:
+                stream.close()
+                sink.close()
+                del self.fds[fd]
+
+        child.returncode = child.popen.wait()
+        return
+
+
+# Shortest sleep between checks of a log when inotify is not available
+MIN_POLL_INTERVAL = 0.1
+
+# inotify is Linux specific and we reach it through libc.  If it is not there
+# (or ctypes is not available) we fall back to polling.
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+    _libc.inotify_init
+    _libc.inotify_add_watch
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+
+
+class Inotify:
+    """ A minimal inotify watch on a single path """
+
+    def __init__(self, path, mask):
+        self.fd = _libc.inotify_init()
+        if self.fd < 0:
+            raise OSError("inotify_init failed")
+        if _libc.inotify_add_watch(self.fd, path, mask) < 0:
+            os.close(self.fd)
+            raise OSError("inotify_add_watch failed for '%s'" % path)
+
+
+    def fileno(self):
+        return self.fd
+
+
+    def wait(self, timeout):
+        """ Wait up to timeout seconds for an event.  Return True if there was one. """
+        try:
+            ready = select.select([self.fd], [], [], timeout)[0]
+        except select.error, err:
+            if err[0] == errno.EINTR:
+                return False
+            raise
+
+        if ready:
+            self.drain()
+            return True
+        return False
+
+
+    def drain(self):
+        """ Throw away the pending events.  We only care that something happened. """
+        try:
+            os.read(self.fd, 65536)
+        except OSError:
+            pass
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watch_file(path):
+    """ Return an Inotify watching path for writes, or None if that is not possible """
+    if _libc is None:
+        return None
+    try:
+        return Inotify(path, IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF)
+    except OSError:
+        return None
+
+
+class LogFollower:
+    """ Read a growing log file incrementally.  We remember how far into the file we
+    have read and only return complete lines, so a line that is in the middle of
+    being written is returned whole on a later read. """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.partial = ""
+        self.chunks = []
+
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+
+    def read(self):
+        """ Return the complete lines appended since the last call ("" if none) """
+
+        try:
+            fd = open(self.path, 'r')
+        except IOError:
+            return ""
+
+        try:
+            size = os.fstat(fd.fileno()).st_size
+            if size < self.offset:
+                # The file was truncated or replaced.  Start over.
+                self.offset = 0
+                self.partial = ""
+                self.chunks = []
+            if size == self.offset:
+                return ""
+            fd.seek(self.offset)
+            data = fd.read(size - self.offset)
+        finally:
+            fd.close()
+
+        self.offset += len(data)
+        data = self.partial + data
+        end = data.rfind("\n") + 1
+        self.partial = data[end:]
+        new_text = data[:end]
+        if new_text:
+            self.chunks.append(new_text)
+        return new_text
+
+
+    def get_contents(self):
+        """ Return everything read so far """
+        return "".join(self.chunks) + self.partial
 
 
 class Sysutils:
@@ -24,32 +437,25 @@ class Sysutils:
         self.rsv = rsv
 
 
-    def system(self, command, timeout):
-        """ Run a system command with a timeout specified (in seconds).
+    def system(self, command, timeout, env=None, stdout=None, stderr=None):
+        """ Run a system command with a timeout specified (in seconds).  The output
+        is collected in the stdout and stderr buffers if they are given.
         Returns:
           1) exit code
           2) STDOUT
           3) STDERR
         """
 
-        p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        signal.signal(signal.SIGALRM, alarm_handler)
-        signal.alarm(timeout)
-        try:
-            (stdout, stderr) = p.communicate()
-            signal.alarm(0)
-        except TimeoutError:
-            # p.kill() is new in Python 2.6 and we support Python 2.4 so we need to have a fallback
-            if hasattr(p, "kill"):
-                p.kill()
-            else:
-                os.kill(p.pid, signal.SIGKILL)
-                
+        supervisor = Supervisor(self.rsv)
+        child = supervisor.spawn(command, timeout, env, stdout, stderr)
+        supervisor.run()
+
+        if child.timed_out:
             self.rsv.log("ERROR", "Command timed out (timeout=%s): %s" % (timeout, command))
             raise TimeoutError("Command timed out (timeout=%s)" % timeout)
 
-        self.rsv.log("INFO", "Exit code of job: %s" % p.returncode)
-        return p.returncode, stdout, stderr
+        self.rsv.log("INFO", "Exit code of job: %s" % child.returncode)
+        return child.returncode, child.get_stdout(), child.get_stderr()
 
 
     def switch_user(self, user, desired_uid, desired_gid):
@@ -81,39 +487,74 @@ class Sysutils:
 
 
     def watch_log(self, log_path, keywords, timeout=300, sleep_interval=10):
-        """ Watch the specified log for the keywords.  Return the keyword that matches. """
+        """ Watch the specified log for the keywords.  Return the keyword that matches
+        and the contents of the log.
+
+        Only the bytes appended since the last read are examined, so each check is
+        cheap no matter how large the log gets.  On Linux we sleep on inotify and wake
+        up as soon as the log is written.  Elsewhere we poll with a backoff that starts
+        small and grows to sleep_interval while the log is quiet. """
 
         self.rsv.log("DEBUG", "Watching log '%s' for keywords [%s].  Timeout is %ss" %
                      (log_path, ', '.join(keywords), timeout))
 
-        start_time = int(time.time())
-        mtime = 0
+        patterns = [(keyword, re.compile(keyword)) for keyword in keywords]
+        follower = LogFollower(log_path)
+        notifier = watch_file(log_path)
+        if notifier is None:
+            self.rsv.log("DEBUG", "inotify is not available.  Polling log '%s'" % log_path)
 
-        while 1:
-            if int(time.time()) - start_time >= timeout:
-                raise TimeoutError("Timeout while watching log (%ss)" % timeout)
-            
-            new_mtime = os.stat(log_path).st_mtime
-            if new_mtime != mtime:
-                mtime = new_mtime
-                contents = self.slurp(log_path)
+        deadline = time.time() + int(timeout)
+        backoff = MIN_POLL_INTERVAL
+        try:
+            while 1:
+                new_text = follower.read()
+                if new_text:
+                    for (keyword, pattern) in patterns:
+                        if pattern.search(new_text):
+                            return keyword, follower.get_contents()
+                    backoff = MIN_POLL_INTERVAL
 
-                for keyword in keywords:
-                    if re.search(keyword, contents):
-                        return keyword, contents
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("Timeout while watching log (%ss)" % timeout)
+
+                if notifier is None and _libc is not None and follower.exists():
+                    # The log did not exist when we started.  Now we can watch it.
+                    notifier = watch_file(log_path)
+
+                if notifier is not None:
+                    # Still wake up every sleep_interval in case an event was missed
+                    notifier.wait(min(remaining, sleep_interval))
+                else:
+                    time.sleep(min(remaining, backoff))
+                    backoff = min(backoff * 2, sleep_interval)
+        finally:
+            if notifier is not None:
+                notifier.close()
 
-            time.sleep(sleep_interval)
-        
         return None, None
     
 
-    def slurp(self, file, must_exist=0):
-        """ Given a path, read the contents of that file """
+    def slurp(self, file, must_exist=0, buffer=None):
+        """ Given a path, read the contents of that file.  If buffer is given the
+        file is read through it (e.g. a BoundedOutputBuffer) a block at a time. """
         self.rsv.log("DEBUG", "Slurping file '%s'" % file)
         
         try:
             f = open(file, 'r')
-            contents = f.read()
+            if buffer is None:
+                contents = f.read()
+            else:
+                try:
+                    while 1:
+                        data = f.read(Supervisor.read_size)
+                        if not data:
+                            break
+                        buffer.write(data)
+                finally:
+                    buffer.close()
+                contents = buffer.getvalue()
             f.close()
         except IOError, err:
             print "Error: %s" % err
@@ -3,7 +3,6 @@
 import os
 import re
 
-import Host
 import Table
 import Condor
 import Metric
@@ -136,8 +135,11 @@ def profile(rsv):
     """ Run the rsv-profiler """
     print "Running the rsv-profiler..."
     profiler = os.path.join("/", "usr", "libexec", "rsv", "misc", "rsv-profiler")
-    sysutils = Sysutils.Sysutils(rsv)
-    (ret, out, err) = sysutils.system([profiler], timeout=100)
+    try:
+        (ret, out, err) = rsv.run_command([profiler], timeout=100)
+    except Sysutils.TimeoutError, err:
+        print "ERROR running rsv-profiler: %s" % err
+        return False
 
     if ret == 0:
         print out
@@ -170,7 +172,7 @@ def dispatcher(rsv, action, options, jobs=None):
     # and stopping, but not to enabling and disabling (since we couldn't know the
     # metric list in those cases)
     if action in ('start', 'stop') and hostname and not jobs:
-        host = Host.Host(hostname, rsv)
+        host = rsv.get_host(hostname)
         jobs = host.get_enabled_metrics()
 
 
@@ -201,7 +203,7 @@ def dispatcher(rsv, action, options, jobs=None):
 
         host = None
         if hostname:
-            host = Host.Host(hostname, rsv)
+            host = rsv.get_host(hostname)
 
         num_errors = 0
         write_config_file = False
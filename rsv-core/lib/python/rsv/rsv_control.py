@@ -21,7 +21,7 @@ def process_options(arguments=None):
     Level settings - 0=print nothing, 1=normal, 2=info, 3=debug
 
     Run a one-time test:
-    --run [--all-enabled] [--gatekeeper-type|--gk-type gram|condor-ce|cream|nordugrid] --host <HOST> METRIC [METRIC ...]
+    --run [--all-enabled] [--jobs N] [--gatekeeper-type|--gk-type gram|condor-ce|cream|nordugrid] --host <HOST> METRIC [METRIC ...]
     --test (same options and behavior as --run but w/o generating records)
     
     Show information about enabled and installed metrics:
@@ -59,7 +59,10 @@ def process_options(arguments=None):
                      help="Same as --run but do not generate records " +
                           "(therefore nothing goes to Gratia, HTML page, etc).")
     group.add_option("--all-enabled", action="store_true", dest="all_enabled", default=False,
-                     help="Run all enabled metrics serially.")
+                     help="Run all enabled metrics.")
+    group.add_option("-J", "--jobs", dest="jobs", default=None, type="int", metavar="N",
+                     help="Run up to N metrics in parallel (with --run).  Overrides parallel-jobs " +
+                     "in rsv.conf.")
     group.add_option("--extra-config-file", dest="extra_config_file", default=None,
                      help="Path to another INI-format file containing metric configuration (with --run)")
     parser.add_option_group(group)
@@ -151,6 +154,9 @@ def process_options(arguments=None):
             parser.error("You must provide a list of metrics to run or else pass the " +
                          "--all-enabled flag to run all enabled metrics")
 
+    if options.jobs is not None and options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     if options.ce_type and options.ce_type not in ('gram', 'condor-ce', 'htcondor-ce', 'cream', 'nordugrid'):
         parser.error("Invalid value for --ce-type. "
                      "Valid values are 'gram' for Globus GRAM, 'htcondor-ce' (or 'condor-ce') for HTCondor-CE, 'cream' for CREAM-CE and 'nordugrid' for Nordugrid")
@@ -5,48 +5,122 @@ import re
 import os
 import pwd
 import sys
-import copy
+import time
 import shutil
 import tempfile
 
 # RSV libraries
 import RSV
 import Metric
+import Condor
 import CondorG
+import JobPool
+import CondorEvents
+import Reachability
 import Sysutils
 import CondorVanilla
 
+try: # Python 2.5 and later
+    from hashlib import md5
+except ImportError: # Python 2.4
+    from md5 import new as md5
+
+# globus-job-run bundles are built once for each version of a metric's files and
+# reused from here (see prepare_shar_file)
+SHAR_CACHE_DIR = os.path.join("/", "var", "tmp", "rsv", "shar-cache")
+
+# Bundles that have not been used for this long are removed
+SHAR_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+# Bundles for an older version of a metric are removed sooner, but not right away
+# in case a running globus-job-run is still about to read one
+SHAR_CACHE_REPLACED_AGE = 60 * 60
+
+# The perl wrapper that unpacks the shar archive on the remote host and runs the metric
+SHAR_HEADER = """#!/usr/bin/env perl
+
+use strict;
+use warnings;
+use File::Temp;
+
+if(system("which uudecode >/dev/null 2>&1") != 0) {
+    print "RSV BRIEF RESULTS:\n";
+    print "UNKNOWN\n";
+    print "Cannot extract the shar file on remote system because uudecode is missing.\n";
+    print "To solve this, install uudecode (provided by the sharutils RPM) on the remote system you are monitoring.\n";
+    exit 0;    
+}
+
+my $temp_dir = mkdtemp("rsv-shar-XXXXXXXX");
+chdir($temp_dir);
+my $out_file = "shar.sh";
+
+my $shar = join "", <DATA>;
+open(OUT, '>', $out_file) or die("cannot write to $out_file: $!");
+print OUT $shar;
+close(OUT);
+
+my $ret = system("/bin/sh shar.sh >shar.out 2>&1");
+if($ret != 0) {
+    print "RSV BRIEF RESULTS:\n";
+    print "UNKNOWN\n";
+    print "Failed to extract shar file.\n";
+    system("cat shar.out");
+}
+else {
+    system("./%s @ARGV");
+    chdir("..");
+    system("rm -fr $temp_dir");
+}
+
+__DATA__"""
+
 
 def ping_test(rsv, metric):
     """ Ping the remote host to make sure it's alive before we attempt
-    to run jobs """
-
-    uri = metric.host
-    if uri.find(":") > 0:
-        (host, port) = re.split(":", uri, 1)
-    else:
-        host = uri
+    to run jobs.  The result may come from an earlier check of the same host
+    (see check_reachability). """
 
+    host = Reachability.split_uri(metric.host)[0]
     rsv.log("INFO", "Pinging host %s:" % host)
 
-    # Send a single ping, with a timeout.  We just want to know if we can reach
-    # the remote host, we don't care about the latency unless it exceeds the timeout
-    cmd = ["/bin/ping", "-W", "3", "-c", "1", host]
-    try:
-        (ret, out, err) = rsv.run_command(cmd)
-    except Sysutils.TimeoutError, err:
-        rsv.results.ping_timeout(metric, " ".join(cmd), err)
+    status = rsv.reachability.get_status(metric.host)
+    if status.timed_out:
+        rsv.results.ping_timeout(metric, status.command, status.stderr)
         sys.exit(1)
 
     # If we can't ping the host, don't bother doing anything else
-    if ret:
-        rsv.results.ping_failure(metric, out, err)
+    if not status.reachable:
+        rsv.results.ping_failure(metric, status.stdout, status.stderr)
         sys.exit(1)
         
     rsv.log("INFO", "Ping successful", 4)
     return
 
 
+def check_reachability(rsv, options, hosts):
+    """ Check every host that will be pinged before any metric runs.  The hosts are
+    probed at the same time and each host only once, however many metrics run
+    against it. """
+
+    if options.no_ping or rsv.get_ping_cache_ttl() <= 0:
+        return
+
+    uris = []
+    for host in hosts:
+        for metric_name in hosts[host]:
+            try:
+                metric = Metric.Metric(metric_name, rsv, host, options)
+            except SystemExit:
+                continue
+            if metric.config_getboolean('no-ping') != True:
+                uris.append(metric.host)
+                break
+
+    rsv.reachability.check(uris)
+    return
+
+
 
 def parse_job_output(rsv, metric, stdout, stderr):
     """ Parse the job output from the worker script """
@@ -109,8 +183,8 @@ def parse_job_output_brief(rsv, metric, stdout, stderr):
 
         # We want to display the trimmed output
         # TODO - display non-trimmed output if we are in -v3 mode?
-        trim_length = rsv.config.get("rsv", "details-data-trim-length")
-        if not rsv.quiet:
+        trim_length = rsv.config.getint("rsv", "details-data-trim-length")
+        if not rsv.quiet and trim_length > 0:
             rsv.echo("Displaying first %s bytes of output" % trim_length, 1)
             stdout = stdout[:trim_length]
         else:
@@ -119,7 +193,9 @@ def parse_job_output_brief(rsv, metric, stdout, stderr):
         rsv.echo(stdout)
 
         rsv.echo("STDERR from metric:")
-        rsv.echo(stderr[:trim_length])
+        if trim_length > 0:
+            stderr = stderr[:trim_length]
+        rsv.echo(stderr)
 
         sys.exit(1)
 
@@ -166,18 +242,14 @@ def execute_local_job(rsv, metric):
     # can take a long time to run (many times longer than the average metric)
     job_timeout = metric.get_timeout()
 
-    original_environment = copy.copy(os.environ)
-    setup_job_environment(rsv, metric)
-
     try:
-        (ret, out, err) = rsv.run_command(job, job_timeout)
+        (ret, out, err) = rsv.run_command(job, job_timeout, metric.get_job_environment(),
+                                          rsv.get_output_buffer(metric, "stdout"),
+                                          rsv.get_output_buffer(metric, "stderr"))
     except Sysutils.TimeoutError, err:
-        os.environ = original_environment
         rsv.results.job_timed_out(metric, " ".join(job), err)
         return
 
-    os.environ = original_environment
-
     if ret:
         rsv.results.local_job_failed(metric, " ".join(job), out, err)
         return
@@ -201,8 +273,8 @@ def execute_grid_job(rsv, metric):
 
     # If the probe depends on any modules we need to prepare a SHAR file to send
     # because globus-job-run can only send one file (it can't send supporting libraries)
-    (shar_dir, shar_file) = prepare_shar_file(rsv, metric)
-    if not shar_dir:
+    shar_file = prepare_shar_file(rsv, metric)
+    if not shar_file:
         return
 
     job = ["globus-job-run", "%s/jobmanager-%s" % (metric.host, jobmanager),
@@ -219,20 +291,14 @@ def execute_grid_job(rsv, metric):
     # can take a long time to run (many times longer than the average metric)
     job_timeout = metric.get_timeout()
 
-    original_environment = copy.copy(os.environ)
-    setup_job_environment(rsv, metric)
-
     try:
-        (ret, out, err) = rsv.run_command(job, job_timeout)
+        (ret, out, err) = rsv.run_command(job, job_timeout, metric.get_job_environment(),
+                                          rsv.get_output_buffer(metric, "stdout"),
+                                          rsv.get_output_buffer(metric, "stderr"))
     except Sysutils.TimeoutError, err:
-        os.environ = original_environment
-        shutil.rmtree(shar_dir)
         rsv.results.job_timed_out(metric, " ".join(job), err)
         return
 
-    os.environ = original_environment
-    shutil.rmtree(shar_dir)
-
     if ret:
         rsv.results.grid_job_failed(metric, " ".join(job), out, err)
 
@@ -241,203 +307,219 @@ def execute_grid_job(rsv, metric):
 
 
 def prepare_shar_file(rsv, metric):
-    """ Create a shar file wrapped in a perl script to be used with globus-job-run.
+    """ Return the path of a shar file wrapped in a perl script to be used with
+    globus-job-run, or None if it cannot be made.
 
     globus-job-run can only send one file, so we will wrap up all the files into a
     sh archive.  But after unshar'ing we need to execute one of the files so we will
-    use a perl script to do the extraction followed by executing the necessary script """
+    use a perl script to do the extraction followed by executing the necessary script.
+
+    The bundle only depends on the metric's name and files, so it is kept in
+    SHAR_CACHE_DIR under a digest of them and only rebuilt when one of them changes. """
 
     # Check for shar
     utils = Sysutils.Sysutils(rsv)
     path = utils.which("shar")
     if not path:
         rsv.results.shar_not_installed(metric)
-        return None, None
-
-    # Make a temporary path to create the shar file
-    parent_dir = os.path.join("/", "var", "tmp", "rsv")
-    if not os.path.exists(parent_dir):
-        # /var/tmp/rsv can be periodically deleted by system cleanup utilities so we sometimes
-        # have to re-create it
-        os.mkdir(parent_dir, 0755)
-        (uid, gid) = pwd.getpwnam('rsv')[2:4]
-        os.chown(parent_dir, uid, gid)
-    tempdir = tempfile.mkdtemp(prefix="shar-", dir=parent_dir)
-    shar_file = os.path.join(tempdir, "shar.pl")
-
-    # Make a perl header for the shar file
-    f = open(shar_file, 'w')
-    f.write("""#!/usr/bin/env perl
+        return None
 
-use strict;
-use warnings;
-use File::Temp;
+    files = [metric.executable] + (metric.get_transfer_files() or [])
+    shar_file = os.path.join(SHAR_CACHE_DIR, "%s-%s.pl" % (metric.name, shar_digest(metric.name, files)))
+    if os.path.exists(shar_file):
+        rsv.log("INFO", "Using cached shar file '%s'" % shar_file)
+        # Mark it as recently used so that it is not pruned
+        try:
+            os.utime(shar_file, None)
+        except OSError:
+            pass
+        return shar_file
 
-if(system("which uudecode >/dev/null 2>&1") != 0) {
-    print "RSV BRIEF RESULTS:\n";
-    print "UNKNOWN\n";
-    print "Cannot extract the shar file on remote system because uudecode is missing.\n";
-    print "To solve this, install uudecode (provided by the sharutils RPM) on the remote system you are monitoring.\n";
-    exit 0;    
-}
-
-my $temp_dir = mkdtemp("rsv-shar-XXXXXXXX");
-chdir($temp_dir);
-my $out_file = "shar.sh";
-
-my $shar = join "", <DATA>;
-open(OUT, '>', $out_file) or die("cannot write to $out_file: $!");
-print OUT $shar;
-close(OUT);
-
-my $ret = system("/bin/sh shar.sh >shar.out 2>&1");
-if($ret != 0) {
-    print "RSV BRIEF RESULTS:\n";
-    print "UNKNOWN\n";
-    print "Failed to extract shar file.\n";
-    system("cat shar.out");
-}
-else {
-    system("./%s @ARGV");
-    chdir("..");
-    system("rm -fr $temp_dir");
-}
-
-__DATA__""" % metric.name)
-    f.close()
+    make_shar_cache_dir()
 
     # Create the shar file
-    transfer_files = metric.get_transfer_files()
-    cmd = ["shar", "-f", metric.executable] + transfer_files
+    cmd = ["shar", "-f"] + files
     (ret, out, err) = rsv.run_command(cmd)
     if ret != 0:
         rsv.results.shar_creation_failed(metric, out, err)
-        return None, None
+        return None
+
+    # Write the bundle under a temporary name and rename it into place so that other
+    # processes never see a partial bundle
+    (fd, temp_path) = tempfile.mkstemp(prefix=".%s-" % metric.name, dir=SHAR_CACHE_DIR)
+    f = os.fdopen(fd, 'w')
+    try:
+        f.write(SHAR_HEADER % metric.name)
+        f.write(out)
+    finally:
+        f.close()
+    os.chmod(temp_path, 0644)
+    os.rename(temp_path, shar_file)
+    rsv.log("INFO", "Created shar file '%s'" % shar_file)
+
+    prune_shar_cache(rsv, shar_file)
+    return shar_file
+
+
+def shar_digest(metric_name, files):
+    """ Return a digest of everything that goes into a metric's shar bundle """
+
+    digest = md5()
+    digest.update(SHAR_HEADER % metric_name)
+    for path in files:
+        digest.update("\0%s\0" % path)
+        try:
+            f = open(path, 'rb')
+            try:
+                digest.update(f.read())
+            finally:
+                f.close()
+        except IOError, err:
+            # shar will fail on this file too, and a failed bundle is not cached
+            digest.update(str(err))
+    return digest.hexdigest()
+
+
+def make_shar_cache_dir():
+    """ Create SHAR_CACHE_DIR if it does not exist """
+
+    parent_dir = os.path.dirname(SHAR_CACHE_DIR)
+    for path in (parent_dir, SHAR_CACHE_DIR):
+        if not os.path.exists(path):
+            # /var/tmp/rsv can be periodically deleted by system cleanup utilities so we sometimes
+            # have to re-create it
+            os.mkdir(path, 0755)
+            (uid, gid) = pwd.getpwnam('rsv')[2:4]
+            os.chown(path, uid, gid)
+    return
+
+
+def prune_shar_cache(rsv, current):
+    """ Remove bundles that have not been used for SHAR_CACHE_MAX_AGE seconds, and
+    bundles for older versions of the current metric that have not been used for
+    SHAR_CACHE_REPLACED_AGE seconds """
+
+    now = time.time()
+    prefix = os.path.basename(current)[:-len(".pl")].rsplit("-", 1)[0] + "-"
+    for entry in os.listdir(SHAR_CACHE_DIR):
+        path = os.path.join(SHAR_CACHE_DIR, entry)
+        if path == current:
+            continue
+
+        max_age = SHAR_CACHE_MAX_AGE
+        if entry.startswith(prefix) and entry.endswith(".pl") and \
+               len(entry) == len(os.path.basename(current)):
+            max_age = SHAR_CACHE_REPLACED_AGE
+
+        try:
+            if now - os.stat(path).st_mtime > max_age:
+                rsv.log("INFO", "Removing old shar file '%s'" % path)
+                os.remove(path)
+        except OSError:
+            # Another process may have removed it already
+            pass
+    return
 
-    f = open(shar_file, 'a')
-    f.write(out)
-    f.close()
 
-    return tempdir, shar_file
-    
-def execute_condor_vanilla_job(rsv,metric):
+def execute_condor_vanilla_job(rsv, metric):
     """ Execute a Vanilla job """
-    # Submit the job                                                                                                                                                              
-    condorvanilla = CondorVanilla.CondorVanilla(rsv)
 
-    attrs = {}
-    if rsv.get_extra_globus_rsl():
-        attrs["globus_rsl"] = rsv.get_extra_globus_rsl()
+    execute_condor_job(rsv, metric, CondorVanilla.CondorVanilla(rsv))
+    return
 
-    original_environment = copy.copy(os.environ)
-    setup_job_environment(rsv, metric)
 
-    ret = condorvanilla.submit(metric, attrs)
+def execute_condor_g_job(rsv, metric):
+    """ Execute a remote job via Condor-G.  This is the preferred format so that we
+    can support both Globus and CREAM """
+
+    execute_condor_job(rsv, metric, CondorG.CondorG(rsv))
+    return
 
-    os.environ = original_environment
 
+def execute_condor_job(rsv, metric, job):
+    """ Submit a job using a CondorG (or CondorVanilla) object and wait for it """
 
-    if not ret:
+    if not submit_condor_job(rsv, metric, job):
         rsv.results.condor_g_globus_submission_failed(metric)
         return
 
-    ret = condorvanilla.wait()
+    handle_condor_result(rsv, metric, job, job.wait())
+    return
 
-    if ret == 0:
-        parse_job_output(rsv, metric, condorvanilla.get_stdout(), condorvanilla.get_stderr())
-    elif ret == 1:
-        rsv.results.condor_grid_job_aborted(metric, condorvanilla.get_log_contents())
-    elif ret == 2:
-        rsv.results.condor_grid_job_failed(metric, condorvanilla.get_stdout(), condorvanilla.get_stderr(), condorvanilla.get_log_contents())
-    elif ret == 3:
-        rsv.results.condor_g_globus_submission_failed(metric, condorvanilla.get_log_contents())
-    elif ret == 4:
-        rsv.results.condor_g_remote_gatekeeper_down(metric, condorvanilla.get_log_contents())
-    elif ret == 5:
-        rsv.results.job_timed_out(metric, "condor-g submission", "", info=condorvanilla.get_log_contents())
-    elif ret == 6:
-        rsv.results.job_was_held(metric, condorvanilla.get_log_contents())
 
-    return
+def submit_condor_job(rsv, metric, job):
+    """ Submit a metric using a CondorG (or CondorVanilla) object """
 
+    return job.submit(metric, get_condor_attrs(rsv))
 
-def execute_condor_g_job(rsv, metric):
-    """ Execute a remote job via Condor-G.  This is the preferred format so that we
-    can support both Globus and CREAM """
 
-    # Submit the job
-    condorg = CondorG.CondorG(rsv)
+def get_condor_attrs(rsv):
+    """ Return the custom submit file attributes for Condor jobs """
 
     attrs = {}
     if rsv.get_extra_globus_rsl():
         attrs["globus_rsl"] = rsv.get_extra_globus_rsl()
+    return attrs
 
-    original_environment = copy.copy(os.environ)
-    setup_job_environment(rsv, metric)
-
-    ret = condorg.submit(metric, attrs)
-
-    os.environ = original_environment
-
-    if not ret:
-        rsv.results.condor_g_globus_submission_failed(metric)
-        return
 
-    ret = condorg.wait()
+def handle_condor_result(rsv, metric, job, ret):
+    """ Record the result of a finished Condor job.  ret is one of the codes
+    returned by CondorG.wait() """
 
     if ret == 0:
-        parse_job_output(rsv, metric, condorg.get_stdout(), condorg.get_stderr())
+        parse_job_output(rsv, metric, job.get_stdout(), job.get_stderr())
     elif ret == 1:
-        rsv.results.condor_grid_job_aborted(metric, condorg.get_log_contents())
+        rsv.results.condor_grid_job_aborted(metric, job.get_log_contents())
     elif ret == 2:
-        rsv.results.condor_grid_job_failed(metric, condorg.get_stdout(), condorg.get_stderr(), condorg.get_log_contents())
+        rsv.results.condor_grid_job_failed(metric, job.get_stdout(), job.get_stderr(), job.get_log_contents())
     elif ret == 3:
-        rsv.results.condor_g_globus_submission_failed(metric, condorg.get_log_contents())
+        rsv.results.condor_g_globus_submission_failed(metric, job.get_log_contents())
     elif ret == 4:
-        rsv.results.condor_g_remote_gatekeeper_down(metric, condorg.get_log_contents())
+        rsv.results.condor_g_remote_gatekeeper_down(metric, job.get_log_contents())
     elif ret == 5:
-        rsv.results.job_timed_out(metric, "condor-g submission", "", info=condorg.get_log_contents())
+        rsv.results.job_timed_out(metric, "condor-g submission", "", info=job.get_log_contents())
     elif ret == 6:
-        rsv.results.job_was_held(metric, condorg.get_log_contents())
+        rsv.results.job_was_held(metric, job.get_log_contents())
 
     return
 
 
-def setup_job_environment(rsv, metric):
-    """ Set the appropriate environment values that a metric expects """
+def run_one_metric(rsv, options, host, metric_name, count, total):
+    """ Perform the pre-flight checks for a single metric against a host, then run it """
 
-    rsv.log("INFO", "Setting up job environment:")
+    metric = Metric.Metric(metric_name, rsv, host, options)
+    preflight(rsv, options, metric)
 
-    env = metric.get_environment()
+    # Run the job and parse the result
+    echo_metric_header(rsv, metric, count, total)
+    execute_job(rsv, metric)
 
-    if not env:
-        rsv.log("INFO", "No environment setup declared", 4)
-        return
-    
-    for var in env.keys():
-        (action, value) = env[var]
-        action = action.upper()
-        rsv.log("INFO", "Var: '%s' Action: '%s' Value: '%s'" % (var, action, value), 4)
-        if action == "APPEND":
-            if var in os.environ:
-                os.environ[var] = os.environ[var] + ":" + value
-            else:
-                os.environ[var] = value
-            rsv.log("DEBUG", "New value of %s:\n%s" % (var, os.environ[var]), 8)
-        elif action == "PREPEND":
-            if var in os.environ:
-                os.environ[var] = value + ":" + os.environ[var]
-            else:
-                os.environ[var] = value
-            rsv.log("DEBUG", "New value of %s:\n%s" % (var, os.environ[var]), 8)
-        elif action == "SET":
-            os.environ[var] = value
-        elif action == "UNSET":
-            if var in os.environ:
-                del os.environ[var]
+    return
+
+
+def preflight(rsv, options, metric):
+    """ Check for some basic error conditions before running a metric.  This exits
+    if the metric should not be run. """
+
+    rsv.check_proxy(metric)
+
+    if options.no_ping:
+        rsv.log("INFO", "Skipping ping check because --no-ping was supplied")
+    elif metric.config_getboolean('no-ping') == True:
+        rsv.log("INFO", "Skipping ping check because metric config contains no-ping=True")
+    else:
+        ping_test(rsv, metric)
 
     return
 
+
+def echo_metric_header(rsv, metric, count, total):
+    if total > 1:
+        rsv.echo("\nRunning metric %s (%s of %s)\n" % (metric.name, count, total))
+    else:
+        rsv.echo("\nRunning metric %s:\n" % metric.name)
+
+
 def main(rsv, options, metrics):
     """ Main subroutine: directs program flow """
 
@@ -453,29 +535,192 @@ def main(rsv, options, metrics):
         total = len(metrics)
 
     RSV.validate_config(rsv)
+    check_reachability(rsv, options, hosts)
+
+    parallel_jobs = rsv.get_parallel_jobs()
+    if parallel_jobs > 1 and total > 1:
+        return run_parallel(rsv, options, hosts, total, parallel_jobs)
 
     # Process the command line and initialize
     count = 0
     for host in hosts:
         for metric_name in hosts[host]:
             count += 1
-            metric = Metric.Metric(metric_name, rsv, host, options)
+            run_one_metric(rsv, options, host, metric_name, count, total)
+
+    return True
 
-            # Check for some basic error conditions
-            rsv.check_proxy(metric)
 
-            if options.no_ping:
-                rsv.log("INFO", "Skipping ping check because --no-ping was supplied")
-            elif metric.config_getboolean('no-ping') == True:
-                rsv.log("INFO", "Skipping ping check because metric config contains no-ping=True")
-            else:
-                ping_test(rsv, metric)
+def run_parallel(rsv, options, hosts, total, parallel_jobs):
+    """ Run the metrics using a pool of parallel_jobs workers.  Each metric runs in
+    its own process and the number of metrics running against a single host at any
+    time is limited by parallel-jobs-per-host. """
+
+    per_host = rsv.get_parallel_jobs_per_host()
+    rsv.echo("Running %s metrics using %s parallel jobs (at most %s per host)" %
+             (total, parallel_jobs, per_host or "unlimited"))
 
-            # Run the job and parse the result
-            if total > 1:
-                rsv.echo("\nRunning metric %s (%s of %s)\n" % (metric.name, count, total))
+    pool = JobPool.JobPool(rsv, parallel_jobs, per_host)
+    batch = []
+    count = 0
+    for host in hosts:
+        for metric_name in hosts[host]:
+            count += 1
+            label = "%s on %s" % (metric_name, host)
+            if is_condor_metric(rsv, options, host, metric_name):
+                batch.append((host, label, metric_name, count))
             else:
-                rsv.echo("\nRunning metric %s:\n" % metric.name)
-            execute_job(rsv, metric)
+                pool.add(host, label, run_one_metric,
+                         rsv, options, host, metric_name, count, total)
+
+    # The loop above loaded the configuration of every metric.  Workers end with
+    # os._exit and would not save it, so write the new cache entries out once here.
+    Metric.config_cache.flush()
+
+    # Condor jobs are all submitted up front and run remotely while the local
+    # metrics run in the pool.  We then collect their results as they finish.
+    condor_batch = None
+    if batch:
+        condor_batch = CondorBatch(rsv, options, total)
+        condor_batch.submit(batch)
+
+    try:
+        pool.run()
+        if condor_batch:
+            condor_batch.collect(pool)
+    finally:
+        if condor_batch:
+            condor_batch.cleanup()
+
+    pool.summary()
 
     return True
+
+
+def is_condor_metric(rsv, options, host, metric_name):
+    """ Return True if the metric will be run as a Condor-G or vanilla Condor job """
+
+    try:
+        metric = Metric.Metric(metric_name, rsv, host, options)
+    except SystemExit:
+        # Let the pool run it so that the error is reported in the right place
+        return False
+
+    execute_type = (metric.config_get("execute") or "").lower()
+    if execute_type == "vanilla":
+        return True
+    if execute_type == "grid" and rsv.use_condor_g():
+        return True
+    return False
+
+
+
+class CondorBatch:
+    """ Submit many Condor-G and vanilla metrics at once and handle their results
+    as they complete.  All of the jobs share one user log which is followed by a
+    single CondorEvents.JobEventReader. """
+
+    def __init__(self, rsv, options, total):
+        self.rsv = rsv
+        self.options = options
+        self.total = total
+        self.tempdir = CondorG.make_temp_dir("condor_batch-")
+        self.log = os.path.join(self.tempdir, "jobs.log")
+        self.reader = CondorEvents.JobEventReader(rsv, self.log)
+        self.failed = []
+
+
+    def submit(self, batch):
+        """ Run the pre-flight checks for each metric in batch, which is a list of
+        (host, label, metric_name, count) tuples, and submit all of them with a single
+        condor_submit """
+
+        self.rsv.echo("Submitting %s metrics as Condor jobs" % len(batch))
+
+        attrs = get_condor_attrs(self.rsv)
+        prepared = []
+        for (host, label, metric_name, count) in batch:
+            start_time = time.time()
+            try:
+                metric = Metric.Metric(metric_name, self.rsv, host, self.options)
+                preflight(self.rsv, self.options, metric)
+
+                if metric.config_get("execute").lower() == "vanilla":
+                    job = CondorVanilla.CondorVanilla(self.rsv)
+                else:
+                    job = CondorG.CondorG(self.rsv)
+
+                description = job.prepare(metric, attrs, self.log)
+            except SystemExit, err:
+                self.failed.append((host, label, start_time, JobPool.exit_code_from_system_exit(err)))
+                continue
+
+            prepared.append((job, description, (host, label, count, metric, job, start_time)))
+
+        if not CondorG.submit_batch(self.rsv, [(job, description) for (job, description, info) in prepared], self.tempdir):
+            # One bad submit description fails the whole batch, so fall back to
+            # submitting the jobs one at a time
+            self.rsv.log("WARNING", "Batch submission failed.  Submitting the jobs individually.")
+            self.submit_individually(prepared)
+
+        for (job, description, info) in prepared:
+            (host, label, count, metric, job, start_time) = info
+            if not job.cluster_id:
+                echo_metric_header(self.rsv, metric, count, self.total)
+                self.rsv.results.condor_g_globus_submission_failed(metric)
+                self.failed.append((host, label, start_time, 1))
+                continue
+
+            job_timeout = metric.get_timeout() or self.rsv.config.get("rsv", "job-timeout")
+            self.reader.add_job(job.cluster_id, job.proc_id, info, job_timeout)
+
+        return
+
+
+    def submit_individually(self, prepared):
+        condor = Condor.Condor(self.rsv)
+        for (job, description, info) in prepared:
+            job.cluster_id = condor.submit_job(description + "Queue\n", job.metric.name, dir=job.tempdir, remove=0)
+            job.proc_id = 0
+
+
+    def collect(self, pool):
+        """ Wait for the submitted jobs and handle their results in the order they
+        finish.  Each metric is recorded in pool so that it shows up in the summary. """
+
+        for (host, label, start_time, exit_code) in self.failed:
+            pool.record(host, label, start_time, start_time, exit_code)
+
+        if self.reader.pending():
+            self.rsv.echo("\nWaiting for %s Condor jobs" % self.reader.pending())
+
+        for waiting in self.reader.wait():
+            (host, label, count, metric, job, start_time) = waiting.job
+            job.log_contents = waiting.get_log_contents()
+
+            # Same clean up that CondorG.wait() does
+            if waiting.result in (CondorEvents.JOB_SUBMIT_FAILED, CondorEvents.JOB_RESOURCE_DOWN,
+                                  CondorEvents.JOB_TIMED_OUT, CondorEvents.JOB_HELD):
+                job.remove()
+
+            exit_code = 0
+            try:
+                echo_metric_header(self.rsv, metric, count, self.total)
+                handle_condor_result(self.rsv, metric, job, waiting.result)
+            except SystemExit, err:
+                exit_code = JobPool.exit_code_from_system_exit(err)
+            pool.record(host, label, start_time, time.time(), exit_code)
+
+        return
+
+
+    def cleanup(self):
+        """ Remove any jobs we are leaving behind (e.g. on Ctrl-C) and the shared log """
+
+        for waiting in self.reader.jobs.values():
+            waiting.job[4].remove()
+        self.reader.close()
+        try:
+            shutil.rmtree(self.tempdir)
+        except OSError, err:
+            self.rsv.log("WARNING", "Could not remove Condor batch directory '%s'.  Error %s" % (self.tempdir, err))
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+""" A stand-in for the Condor-Cron schedd, used to test CondorBackend.
+
+The jobs are kept in a pickle file so that the fake condor_cron_q,
+condor_cron_submit and condor_cron_rm commands (see write_commands) and the
+fake htcondor bindings (FakeHTCondor) see the same queue.  Job attributes are
+kept as the text condor_cron_q -l would print, e.g. strings are quoted.
+
+Only the constraints RSV uses are understood: 'true' and comparisons joined
+with '&&', e.g.  ClusterId==3 && ProcId==0 """
+
+import os
+import re
+import sys
+import cPickle
+
+COMPARISON = re.compile(r'^\s*(\w+)\s*==\s*(.+?)\s*$')
+
+# Submit commands that become job attributes, and what they are called in the job ad
+SUBMIT_ATTRIBUTES = {"executable": "Cmd", "arguments": "Args", "universe": "JobUniverse",
+                     "log": "UserLog", "output": "Out", "error": "Err"}
+
+
+class FakeSchedd:
+    """ A queue of jobs stored in path """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            self.save({"next_cluster": 1, "jobs": []})
+
+
+    def load(self):
+        fd = open(self.path, 'rb')
+        try:
+            return cPickle.load(fd)
+        finally:
+            fd.close()
+
+
+    def save(self, state):
+        fd = open(self.path, 'wb')
+        try:
+            cPickle.dump(state, fd)
+        finally:
+            fd.close()
+
+
+    def jobs(self):
+        return self.load()["jobs"]
+
+
+    def query(self, constraint=None, projection=None):
+        """ Return the ads of the jobs matching constraint, with only the attributes
+        in projection if it is given """
+        ads = []
+        for job in self.jobs():
+            if not matches(job, constraint):
+                continue
+            if projection:
+                ads.append(dict([(name, job[name]) for name in projection if name in job]))
+            else:
+                ads.append(dict(job))
+        return ads
+
+
+    def submit(self, descriptions, owner="rsv", single_cluster=False):
+        """ Queue a cluster for each (description, count) pair and return the list
+        of cluster IDs.  With single_cluster all of the jobs go into one cluster, as
+        condor_submit does with a file that has several Queue statements.  Nothing
+        is queued if any description is invalid. """
+
+        state = self.load()
+        clusters = []
+        proc = 0
+        for (description, count) in descriptions:
+            attributes = parse_description(description)
+            if not (single_cluster and clusters):
+                cluster = state["next_cluster"]
+                state["next_cluster"] += 1
+                clusters.append(cluster)
+                proc = 0
+            for index in range(count):
+                job = dict(attributes)
+                job["ClusterId"] = str(cluster)
+                job["ProcId"] = str(proc)
+                proc += 1
+                job["JobStatus"] = "1"
+                job["Owner"] = '"%s"' % owner
+                state["jobs"].append(job)
+
+        self.save(state)
+        return clusters
+
+
+    def remove(self, constraint=None):
+        """ Remove the jobs matching constraint and return how many there were """
+        state = self.load()
+        kept = [job for job in state["jobs"] if not matches(job, constraint)]
+        removed = len(state["jobs"]) - len(kept)
+        state["jobs"] = kept
+        self.save(state)
+        return removed
+
+
+
+def matches(job, constraint):
+    if constraint is None or constraint.strip().lower() == "true":
+        return True
+
+    for term in constraint.split("&&"):
+        match = COMPARISON.match(term)
+        if not match:
+            raise ValueError("Unsupported constraint: %s" % constraint)
+        (name, value) = match.groups()
+        if job.get(name) != value:
+            return False
+    return True
+
+
+def parse_description(description):
+    """ Return the job attributes set by a submit description.  Raises ValueError
+    if it has no (or an empty) Executable. """
+
+    attributes = {}
+    for line in description.split("\n"):
+        if "=" not in line:
+            continue
+        (key, value) = [part.strip() for part in line.split("=", 1)]
+        if key.startswith("+"):
+            attributes[key[1:]] = value
+        elif key.lower() in SUBMIT_ATTRIBUTES:
+            attributes[SUBMIT_ATTRIBUTES[key.lower()]] = '"%s"' % value
+
+    if attributes.get("Cmd", '""') == '""':
+        raise ValueError("No Executable in submit description")
+    return attributes
+
+
+
+class FakeExpression:
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+
+class FakeAd:
+    """ Enough of a classad.ClassAd for BindingsBackend.query """
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+
+    def keys(self):
+        return self.attributes.keys()
+
+    def lookup(self, name):
+        return FakeExpression(self.attributes[name])
+
+
+class FakeTransaction:
+    def __init__(self, schedd):
+        self.schedd = schedd
+        self.pending = []
+        self.next_cluster = None
+
+    def __enter__(self):
+        self.next_cluster = self.schedd.load()["next_cluster"]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Like the real schedd, an exception aborts the whole transaction
+        if exc_type is None:
+            self.schedd.submit(self.pending)
+        return False
+
+
+class FakeSubmit:
+    def __init__(self, description):
+        self.description = description
+
+    def queue(self, transaction, count=1):
+        try:
+            parse_description(self.description)
+        except ValueError, err:
+            raise RuntimeError(str(err))
+        transaction.pending.append((self.description, count))
+        return transaction.next_cluster + len(transaction.pending) - 1
+
+
+class FakeJobAction:
+    Remove = "Remove"
+
+
+class FakeBindingsSchedd:
+    def __init__(self, schedd):
+        self.schedd = schedd
+
+    def query(self, constraint, projection):
+        return [FakeAd(ad) for ad in self.schedd.query(constraint, projection)]
+
+    def transaction(self):
+        return FakeTransaction(self.schedd)
+
+    def act(self, action, constraint):
+        if action != FakeJobAction.Remove:
+            raise RuntimeError("Unsupported action %s" % action)
+        self.schedd.remove(constraint)
+
+
+class FakeHTCondor:
+    """ Stands in for the htcondor module """
+
+    JobAction = FakeJobAction
+    Submit = FakeSubmit
+
+    def __init__(self, schedd):
+        self.schedd = schedd
+
+    def Schedd(self):
+        return FakeBindingsSchedd(self.schedd)
+
+    def reload_config(self):
+        pass
+
+
+
+def write_commands(bin_dir, state_path):
+    """ Write fake condor_cron_q, condor_cron_submit and condor_cron_rm commands
+    into bin_dir that work on the queue in state_path """
+
+    for command in ("q", "submit", "rm"):
+        path = os.path.join(bin_dir, "condor_cron_" + command)
+        fd = open(path, 'w')
+        fd.write('#!/bin/sh\nexec "%s" "%s" "%s" %s "$@"\n' %
+                 (sys.executable, os.path.abspath(__file__).replace(".pyc", ".py"), state_path, command))
+        fd.close()
+        os.chmod(path, 0755)
+
+
+def main(args):
+    """ The fake condor_cron_* commands """
+
+    schedd = FakeSchedd(args[0])
+    command = args[1]
+    args = args[2:]
+
+    constraint = None
+    if "-constraint" in args:
+        index = args.index("-constraint")
+        constraint = args[index + 1]
+        del args[index:index + 2]
+
+    if command == "q":
+        if args and args[0] == "-af:rt":
+            projection = args[1:]
+            for ad in schedd.query(constraint, projection):
+                print "\t".join([ad.get(name, "undefined") for name in projection])
+        else:
+            for ad in schedd.query(constraint):
+                for name in ad.keys():
+                    print "%s = %s" % (name, ad[name])
+                print
+    elif command == "submit":
+        fd = open(args[0])
+        contents = fd.read()
+        fd.close()
+        descriptions = []
+        commands = []
+        for line in contents.split("\n"):
+            if line.strip().lower().startswith("queue"):
+                words = line.split()
+                count = 1
+                if len(words) > 1:
+                    count = int(words[1])
+                descriptions.append(("\n".join(commands), count))
+            else:
+                commands.append(line)
+        try:
+            clusters = schedd.submit(descriptions, single_cluster=True)
+        except ValueError, err:
+            print >> sys.stderr, "ERROR: %s" % err
+            return 1
+        total = 0
+        for (description, count) in descriptions:
+            total += count
+        print "Submitting job(s)."
+        print "%s job(s) submitted to cluster %s." % (total, clusters[0])
+    elif command == "rm":
+        schedd.remove(constraint)
+        print "Jobs matching constraint %s have been marked for removal" % constraint
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+""" Tests for CondorBackend, run against the fake schedd in fakecondor.py """
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, "..", "lib", "python", "rsv"))
+sys.path.insert(0, TEST_DIR)
+
+import Condor
+import CondorBackend
+import fakecondor
+
+SUBMIT_FILE = """Universe = local
+Executable = /usr/libexec/rsv/metrics/org.osg.test
+Arguments = -m org.osg.test -u ce.example.org
++OSGRSV = "metrics"
++OSGRSVUniqueName = "ce.example.org__org.osg.test"
+Queue
+Executable = /usr/libexec/rsv/metrics/org.osg.other
++OSGRSVUniqueName = "ce.example.org__org.osg.other"
+Queue 2
+"""
+
+
+class FakeRSV:
+    def __init__(self, backend="cli"):
+        self.backend = backend
+        self.messages = []
+
+    def log(self, level, message, indent=0):
+        self.messages.append((level, message))
+
+    def get_user(self):
+        return None
+
+    def get_condor_backend(self):
+        return self.backend
+
+
+
+class BackendTests:
+    """ Tests run through each backend.  Subclasses set up self.backend. """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="rsv-test-")
+        self.schedd = fakecondor.FakeSchedd(os.path.join(self.tempdir, "queue"))
+        self.rsv = FakeRSV()
+        self.condor = Condor.Condor(self.rsv)
+        self.backend = self.make_backend()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def submit(self, contents=SUBMIT_FILE):
+        sub_file_name = os.path.join(self.tempdir, "test.sub")
+        fd = open(sub_file_name, 'w')
+        fd.write(contents)
+        fd.close()
+        return self.backend.submit(contents, sub_file_name, None)
+
+
+    def test_submit(self):
+        job_ids = self.submit()
+        self.assertEqual(len(job_ids), 3)
+        self.assertEqual(len(self.schedd.jobs()), 3)
+        # Each ID is a different job
+        self.assertEqual(len(dict([(job_id, 1) for job_id in job_ids])), 3)
+        for (cluster, proc) in job_ids:
+            ads = self.schedd.query("ClusterId==%s && ProcId==%s" % (cluster, proc))
+            self.assertEqual(len(ads), 1)
+
+
+    def test_submit_invalid(self):
+        self.assertEqual(self.submit("Universe = local\nQueue\n"), None)
+        self.assertEqual(self.schedd.jobs(), [])
+
+
+    def test_query(self):
+        self.submit()
+        ads = self.backend.query()
+        self.assertEqual(len(ads), 3)
+        names = [ad["OSGRSVUniqueName"] for ad in ads]
+        names.sort()
+        self.assertEqual(names, ['"ce.example.org__org.osg.other"', '"ce.example.org__org.osg.other"',
+                                 '"ce.example.org__org.osg.test"'])
+
+
+    def test_query_constraint(self):
+        self.submit()
+        ads = self.backend.query('OSGRSVUniqueName=="ce.example.org__org.osg.test"')
+        self.assertEqual(len(ads), 1)
+        self.assertEqual(ads[0]["OSGRSV"], '"metrics"')
+        self.assertEqual(ads[0]["ProcId"], "0")
+
+
+    def test_query_projection(self):
+        self.submit()
+        ads = self.backend.query(None, ["ClusterId", "OSGRSV", "DeferralTime"])
+        self.assertEqual(len(ads), 3)
+        # Attributes that are not in the projection are not fetched, and
+        # attributes that a job does not have are left out
+        for ad in ads:
+            keys = ad.keys()
+            keys.sort()
+            self.assertEqual(keys, ["ClusterId", "OSGRSV"])
+            self.assertEqual(ad["OSGRSV"], '"metrics"')
+
+
+    def test_remove(self):
+        self.submit()
+        self.failUnless(self.backend.remove('OSGRSVUniqueName=="ce.example.org__org.osg.other"'))
+        ads = self.backend.query()
+        self.assertEqual(len(ads), 1)
+        self.assertEqual(ads[0]["OSGRSVUniqueName"], '"ce.example.org__org.osg.test"')
+
+        self.failUnless(self.backend.remove(None))
+        self.assertEqual(self.backend.query(), [])
+
+
+    def test_condor_submit_jobs(self):
+        # Through the Condor class, as RSV uses it
+        self.condor.backend = self.backend
+        job_ids = self.condor.submit_jobs(SUBMIT_FILE, "test", dir=self.tempdir)
+        self.assertEqual(len(job_ids), 3)
+        self.failIf(os.path.exists(os.path.join(self.tempdir, "test.sub")))
+
+
+
+class CLIBackendTests(BackendTests, unittest.TestCase):
+
+    def make_backend(self):
+        bin_dir = os.path.join(self.tempdir, "bin")
+        os.mkdir(bin_dir)
+        fakecondor.write_commands(bin_dir, self.schedd.path)
+        self.original_path = os.environ["PATH"]
+        os.environ["PATH"] = bin_dir + os.pathsep + self.original_path
+        return CondorBackend.CLIBackend(self.condor)
+
+
+    def tearDown(self):
+        os.environ["PATH"] = self.original_path
+        BackendTests.tearDown(self)
+
+
+
+class BindingsBackendTests(BackendTests, unittest.TestCase):
+
+    def make_backend(self):
+        return CondorBackend.BindingsBackend(self.condor, fakecondor.FakeHTCondor(self.schedd))
+
+
+    def test_submit_is_one_transaction(self):
+        # The last cluster is invalid, so the others must not be queued either
+        contents = SUBMIT_FILE + "Executable =\nQueue\n"
+        self.assertEqual(self.submit(contents), None)
+        self.assertEqual(self.schedd.jobs(), [])
+
+
+    def test_submit_clusters(self):
+        job_ids = self.submit()
+        self.assertEqual(job_ids, [("1", "0"), ("2", "0"), ("2", "1")])
+
+
+
+class GetBackendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.original_bindings = CondorBackend.htcondor
+        self.tempdir = tempfile.mkdtemp(prefix="rsv-test-")
+
+
+    def tearDown(self):
+        CondorBackend.htcondor = self.original_bindings
+        shutil.rmtree(self.tempdir)
+
+
+    def get_backend(self, choice):
+        return CondorBackend.get_backend(Condor.Condor(FakeRSV(choice)))
+
+
+    def test_cli(self):
+        CondorBackend.htcondor = fakecondor.FakeHTCondor(fakecondor.FakeSchedd(os.path.join(self.tempdir, "queue")))
+        self.assertEqual(self.get_backend("cli").name, "cli")
+
+
+    def test_python(self):
+        CondorBackend.htcondor = fakecondor.FakeHTCondor(fakecondor.FakeSchedd(os.path.join(self.tempdir, "queue")))
+        self.assertEqual(self.get_backend("python").name, "python")
+        self.assertEqual(self.get_backend("auto").name, "python")
+
+
+
+class SplitSubmitFileTests(unittest.TestCase):
+
+    def test_split(self):
+        descriptions = CondorBackend.split_submit_file(SUBMIT_FILE)
+        self.assertEqual([count for (description, count) in descriptions], [1, 2])
+        # Commands carry over to the next Queue statement
+        self.failUnless("+OSGRSV = \"metrics\"" in descriptions[1][0])
+        self.failUnless("org.osg.other" in descriptions[1][0])
+
+
+    def test_unsupported_queue(self):
+        self.assertEqual(CondorBackend.split_submit_file("Executable = x\nQueue from list.txt\n"), None)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
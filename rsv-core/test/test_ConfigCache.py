@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+""" Tests for Metric.ConfigCache """
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, "..", "lib", "python", "rsv"))
+
+import Metric
+
+SECTIONS = [("org.osg.test", [("service-type", "OSG-CE"), ("execute", "local")])]
+
+
+class ConfigCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="rsv-test-")
+        self.cache_path = os.path.join(self.tempdir, "metric-config.cache")
+        self.config_file = os.path.join(self.tempdir, "org.osg.test.conf")
+        self.write_config("[org.osg.test]\nexecute = local\n")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def write_config(self, contents):
+        fd = open(self.config_file, 'w')
+        fd.write(contents)
+        fd.close()
+
+
+    def signature(self):
+        return (Metric.file_signature(self.config_file), Metric.file_signature(self.config_file + ".missing"))
+
+
+    def test_hit(self):
+        cache = Metric.ConfigCache(self.cache_path)
+        cache.put(("org.osg.test", "ce.example.org"), self.signature(), SECTIONS)
+        cache.flush()
+
+        # Another process reads it from the file
+        cache = Metric.ConfigCache(self.cache_path)
+        self.assertEqual(cache.get(("org.osg.test", "ce.example.org"), self.signature()), SECTIONS)
+        self.assertEqual(cache.get(("org.osg.test", "other.example.org"), self.signature()), None)
+
+
+    def test_changed_file(self):
+        cache = Metric.ConfigCache(self.cache_path)
+        cache.put(("org.osg.test", ""), self.signature(), SECTIONS)
+        cache.flush()
+
+        self.write_config("[org.osg.test]\nexecute = local\nno-ping = True\n")
+        cache = Metric.ConfigCache(self.cache_path)
+        self.assertEqual(cache.get(("org.osg.test", ""), self.signature()), None)
+
+
+    def test_created_file(self):
+        cache = Metric.ConfigCache(self.cache_path)
+        cache.put(("org.osg.test", ""), self.signature(), SECTIONS)
+        cache.flush()
+
+        # A file that did not exist (e.g. a host's allmetrics.conf) now does
+        self.config_file += ".missing"
+        self.write_config("[org.osg.test]\n")
+        self.config_file = self.config_file[:-len(".missing")]
+        cache = Metric.ConfigCache(self.cache_path)
+        self.assertEqual(cache.get(("org.osg.test", ""), self.signature()), None)
+
+
+    def test_flush_merges(self):
+        first = Metric.ConfigCache(self.cache_path)
+        second = Metric.ConfigCache(self.cache_path)
+        first.put(("first", ""), self.signature(), SECTIONS)
+        second.put(("second", ""), self.signature(), SECTIONS)
+        first.flush()
+        second.flush()
+
+        cache = Metric.ConfigCache(self.cache_path)
+        self.assertEqual(cache.get(("first", ""), self.signature()), SECTIONS)
+        self.assertEqual(cache.get(("second", ""), self.signature()), SECTIONS)
+
+
+    def test_written_once(self):
+        cache = Metric.ConfigCache(self.cache_path)
+        for index in range(1000):
+            cache.put(("metric%s" % index, "ce.example.org"), self.signature(), SECTIONS)
+        # Nothing is written until the cache is flushed
+        self.failIf(os.path.exists(self.cache_path))
+        cache.flush()
+        self.assertEqual(len(cache.read()), 1000)
+
+
+
+if __name__ == "__main__":
+    unittest.main()
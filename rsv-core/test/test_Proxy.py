@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+""" Tests for Proxy, with a fake openssl """
+
+import os
+import sys
+import time
+import shutil
+import calendar
+import tempfile
+import unittest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, "..", "lib", "python", "rsv"))
+
+import Proxy
+
+ENDDATE = "notAfter=Oct  8 12:00:00 2026 GMT\n"
+NOT_AFTER = calendar.timegm((2026, 10, 8, 12, 0, 0, 0, 0, 0))
+
+
+class FakeRSV:
+    """ Answers 'openssl x509 -enddate' with the first line of the proxy file """
+
+    def __init__(self):
+        self.commands = []
+        self.messages = []
+
+    def log(self, level, message, indent=0):
+        self.messages.append((level, message))
+
+    def run_command(self, command):
+        self.commands.append(command)
+        fd = open(command[command.index("-in") + 1])
+        line = fd.readline()
+        fd.close()
+        if not line.startswith("notAfter="):
+            return (1, "", "unable to load certificate\n")
+        return (0, line, "")
+
+
+
+class ParseEnddateTests(unittest.TestCase):
+
+    def test_padded_day(self):
+        self.assertEqual(Proxy.parse_enddate(ENDDATE), NOT_AFTER)
+
+    def test_two_digit_day(self):
+        self.assertEqual(Proxy.parse_enddate("notAfter=Oct 18 12:00:00 2026 GMT\n"),
+                         NOT_AFTER + 10 * 24 * 60 * 60)
+
+    def test_garbage(self):
+        self.assertEqual(Proxy.parse_enddate("unable to load certificate\n"), None)
+        self.assertEqual(Proxy.parse_enddate("notAfter=Foo  8 12:00:00 2026 GMT\n"), None)
+        self.assertEqual(Proxy.parse_enddate("notAfter=Oct  8 noon 2026 GMT\n"), None)
+        self.assertEqual(Proxy.parse_enddate("notAfter=\n"), None)
+        self.assertEqual(Proxy.parse_enddate(""), None)
+
+
+
+class ProxyCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="rsv-test-")
+        self.proxy = os.path.join(self.tempdir, "proxy")
+        self.cache_path = os.path.join(self.tempdir, "proxy-expiry.cache")
+        self.rsv = FakeRSV()
+        self.write_proxy(ENDDATE)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def write_proxy(self, contents, path=None):
+        fd = open(path or self.proxy, 'w')
+        fd.write(contents)
+        fd.close()
+
+
+    def cache(self):
+        return Proxy.ProxyCache(self.rsv, "openssl", self.cache_path)
+
+
+    def test_reused(self):
+        self.assertEqual(self.cache().get_enddate(self.proxy), (NOT_AFTER, ENDDATE))
+        # Another invocation reads the answer from the cache file
+        self.assertEqual(self.cache().get_enddate(self.proxy), (NOT_AFTER, ENDDATE))
+        self.assertEqual(len(self.rsv.commands), 1)
+
+
+    def test_size_changed(self):
+        cache = self.cache()
+        cache.get_enddate(self.proxy)
+        self.write_proxy("notAfter=Oct 18 12:00:00 2026 GMT\n\n")
+        self.assertEqual(cache.get_enddate(self.proxy)[0], NOT_AFTER + 10 * 24 * 60 * 60)
+        self.assertEqual(len(self.rsv.commands), 2)
+
+
+    def test_mtime_changed(self):
+        cache = self.cache()
+        cache.get_enddate(self.proxy)
+        info = os.stat(self.proxy)
+        os.utime(self.proxy, (info.st_atime, info.st_mtime - 60))
+        cache.get_enddate(self.proxy)
+        self.assertEqual(len(self.rsv.commands), 2)
+
+
+    def test_inode_changed(self):
+        cache = self.cache()
+        cache.get_enddate(self.proxy)
+        info = os.stat(self.proxy)
+
+        # Same size and mtime, but a new file (as grid-proxy-init writes it)
+        new_proxy = self.proxy + ".new"
+        self.write_proxy(ENDDATE, new_proxy)
+        os.utime(new_proxy, (info.st_atime, info.st_mtime))
+        os.rename(new_proxy, self.proxy)
+
+        cache.get_enddate(self.proxy)
+        self.assertEqual(len(self.rsv.commands), 2)
+
+
+    def test_missing(self):
+        (not_after, out) = self.cache().get_enddate(os.path.join(self.tempdir, "missing"))
+        self.assertEqual(not_after, None)
+        self.assertEqual(self.rsv.commands, [])
+
+
+    def test_unreadable_not_cached(self):
+        self.write_proxy("garbage\n")
+        cache = self.cache()
+        self.assertEqual(cache.get_enddate(self.proxy), (None, "unable to load certificate\n"))
+        cache.get_enddate(self.proxy)
+        self.assertEqual(len(self.rsv.commands), 2)
+
+
+    def test_check_end(self):
+        cache = self.cache()
+        (expiring, out) = cache.check_end(self.proxy, 3600, NOT_AFTER - 7200)
+        self.failIf(expiring)
+        self.assertEqual(out, ENDDATE + "Certificate will not expire\n")
+
+        (expiring, out) = cache.check_end(self.proxy, 3600, NOT_AFTER - 1800)
+        self.failUnless(expiring)
+        self.assertEqual(out, ENDDATE + "Certificate will expire\n")
+
+        self.write_proxy("garbage\n")
+        self.failUnless(cache.check_end(self.proxy, 3600, NOT_AFTER - 7200)[0])
+
+
+
+class LockTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="rsv-test-")
+        self.path = os.path.join(self.tempdir, "proxy-renewal.lock")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
+    def test_lock(self):
+        fd = Proxy.lock(self.path, 1)
+        self.failIf(fd is None)
+        Proxy.unlock(fd)
+        fd = Proxy.lock(self.path, 1)
+        self.failIf(fd is None)
+        Proxy.unlock(fd)
+
+
+    def test_held(self):
+        fd = Proxy.lock(self.path, 1)
+        try:
+            start = time.time()
+            self.assertEqual(Proxy.lock(self.path, 0.3), None)
+            self.failUnless(time.time() - start < 2)
+        finally:
+            Proxy.unlock(fd)
+
+
+    def test_symlink(self):
+        target = os.path.join(self.tempdir, "target")
+        os.symlink(target, self.path)
+        self.assertEqual(Proxy.lock(self.path, 0.3), None)
+        self.failIf(os.path.exists(target))
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+""" Tests for Reachability, run against 127.0.0.1 and a fake ping command """
+
+import os
+import sys
+import time
+import socket
+import shutil
+import cPickle
+import tempfile
+import unittest
+import ConfigParser
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TEST_DIR, "..", "lib", "python", "rsv"))
+
+import Reachability
+
+# Records each host it is asked to ping.  Hosts starting with 'up' answer.
+FAKE_PING = """#!/bin/sh
+for host; do :; done
+echo "$host" >> "%s"
+case "$host" in up*) exit 0;; esac
+exit 1
+"""
+
+
+class FakeRSV:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.messages = []
+        self.config = ConfigParser.RawConfigParser()
+        self.config.add_section("rsv")
+        self.config.set("rsv", "job-timeout", "10")
+
+    def log(self, level, message, indent=0):
+        self.messages.append((level, message))
+
+    def get_ping_cache_ttl(self):
+        return self.ttl
+
+
+
+def listening_socket():
+    """ Return a socket listening on a free port of 127.0.0.1 """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(5)
+    return sock
+
+
+def closed_port():
+    """ Return a port of 127.0.0.1 that nothing listens on """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+
+class SplitURITests(unittest.TestCase):
+
+    def test_host_and_port(self):
+        self.assertEqual(Reachability.split_uri("ce.example.org:2119"), ("ce.example.org", 2119))
+
+    def test_host(self):
+        self.assertEqual(Reachability.split_uri("ce.example.org"), ("ce.example.org", None))
+
+    def test_bad_port(self):
+        self.assertEqual(Reachability.split_uri("ce.example.org:gsiftp"), ("ce.example.org", None))
+
+
+
+class TCPConnectTests(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = listening_socket()
+
+    def tearDown(self):
+        self.listener.close()
+
+
+    def test_listening(self):
+        port = self.listener.getsockname()[1]
+        self.assertEqual(Reachability.tcp_connect([("127.0.0.1", port)], 3), {"127.0.0.1": None})
+
+
+    def test_refused(self):
+        errors = Reachability.tcp_connect([("127.0.0.1", closed_port())], 3)
+        self.assertEqual(errors.keys(), ["127.0.0.1"])
+        self.failIf(errors["127.0.0.1"] is None)
+
+
+    def test_together(self):
+        # 'localhost' and '127.0.0.1' are different hosts as far as tcp_connect knows
+        port = self.listener.getsockname()[1]
+        errors = Reachability.tcp_connect([("127.0.0.1", port), ("localhost", closed_port())], 3)
+        self.assertEqual(errors["127.0.0.1"], None)
+        self.failIf(errors["localhost"] is None)
+
+
+
+class ReachabilityTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="rsv-test-")
+        self.ping_log = os.path.join(self.tempdir, "pinged")
+        self.cache_path = os.path.join(self.tempdir, "reachability.cache")
+
+        ping = os.path.join(self.tempdir, "ping")
+        fd = open(ping, 'w')
+        fd.write(FAKE_PING % self.ping_log)
+        fd.close()
+        os.chmod(ping, 0755)
+        self.original_ping = Reachability.PING_EXE
+        Reachability.PING_EXE = ping
+
+
+    def tearDown(self):
+        Reachability.PING_EXE = self.original_ping
+        shutil.rmtree(self.tempdir)
+
+
+    def reachability(self, ttl=60):
+        return Reachability.Reachability(FakeRSV(ttl), self.cache_path)
+
+
+    def pinged(self):
+        if not os.path.exists(self.ping_log):
+            return []
+        fd = open(self.ping_log)
+        hosts = fd.read().split()
+        fd.close()
+        hosts.sort()
+        return hosts
+
+
+    def test_one_probe_per_host(self):
+        reachability = self.reachability()
+        reachability.check(["up.example.org:2119", "up.example.org:2811", "up.example.org",
+                            "down.example.org"])
+        self.assertEqual(self.pinged(), ["down.example.org", "up.example.org"])
+        self.failUnless(reachability.get_status("up.example.org:2119").reachable)
+        self.failIf(reachability.get_status("down.example.org").reachable)
+        # Both were answered from memory
+        self.assertEqual(len(self.pinged()), 2)
+
+
+    def test_cache_reused(self):
+        self.reachability().check(["up.example.org"])
+        # Another invocation within the TTL reads the cache file
+        status = self.reachability().get_status("up.example.org")
+        self.failUnless(status.reachable)
+        self.assertEqual(self.pinged(), ["up.example.org"])
+
+
+    def test_cache_expired(self):
+        self.reachability().check(["up.example.org"])
+
+        # Age the result past the TTL
+        fd = open(self.cache_path, 'rb')
+        results = cPickle.load(fd)
+        fd.close()
+        results["up.example.org"].checked = time.time() - 120
+        fd = open(self.cache_path, 'wb')
+        cPickle.dump(results, fd)
+        fd.close()
+
+        self.reachability().get_status("up.example.org")
+        self.assertEqual(self.pinged(), ["up.example.org", "up.example.org"])
+
+
+    def test_no_cache(self):
+        reachability = self.reachability(ttl=0)
+        reachability.check(["up.example.org"])
+        reachability.get_status("up.example.org")
+        self.assertEqual(self.pinged(), ["up.example.org", "up.example.org"])
+        self.failIf(os.path.exists(self.cache_path))
+
+
+    def test_tcp_fallback(self):
+        listener = listening_socket()
+        try:
+            port = listener.getsockname()[1]
+            # The fake ping never answers for 127.0.0.1
+            status = self.reachability(ttl=0).get_status("127.0.0.1:%s" % port)
+            self.failUnless(status.reachable)
+        finally:
+            listener.close()
+
+
+    def test_tcp_fallback_refused(self):
+        status = self.reachability(ttl=0).get_status("127.0.0.1:%s" % closed_port())
+        self.failIf(status.reachable)
+        self.failUnless("TCP connection to 127.0.0.1" in status.stderr)
+
+
+
+if __name__ == "__main__":
+    unittest.main()